@@ -3,11 +3,32 @@ import hashlib
 from datetime import datetime, date, time as tm, timedelta
 import base64
 import sqlite3
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
+from PIL import Image, ImageOps
 import time
+import csv
 import io
+import json
+import re
+import unicodedata
+import threading
+import queue
+import hmac
+import urllib.request
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import openpyxl
+except ImportError:  # export XLSX indisponible, CSV seulement
+    openpyxl = None
+try:
+    import pyarrow  # moteur Parquet des archives mensuelles
+except ImportError:  # archivage désactivé, tout reste en base
+    pyarrow = None
 
 
 # =========================
@@ -28,78 +49,561 @@ DB_PATH = "pointage_db.sqlite"
 DEFAULT_ADMIN_USER = "admin"
 DEFAULT_ADMIN_PASS = "admin123"
 
+# Réglages appliqués une seule fois à l'ouverture de chaque connexion du pool
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("busy_timeout", 5000),       # ms d'attente avant "database is locked"
+    ("synchronous", "NORMAL"),    # suffisant en WAL, évite un fsync par commit
+    ("cache_size", -16000),       # 16 Mo de cache de pages par connexion
+    ("mmap_size", 67108864),      # 64 Mo lus via mmap
+)
+POOL_MAX_CONNEXIONS = 8
+
+# Tâches planifiées exécutées par le thread de fond (voir PlanificateurTaches)
+PLANIFICATEUR_ACTIF = True
+PLANIFICATEUR_INTERVALLE = 60            # secondes entre deux vérifications des échéances
+HEURE_ROTATION_NUIT = tm(17, 0)          # bascule du groupe de nuit, avant la prise de poste
+HEURE_CLOTURE_JOUR = tm(23, 50)          # tâches de fin de journée
+HEURE_CALENDRIER_SHIFTS = tm(0, 5)       # prolongation quotidienne du calendrier des shifts prévus
+SHIFTS_HORIZON_JOURS = 30                # jours à venir matérialisés dans shifts_prevus
+MARGE_ARRIVEE_SHIFT_MINUTES = 240        # arrivée rattachée à un shift jusqu'à 4 h avant son début
+MARGE_DEPART_SHIFT_MINUTES = 240         # départ rattaché à un shift jusqu'à 4 h après sa fin
+
+# Service HTTP local recevant les pointages des badgeuses (voir _GestionnairePointage)
+SERVICE_POINTAGE_ACTIF = True
+SERVICE_POINTAGE_HOTE = "127.0.0.1"
+SERVICE_POINTAGE_PORT = 8765
+SERVICE_POINTAGE_JETON = os.environ.get("POINTAGE_JETON")  # en-tête X-Jeton exigé ; service non démarré sans jeton
+SERVICE_POINTAGE_LOT_MAX = 500
+
+# File d'écriture : un thread écrivain valide les écritures concurrentes par groupes
+FILE_ECRITURES_ACTIVE = True
+FILE_ECRITURES_CAPACITE = 2000           # commandes en attente avant contre-pression
+FILE_ECRITURES_GROUPE_MAX = 64           # commandes par transaction
+FILE_ECRITURES_DELAI = 10                # secondes d'attente max quand la file est pleine
+
+# Certificats d'absence stockés sur disque, nommés par leur SHA-256 (dossier relatif à la base)
+CERTIFICATS_DIR = "certificats"
+APERCU_MAX_PX = 320                      # vignette affichée en premier
+AFFICHAGE_MAX_PX = 1600                  # image recompressée affichée en grand
+AFFICHAGE_MAX_OCTETS = 400 * 1024
+EXPORTS_DIR = "exports"
+EXPORT_TAILLE_LOT = 2000                 # lignes lues du curseur par lot
+
+# Mois clos archivés en Parquet (archives/<table>/year=AAAA/month=M/) puis retirés de la base
+ARCHIVAGE_ACTIF = True
+ARCHIVES_DIR = "archives"
+ARCHIVE_MOIS_CONSERVES = 3               # mois gardés en base en plus du mois courant
+
 # =========================
 # Connexion SQLite
 # =========================
 
-def get_connection():
-    try:
-        conn = sqlite3.connect(DB_PATH)
+class ConnexionPoolee(sqlite3.Connection):
+    """Connexion SQLite dont close() la rend au pool au lieu de la fermer"""
+
+    def close(self):
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            pool.restituer(self)
+        else:
+            super().close()
+
+    def fermer_definitivement(self):
+        super().close()
+
+
+class PoolConnexions:
+    """Pool de connexions SQLite partagé par le processus.
+
+    Chaque connexion empruntée est réservée au thread emprunteur jusqu'à son
+    close(); elle est ensuite réutilisée par les exécutions Streamlit suivantes
+    avec ses PRAGMA déjà appliqués.
+    """
+
+    def __init__(self, db_path, taille_max=POOL_MAX_CONNEXIONS):
+        self.db_path = db_path
+        self.taille_max = taille_max
+        self._libres = []
+        self._lock = threading.Lock()
+
+    def _ouvrir(self):
+        conn = sqlite3.connect(self.db_path, factory=ConnexionPoolee, check_same_thread=False)
+        for nom, valeur in SQLITE_PRAGMAS:
+            conn.execute(f"PRAGMA {nom} = {valeur}")
+        conn._pool = self
+        return conn
+
+    def emprunter(self):
+        with self._lock:
+            conn = self._libres.pop() if self._libres else None
+        if conn is None:
+            conn = self._ouvrir()
         conn.row_factory = sqlite3.Row
+        conn._empruntee = True
         return conn
+
+    def restituer(self, conn):
+        # Un double close() ne doit pas remettre deux fois la même connexion
+        if not getattr(conn, "_empruntee", False):
+            return
+        conn._empruntee = False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.fermer_definitivement()
+            return
+        with self._lock:
+            if len(self._libres) < self.taille_max:
+                self._libres.append(conn)
+                return
+        conn.fermer_definitivement()
+
+    @contextmanager
+    def connexion(self):
+        conn = self.emprunter()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def fermer_tout(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conn in libres:
+            conn.fermer_definitivement()
+
+
+@st.cache_resource(show_spinner=False)
+def get_pool_connexions(db_path):
+    """Pool unique par fichier de base, conservé entre les reruns Streamlit"""
+    return PoolConnexions(db_path)
+
+def get_connection():
+    try:
+        return get_pool_connexions(DB_PATH).emprunter()
     except sqlite3.Error as e:
         st.error(f"Erreur de connexion à SQLite: {e}")
         return None
 
-def test_connection_background():
-    try:
+# =========================
+# File d'écriture (group commit)
+# =========================
+
+class CommandeEcriture:
+    """Écriture en attente : fonction(cur) exécutée par le thread écrivain, résultat livré via future"""
+
+    __slots__ = ("fonction", "future", "soumise_le")
+
+    def __init__(self, fonction):
+        self.fonction = fonction
+        self.future = Future()
+        self.soumise_le = time.perf_counter()
+
+
+class FileEcritures:
+    """File d'écriture à thread écrivain unique.
+
+    Les commandes (pointages, absences, corrections) sont regroupées : chaque
+    groupe tient dans une transaction BEGIN IMMEDIATE, chaque commande dans un
+    SAVEPOINT pour qu'un échec n'annule pas ses voisines, et les futures ne
+    sont résolues qu'après le COMMIT. La file bornée exerce la contre-pression :
+    soumettre() bloque quand elle est pleine, puis échoue après le délai.
+    """
+
+    def __init__(self, capacite=FILE_ECRITURES_CAPACITE, taille_groupe=FILE_ECRITURES_GROUPE_MAX):
+        self.capacite = capacite
+        self.taille_groupe = taille_groupe
+        self._file = queue.Queue(maxsize=capacite)
+        self._lock = threading.Lock()
+        self._compteurs = {
+            "soumises": 0, "traitees": 0, "echecs": 0, "rejetees": 0,
+            "groupes": 0, "plus_grand_groupe": 0,
+            "attente_totale": 0.0, "attente_max": 0.0, "commit_total": 0.0,
+        }
+        self._thread = threading.Thread(target=self._boucle, name="ecrivain-sqlite", daemon=True)
+
+    def demarrer(self):
+        self._thread.start()
+
+    @property
+    def actif(self):
+        return self._thread.is_alive()
+
+    def soumettre(self, fonction, delai=FILE_ECRITURES_DELAI):
+        """Met en file une fonction(cur) et retourne sa future (en échec si la file reste pleine)"""
+        commande = CommandeEcriture(fonction)
+        try:
+            self._file.put(commande, timeout=delai)
+        except queue.Full:
+            with self._lock:
+                self._compteurs["rejetees"] += 1
+            commande.future.set_exception(RuntimeError(f"File d'écriture saturée ({self.capacite} commandes en attente)"))
+            return commande.future
+        with self._lock:
+            self._compteurs["soumises"] += 1
+        return commande.future
+
+    def metriques(self):
+        """Indicateurs de contre-pression : profondeur de file, attentes, taille des groupes"""
+        with self._lock:
+            c = dict(self._compteurs)
+        groupes = c["groupes"] or 1
+        traitees = (c["traitees"] + c["echecs"]) or 1
+        return {
+            "profondeur": self._file.qsize(),
+            "capacite": self.capacite,
+            "soumises": c["soumises"],
+            "traitees": c["traitees"],
+            "echecs": c["echecs"],
+            "rejetees": c["rejetees"],
+            "groupes": c["groupes"],
+            "taille_moyenne_groupe": round((c["traitees"] + c["echecs"]) / groupes, 2),
+            "plus_grand_groupe": c["plus_grand_groupe"],
+            "attente_moyenne_ms": round(c["attente_totale"] * 1000 / traitees, 2),
+            "attente_max_ms": round(c["attente_max"] * 1000, 2),
+            "commit_moyen_ms": round(c["commit_total"] * 1000 / groupes, 2),
+        }
+
+    def _boucle(self):
+        while True:
+            # Bloquer sur la première commande puis prendre tout ce qui attend déjà
+            groupe = [self._file.get()]
+            while len(groupe) < self.taille_groupe:
+                try:
+                    groupe.append(self._file.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._executer_groupe(groupe)
+            except Exception as e:
+                print(f"DEBUG: Erreur thread écrivain - {e}")
+
+    def _executer_groupe(self, groupe):
+        debut = time.perf_counter()
+        resultats = []
         conn = get_connection()
-        if conn:
-            conn.close()
-            return True
-        return False
-    except Exception:
-        return False
+        try:
+            if conn is None:
+                raise RuntimeError("Connexion à la base impossible")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for commande in groupe:
+                    conn.execute("SAVEPOINT commande")
+                    try:
+                        resultats.append((commande, commande.fonction(conn.cursor()), None))
+                        conn.execute("RELEASE commande")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO commande")
+                        conn.execute("RELEASE commande")
+                        resultats.append((commande, None, e))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        except Exception as e:
+            # Transaction du groupe perdue : toutes ses commandes échouent
+            resultats = [(commande, None, e) for commande in groupe]
+        finally:
+            if conn:
+                conn.close()
+
+        fin = time.perf_counter()
+        with self._lock:
+            c = self._compteurs
+            c["groupes"] += 1
+            c["plus_grand_groupe"] = max(c["plus_grand_groupe"], len(groupe))
+            c["commit_total"] += fin - debut
+            for commande, _, erreur in resultats:
+                attente = debut - commande.soumise_le
+                c["attente_totale"] += attente
+                c["attente_max"] = max(c["attente_max"], attente)
+                c["echecs" if erreur else "traitees"] += 1
+
+        # Les appelants ne sont libérés qu'une fois le groupe validé
+        for commande, resultat, erreur in resultats:
+            if erreur:
+                commande.future.set_exception(erreur)
+            else:
+                commande.future.set_result(resultat)
+
+@st.cache_resource(show_spinner=False)
+def get_file_ecritures(db_path):
+    """File d'écriture unique par processus et par base, démarrée au premier usage"""
+    file_ecritures = FileEcritures()
+    file_ecritures.demarrer()
+    return file_ecritures
+
+def executer_ecriture(fonction):
+    """Exécute fonction(cur) dans une transaction d'écriture et retourne son résultat (exception si échec).
+
+    Avec FILE_ECRITURES_ACTIVE, l'écriture passe par le thread écrivain et
+    partage le COMMIT des écritures concurrentes.
+    """
+    if FILE_ECRITURES_ACTIVE:
+        return get_file_ecritures(DB_PATH).soumettre(fonction).result()
+
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError("Connexion à la base impossible")
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return fonction(conn.cursor())
+    finally:
+        conn.close()
 
 # =========================
-# Authentification & Utilisateurs
+# Stockage des certificats (fichiers adressés par SHA-256)
 # =========================
+MIME_CERTIFICATS = {"jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png", "pdf": "application/pdf"}
 
-def sha256(text: str) -> str:
-    return hashlib.sha256(text.encode()).hexdigest()
+def get_dossier_certificats():
+    """Dossier du stockage des certificats, à côté du fichier de base"""
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), CERTIFICATS_DIR)
+
+def chemin_certificat(empreinte):
+    return os.path.join(get_dossier_certificats(), empreinte[:2], empreinte)
+
+def chemin_derive_certificat(empreinte, variante):
+    """Dérivé JPEG d'un certificat image ('apercu' ou 'affichage'), rangé à côté de l'original"""
+    return f"{chemin_certificat(empreinte)}.{variante}.jpg"
+
+def _ecrire_fichier_atomique(chemin, donnees):
+    os.makedirs(os.path.dirname(chemin), exist_ok=True)
+    temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaire, "wb") as f:
+        f.write(donnees)
+        f.flush()
+        os.fsync(f.fileno())
+    # Renommage atomique : jamais de fichier partiel sous une empreinte
+    os.replace(temporaire, chemin)
+
+def stocker_certificat(donnees):
+    """Écrit un contenu sous son empreinte SHA-256, une seule fois par contenu; retourne (empreinte, taille)"""
+    empreinte = hashlib.sha256(donnees).hexdigest()
+    chemin = chemin_certificat(empreinte)
+    if not os.path.exists(chemin):
+        _ecrire_fichier_atomique(chemin, donnees)
+    return empreinte, len(donnees)
+
+def _compresser_jpeg(image, octets_max=None):
+    """Encode en JPEG en baissant la qualité, puis la taille, jusqu'à tenir sous octets_max"""
+    while True:
+        for qualite in (85, 75, 65, 55, 45):
+            tampon = io.BytesIO()
+            image.save(tampon, format="JPEG", quality=qualite, optimize=True, progressive=True)
+            if octets_max is None or tampon.tell() <= octets_max:
+                return tampon.getvalue()
+        if max(image.size) <= APERCU_MAX_PX:
+            return tampon.getvalue()
+        image = image.resize((int(image.width * 0.75), int(image.height * 0.75)), Image.LANCZOS)
+
+def generer_derives_certificat(empreinte):
+    """Crée l'aperçu et l'image d'affichage recompressée d'un certificat image (idempotent)"""
+    variantes = (
+        ("apercu", APERCU_MAX_PX, None),
+        ("affichage", AFFICHAGE_MAX_PX, AFFICHAGE_MAX_OCTETS),
+    )
+    if all(os.path.exists(chemin_derive_certificat(empreinte, v)) for v, _, _ in variantes):
+        return
+
+    with Image.open(chemin_certificat(empreinte)) as original:
+        # Photos de téléphone : appliquer l'orientation EXIF avant de réduire
+        image = ImageOps.exif_transpose(original)
+        if image.mode != "RGB":
+            # Transparence (PNG) aplatie sur fond blanc
+            fond = Image.new("RGB", image.size, "white")
+            fond.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = fond
+
+        for variante, taille_max, octets_max in variantes:
+            chemin = chemin_derive_certificat(empreinte, variante)
+            if os.path.exists(chemin):
+                continue
+            reduite = image.copy()
+            reduite.thumbnail((taille_max, taille_max), Image.LANCZOS)
+            _ecrire_fichier_atomique(chemin, _compresser_jpeg(reduite, octets_max))
+
+def ingerer_certificat(certificat_file):
+    """Stocke un certificat envoyé et prépare ses dérivés d'affichage; retourne (empreinte, taille, mime)"""
+    empreinte, taille = stocker_certificat(certificat_file.getvalue())
+    mime = certificat_file.type
+    if mime.startswith("image/"):
+        try:
+            generer_derives_certificat(empreinte)
+        except Exception as e:
+            # Image illisible : l'original reste affichable et téléchargeable
+            print(f"DEBUG: Dérivés du certificat {empreinte[:12]} non générés - {e}")
+    return empreinte, taille, mime
+
+def purger_certificats_orphelins(delai_grace_heures=24):
+    """Supprime les fichiers qu'aucune absence ne référence plus; retourne le nombre supprimé.
+
+    Le délai de grâce protège les fichiers écrits par un envoi dont la
+    transaction n'est pas encore validée.
+    """
+    dossier = get_dossier_certificats()
+    if not os.path.isdir(dossier):
+        return 0
 
-def create_users_table():
     conn = get_connection()
     if conn is None:
-        return False
-
+        return 0
     try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    role VARCHAR(20) DEFAULT 'user',
-                    email VARCHAR(100),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
+        cur = conn.execute("SELECT DISTINCT certificat_sha256 FROM absences WHERE certificat_sha256 IS NOT NULL")
+        references = {row[0] for row in cur.fetchall()}
+    finally:
+        conn.close()
 
-            # Créer un admin par défaut si absent
-            cur.execute("SELECT COUNT(*) FROM users WHERE username = ?", (DEFAULT_ADMIN_USER,))
-            exists = cur.fetchone()[0]
-            if exists == 0:
-                cur.execute(
-                    "INSERT INTO users (username, password_hash, role, email) VALUES (?, ?, ?, ?)",
-                    (
-                        DEFAULT_ADMIN_USER,
-                        sha256(DEFAULT_ADMIN_PASS),
-                        "admin",
-                        f"{DEFAULT_ADMIN_USER}@example.com",
-                    ),
-                )
-        return True
+    limite = time.time() - delai_grace_heures * 3600
+    supprimes = 0
+    for racine, _, fichiers in os.walk(dossier):
+        for nom in fichiers:
+            chemin = os.path.join(racine, nom)
+            # Les dérivés (empreinte.apercu.jpg, ...) suivent leur original
+            if nom.split('.')[0] not in references and os.path.getmtime(chemin) < limite:
+                os.remove(chemin)
+                supprimes += 1
+    return supprimes
+
+# =========================
+# Exports (CSV / XLSX)
+# =========================
+
+def get_dossier_exports():
+    """Dossier des fichiers d'export, à côté du fichier de base"""
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), EXPORTS_DIR)
+
+def _ecrire_export_csv(entetes, lots, chemin):
+    with open(chemin, "w", newline="", encoding="utf-8-sig") as f:
+        ecrivain = csv.writer(f)
+        ecrivain.writerow(entetes)
+        for lot in lots:
+            ecrivain.writerows(lot)
+
+def _ecrire_export_xlsx(entetes, lots, chemin):
+    # Classeur en écriture seule : les lignes partent sur disque au fil de l'eau
+    classeur = openpyxl.Workbook(write_only=True)
+    feuille = classeur.create_sheet("Export")
+    feuille.append(entetes)
+    for lot in lots:
+        for ligne in lot:
+            feuille.append(tuple(ligne))
+    classeur.save(chemin)
+
+FORMATS_EXPORT = {
+    'csv': ("text/csv", _ecrire_export_csv),
+    'xlsx': ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", _ecrire_export_xlsx),
+}
+
+def formats_export_disponibles():
+    return [f for f in FORMATS_EXPORT if f != 'xlsx' or openpyxl is not None]
+
+def _lots_curseur(cur):
+    while True:
+        lot = cur.fetchmany(EXPORT_TAILLE_LOT)
+        if not lot:
+            break
+        yield lot
+
+def _tranches_export(date_debut, date_fin, mois_archives):
+    """Découpe la période, du plus récent au plus ancien, en tranches (début, fin, mois archivé)"""
+    tranches = []
+    fin = date_fin
+    for mois in sorted(mois_archives, reverse=True):
+        debut_mois, fin_mois = _bornes_mois(*(int(partie) for partie in mois.split('-')))
+        if fin_mois < fin:
+            tranches.append((fin_mois + timedelta(days=1), fin, False))
+        tranches.append((max(debut_mois, date_debut), min(fin_mois, fin), True))
+        fin = debut_mois - timedelta(days=1)
+    if date_debut <= fin:
+        tranches.append((date_debut, fin, False))
+    return tranches
+
+def _lots_export(conn, nom, sql, params):
+    """Lots de lignes d'un export. Les tranches non archivées sont lues par lots depuis le curseur;
+    un mois archivé est relu dans sa partition et fusionné aux lignes restées en base pour ce mois."""
+    spec = ARCHIVES_EXPORT.get(nom)
+    mois_archives = get_mois_archives(params[0], params[1]) if spec and pyarrow is not None else []
+    if not mois_archives:
+        yield from _lots_curseur(conn.execute(sql, params))
+        return
+    table, colonnes, tri, croissant = spec
+    for debut, fin, archive in _tranches_export(params[0], params[1], mois_archives):
+        cur = conn.execute(sql, (debut, fin) + tuple(params[2:]))
+        if not archive:
+            yield from _lots_curseur(cur)
+            continue
+        entetes = [colonne[0] for colonne in cur.description]
+        df = pd.DataFrame([tuple(ligne) for ligne in cur.fetchall()], columns=entetes)
+        archives = lire_archives(table, debut, fin)
+        if not archives.empty:
+            archives = preparer_archives(table, archives)[colonnes or entetes].set_axis(entetes, axis=1)
+            df = pd.concat([df, archives], ignore_index=True).sort_values(tri, ascending=croissant, ignore_index=True)
+        df = df.astype(object).where(df.notna(), None)
+        for i in range(0, len(df), EXPORT_TAILLE_LOT):
+            yield list(df.iloc[i:i + EXPORT_TAILLE_LOT].itertuples(index=False, name=None))
+
+def generer_export(nom, sql, params=(), format_export='csv'):
+    """Écrit le résultat d'une requête dans un fichier d'export, lu par lots depuis le curseur.
+
+    Pour les exports de ARCHIVES_EXPORT, la période (deux premiers paramètres) couvre
+    aussi les mois archivés, relus un à un dans leurs partitions Parquet.
+    Le fichier est nommé d'après (requête, paramètres, version des données) :
+    tant que les données ne changent pas, un nouvel export le réutilise.
+    Retourne le chemin du fichier, None en cas d'erreur.
+    """
+    version = get_version_donnees()
+    if version is None:
+        return None
+    cle = hashlib.sha256(
+        json.dumps([sql, [str(p) for p in params], version, format_export]).encode()
+    ).hexdigest()
+    chemin = os.path.join(get_dossier_exports(), f"{nom}_{cle[:16]}.{format_export}")
+    if os.path.exists(chemin):
+        return chemin
+
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+        temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # En-têtes sans lire de ligne (LIMIT 0)
+        entetes = [colonne[0] for colonne in conn.execute(f"SELECT * FROM ({sql}) LIMIT 0", params).description]
+        FORMATS_EXPORT[format_export][1](entetes, _lots_export(conn, nom, sql, params), temporaire)
+        os.replace(temporaire, chemin)
+        return chemin
     except Exception as e:
-        st.error(f"Erreur création table users: {e}")
-        return False
+        st.error(f"Erreur export {nom}: {e}")
+        return None
     finally:
         if conn:
             conn.close()
 
+def purger_exports(age_heures=24):
+    """Supprime les fichiers d'export plus anciens que age_heures; retourne le nombre supprimé"""
+    dossier = get_dossier_exports()
+    if not os.path.isdir(dossier):
+        return 0
+    limite = time.time() - age_heures * 3600
+    supprimes = 0
+    for nom in os.listdir(dossier):
+        chemin = os.path.join(dossier, nom)
+        if os.path.getmtime(chemin) < limite:
+            os.remove(chemin)
+            supprimes += 1
+    return supprimes
+
+# =========================
+# Authentification & Utilisateurs
+# =========================
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
 def authenticate_user(username, password):
     conn = get_connection()
     if conn is None:
@@ -157,268 +661,851 @@ def create_user(username, password, role, email):
             conn.close()
 
 # =========================
-# Mise à jour du schéma de la base de données
+# Index et audit des plans de requête
 # =========================
 
-def update_database_schema():
-    """Met à jour le schéma de la base de données avec les nouvelles colonnes et tables"""
-    conn = get_connection()
-    if conn is None:
-        return False
-    
+# Index conçus à partir des filtres des requêtes enregistrées ci-dessous
+INDEX_PACK = (
+    # Plages de dates (historique, stats) et "a pointé aujourd'hui" (couvrant)
+    "CREATE INDEX IF NOT EXISTS idx_pointages_date ON pointages(date_pointage, personnel_id, heure_arrivee)",
+    "CREATE INDEX IF NOT EXISTS idx_retards_date ON retards(date_retard)",
+    "CREATE INDEX IF NOT EXISTS idx_retards_personnel_date ON retards(personnel_id, date_retard)",
+    "CREATE INDEX IF NOT EXISTS idx_absences_date ON absences(date_absence)",
+    "CREATE INDEX IF NOT EXISTS idx_absences_justifie_date ON absences(justifie, date_absence)",
+    # Congés approuvés couvrant une date (sous-requêtes NOT IN)
+    "CREATE INDEX IF NOT EXISTS idx_conges_statut_dates ON conges(statut, date_debut, date_fin, personnel_id)",
+    "CREATE INDEX IF NOT EXISTS idx_conges_personnel ON conges(personnel_id, statut)",
+    "CREATE INDEX IF NOT EXISTS idx_personnels_actif_poste_service ON personnels(actif, poste, service)",
+)
+
+# Requêtes fréquentes soumises à l'audit EXPLAIN QUERY PLAN
+REQUETES_AUDITEES = {}
+
+def enregistrer_requete(nom, sql):
+    """Enregistre une requête pour l'audit des plans et la retourne telle quelle"""
+    REQUETES_AUDITEES[nom] = sql
+    return sql
+
+def auditer_plans_requetes():
+    """Exécute EXPLAIN QUERY PLAN sur chaque requête enregistrée et signale les parcours complets"""
+    conn = None
     try:
-        with conn:
-            cur = conn.cursor()
-            
-            # Vérifier si la colonne service existe dans tours_role_nuit
-            cur.execute("PRAGMA table_info(tours_role_nuit)")
-            columns = [col[1] for col in cur.fetchall()]
-            if 'service' not in columns:
-                cur.execute("ALTER TABLE tours_role_nuit ADD COLUMN service VARCHAR(100) NOT NULL DEFAULT 'General'")
-                st.info("✅ Colonne service ajoutée à la table tours_role_nuit")
-                
-                # Supprimer et recréer la contrainte UNIQUE pour SQLite
-                cur.execute("DROP INDEX IF EXISTS tours_role_nuit_date_tour_service_key")
-                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS tours_role_nuit_date_tour_service_key ON tours_role_nuit(date_tour, service)")
-            
-            # Vérifier si la colonne jours_travail existe dans personnels
-            cur.execute("PRAGMA table_info(personnels)")
-            columns_personnel = [col[1] for col in cur.fetchall()]
-            if 'jours_travail' not in columns_personnel:
-                cur.execute("ALTER TABLE personnels ADD COLUMN jours_travail VARCHAR(100) DEFAULT ''")
-                st.info("✅ Colonne jours_travail ajoutée à la table personnels")
-            
-            # Vérifier si le poste 'Mixte' est dans les contraintes CHECK
-            # Pour SQLite, il faut recréer la table pour modifier la contrainte CHECK
-            cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='personnels'")
-            table_sql = cur.fetchone()[0]
-            if "CHECK (poste IN ('Jour', 'Nuit'))" in table_sql:
-                # Sauvegarder les données
-                cur.execute("""
-                    CREATE TEMPORARY TABLE temp_personnels AS 
-                    SELECT * FROM personnels
-                """)
-                
-                # Supprimer l'ancienne table
-                cur.execute("DROP TABLE personnels")
-                
-                # Recréer la table avec la nouvelle contrainte
-                cur.execute("""
-                    CREATE TABLE personnels (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        nom VARCHAR(100) NOT NULL,
-                        prenom VARCHAR(100) NOT NULL,
-                        service VARCHAR(100) NOT NULL,
-                        poste VARCHAR(50) NOT NULL CHECK (poste IN ('Jour', 'Nuit', 'Mixte')),
-                        heure_entree_prevue TIME NOT NULL,
-                        heure_sortie_prevue TIME NOT NULL,
-                        groupe_nuit VARCHAR(1) DEFAULT 'A' CHECK (groupe_nuit IN ('A', 'B')),
-                        jours_travail VARCHAR(100) DEFAULT '',
-                        actif BOOLEAN DEFAULT TRUE,
-                        date_creation TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Restaurer les données
-                cur.execute("""
-                    INSERT INTO personnels 
-                    (id, nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit, actif, date_creation)
-                    SELECT id, nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit, actif, date_creation
-                    FROM temp_personnels
-                """)
-                
-                # Supprimer la table temporaire
-                cur.execute("DROP TABLE temp_personnels")
-                st.info("✅ Contrainte CHECK mise à jour pour inclure 'Mixte'")
-                
-        return True
+        # Connexion dédiée : EXPLAIN ne revalide pas le schéma que les connexions
+        # du pool ont en cache, un index créé depuis n'apparaîtrait pas
+        conn = sqlite3.connect(DB_PATH)
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        lignes = []
+        param = date.today().isoformat()
+        for nom, sql in REQUETES_AUDITEES.items():
+            # Alias -> table réelle, pour ignorer les parcours de CTE et de sous-requêtes
+            alias = {t: t for t in tables}
+            for table, nom_alias in re.findall(r"(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)", sql, re.IGNORECASE):
+                if table in tables:
+                    alias[nom_alias] = table
+            cur = conn.execute("EXPLAIN QUERY PLAN " + sql, (param,) * sql.count("?"))
+            for row in cur.fetchall():
+                detail = row[3]
+                # "SCAN t" (ou "SCAN t USING INDEX") parcourt toute la table ou tout l'index
+                table = alias.get(detail.split()[1]) if detail.startswith("SCAN ") else None
+                lignes.append({
+                    'requete': nom,
+                    'detail': detail,
+                    'table': table,
+                    'parcours_complet': table is not None,
+                })
+        return pd.DataFrame(lignes, columns=['requete', 'detail', 'table', 'parcours_complet'])
     except Exception as e:
-        st.error(f"Erreur mise à jour du schéma: {e}")
-        return False
+        st.error(f"Erreur audit des plans de requête: {e}")
+        return pd.DataFrame()
     finally:
         if conn:
             conn.close()
 
 # =========================
-# Modèle de données
+# Modèle de données (migrations versionnées)
 # =========================
 
-def create_tables():
-    conn = get_connection()
-    if conn is None:
-        return False
+def _migration_schema_initial(cur):
+    """Migration 1 : tables de base, administrateur par défaut et données d'exemple"""
+    # Table personnels - MODIFIÉE pour supporter mixte
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS personnels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nom VARCHAR(100) NOT NULL,
+            prenom VARCHAR(100) NOT NULL,
+            service VARCHAR(100) NOT NULL,
+            poste VARCHAR(50) NOT NULL CHECK (poste IN ('Jour', 'Nuit', 'Mixte')),
+            heure_entree_prevue TIME NOT NULL,
+            heure_sortie_prevue TIME NOT NULL,
+            groupe_nuit VARCHAR(1) DEFAULT 'A' CHECK (groupe_nuit IN ('A', 'B')),
+            jours_travail VARCHAR(100) DEFAULT '',
+            actif BOOLEAN DEFAULT TRUE,
+            date_creation TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
 
-    try:
-        with conn:
-            cur = conn.cursor()
-            # Table personnels - MODIFIÉE pour supporter mixte
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS personnels (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    nom VARCHAR(100) NOT NULL,
-                    prenom VARCHAR(100) NOT NULL,
-                    service VARCHAR(100) NOT NULL,
-                    poste VARCHAR(50) NOT NULL CHECK (poste IN ('Jour', 'Nuit', 'Mixte')),
-                    heure_entree_prevue TIME NOT NULL,
-                    heure_sortie_prevue TIME NOT NULL,
-                    groupe_nuit VARCHAR(1) DEFAULT 'A' CHECK (groupe_nuit IN ('A', 'B')),
-                    jours_travail VARCHAR(100) DEFAULT '',
-                    actif BOOLEAN DEFAULT TRUE,
-                    date_creation TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
+    # Table tours de rôle pour le personnel de nuit
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tours_role_nuit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date_tour DATE NOT NULL,
+            service VARCHAR(100) NOT NULL,
+            groupe_actif VARCHAR(20) NOT NULL CHECK (groupe_actif IN ('A', 'B')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(date_tour, service)
+        )
+        """
+    )
 
-            # Table tours de rôle pour le personnel de nuit
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS tours_role_nuit (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    date_tour DATE NOT NULL,
-                    service VARCHAR(100) NOT NULL,
-                    groupe_actif VARCHAR(20) NOT NULL CHECK (groupe_actif IN ('A', 'B')),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(date_tour, service)
-                )
-                """
-            )
+    # Table groupes par service
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS groupes_nuit_par_service (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            service VARCHAR(100) NOT NULL UNIQUE,
+            groupe_actif VARCHAR(20) NOT NULL DEFAULT 'A' CHECK (groupe_actif IN ('A', 'B')),
+            derniere_maj TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
 
-            # Table groupes par service
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS groupes_nuit_par_service (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    service VARCHAR(100) NOT NULL UNIQUE,
-                    groupe_actif VARCHAR(20) NOT NULL DEFAULT 'A' CHECK (groupe_actif IN ('A', 'B')),
-                    derniere_maj TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
+    # Table congés
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
+            date_debut DATE NOT NULL,
+            date_fin DATE NOT NULL,
+            type_conge VARCHAR(50) NOT NULL,
+            motif TEXT,
+            statut VARCHAR(20) DEFAULT 'En attente' CHECK (statut IN ('En attente', 'Approuvé', 'Rejeté')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
 
-            # Table congés
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS conges (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
-                    date_debut DATE NOT NULL,
-                    date_fin DATE NOT NULL,
-                    type_conge VARCHAR(50) NOT NULL,
-                    motif TEXT,
-                    statut VARCHAR(20) DEFAULT 'En attente' CHECK (statut IN ('En attente', 'Approuvé', 'Rejeté')),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
+    # Table: Quotas de congés par employé
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS quotas_conges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnel_id INTEGER UNIQUE REFERENCES personnels(id) ON DELETE CASCADE,
+            jours_alloues INTEGER DEFAULT 21,
+            jours_pris INTEGER DEFAULT 0,
+            jours_restants INTEGER DEFAULT 21,
+            annee INTEGER DEFAULT (strftime('%Y', CURRENT_DATE)),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
 
-            # Table: Quotas de congés par employé
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS quotas_conges (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    personnel_id INTEGER UNIQUE REFERENCES personnels(id) ON DELETE CASCADE,
-                    jours_alloues INTEGER DEFAULT 21,
-                    jours_pris INTEGER DEFAULT 0,
-                    jours_restants INTEGER DEFAULT 21,
-                    annee INTEGER DEFAULT (strftime('%Y', CURRENT_DATE)),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
+    # Table pointages
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pointages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
+            date_pointage DATE NOT NULL,
+            heure_arrivee TIME,
+            heure_depart TIME,
+            statut_arrivee VARCHAR(50) DEFAULT 'Present',
+            statut_depart VARCHAR(50) DEFAULT 'Present',
+            retard_minutes INTEGER DEFAULT 0,
+            depart_avance_minutes INTEGER DEFAULT 0,
+            motif_retard TEXT,
+            motif_depart_avance TEXT,
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(personnel_id, date_pointage)
+        )
+        """
+    )
 
-            # Table pointages
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS pointages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
-                    date_pointage DATE NOT NULL,
-                    heure_arrivee TIME,
-                    heure_depart TIME,
-                    statut_arrivee VARCHAR(50) DEFAULT 'Present',
-                    statut_depart VARCHAR(50) DEFAULT 'Present',
-                    retard_minutes INTEGER DEFAULT 0,
-                    depart_avance_minutes INTEGER DEFAULT 0,
-                    motif_retard TEXT,
-                    motif_depart_avance TEXT,
-                    notes TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(personnel_id, date_pointage)
-                )
-                """
-            )
+    # Table retards
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS retards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
+            date_retard DATE NOT NULL,
+            retard_minutes INTEGER NOT NULL,
+            motif TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
 
-            # Table retards
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS retards (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
-                    date_retard DATE NOT NULL,
-                    retard_minutes INTEGER NOT NULL,
-                    motif TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
+    # Table absences
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS absences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
+            date_absence DATE NOT NULL,
+            motif TEXT,
+            justifie BOOLEAN DEFAULT FALSE,
+            certificat_justificatif BLOB,
+            type_certificat VARCHAR(10),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(personnel_id, date_absence)
+        )
+        """
+    )
 
-            # Table absences
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS absences (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    personnel_id INTEGER REFERENCES personnels(id) ON DELETE CASCADE,
-                    date_absence DATE NOT NULL,
-                    motif TEXT,
-                    justifie BOOLEAN DEFAULT FALSE,
-                    certificat_justificatif BLOB,
-                    type_certificat VARCHAR(10),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(personnel_id, date_absence)
-                )
-                """
+    # Table users
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            role VARCHAR(20) DEFAULT 'user',
+            email VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+    # Créer un admin par défaut si absent
+    cur.execute("SELECT COUNT(*) FROM users WHERE username = ?", (DEFAULT_ADMIN_USER,))
+    if cur.fetchone()[0] == 0:
+        cur.execute(
+            "INSERT INTO users (username, password_hash, role, email) VALUES (?, ?, ?, ?)",
+            (
+                DEFAULT_ADMIN_USER,
+                sha256(DEFAULT_ADMIN_PASS),
+                "admin",
+                f"{DEFAULT_ADMIN_USER}@example.com",
+            ),
+        )
+
+    # Données d'exemple s'il n'y a personne
+    cur.execute("SELECT COUNT(*) FROM personnels")
+    if cur.fetchone()[0] == 0:
+        cur.execute(
+            """
+            INSERT INTO personnels (nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit) VALUES
+            ('Dupont', 'Jean', 'Reception', 'Jour', '08:00:00', '16:00:00', 'A'),
+            ('Martin', 'Marie', 'Radiologie', 'Nuit', '20:00:00', '04:00:00', 'A'),
+            ('Bernard', 'Pierre', 'Urgence', 'Jour', '07:30:00', '15:30:00', 'A'),
+            ('Dubois', 'Sophie', 'Maternité', 'Nuit', '21:00:00', '05:00:00', 'B'),
+            ('Moreau', 'Luc', 'Administration', 'Jour', '09:00:00', '17:00:00', 'A'),
+            ('Leroy', 'Julie', 'Chirurgie', 'Mixte', '08:00:00', '16:00:00', 'A')
+            """
+        )
+
+        # Initialiser les quotas de congés pour les employés exemple
+        cur.execute("INSERT INTO quotas_conges (personnel_id) SELECT id FROM personnels")
+
+def _migration_colonnes_nuit_mixte(cur):
+    """Migration 2 : service des tours de rôle, jours de travail et poste Mixte (anciennes bases)"""
+    # Vérifier si la colonne service existe dans tours_role_nuit
+    cur.execute("PRAGMA table_info(tours_role_nuit)")
+    columns = [col[1] for col in cur.fetchall()]
+    if 'service' not in columns:
+        cur.execute("ALTER TABLE tours_role_nuit ADD COLUMN service VARCHAR(100) NOT NULL DEFAULT 'General'")
+
+        # Supprimer et recréer la contrainte UNIQUE pour SQLite
+        cur.execute("DROP INDEX IF EXISTS tours_role_nuit_date_tour_service_key")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS tours_role_nuit_date_tour_service_key ON tours_role_nuit(date_tour, service)")
+
+    # Vérifier si la colonne jours_travail existe dans personnels
+    cur.execute("PRAGMA table_info(personnels)")
+    columns_personnel = [col[1] for col in cur.fetchall()]
+    if 'jours_travail' not in columns_personnel:
+        cur.execute("ALTER TABLE personnels ADD COLUMN jours_travail VARCHAR(100) DEFAULT ''")
+
+    # Vérifier si le poste 'Mixte' est dans les contraintes CHECK
+    # Pour SQLite, il faut recréer la table pour modifier la contrainte CHECK
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='personnels'")
+    table_sql = cur.fetchone()[0]
+    if "CHECK (poste IN ('Jour', 'Nuit'))" in table_sql:
+        # Sauvegarder les données
+        cur.execute("""
+            CREATE TEMPORARY TABLE temp_personnels AS
+            SELECT * FROM personnels
+        """)
+
+        # Supprimer l'ancienne table
+        cur.execute("DROP TABLE personnels")
+
+        # Recréer la table avec la nouvelle contrainte
+        cur.execute("""
+            CREATE TABLE personnels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nom VARCHAR(100) NOT NULL,
+                prenom VARCHAR(100) NOT NULL,
+                service VARCHAR(100) NOT NULL,
+                poste VARCHAR(50) NOT NULL CHECK (poste IN ('Jour', 'Nuit', 'Mixte')),
+                heure_entree_prevue TIME NOT NULL,
+                heure_sortie_prevue TIME NOT NULL,
+                groupe_nuit VARCHAR(1) DEFAULT 'A' CHECK (groupe_nuit IN ('A', 'B')),
+                jours_travail VARCHAR(100) DEFAULT '',
+                actif BOOLEAN DEFAULT TRUE,
+                date_creation TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
+        """)
 
-            # Données d'exemple s'il n'y a personne
-            cur.execute("SELECT COUNT(*) FROM personnels")
-            if cur.fetchone()[0] == 0:
-                cur.execute(
-                    """
-                    INSERT INTO personnels (nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit) VALUES
-                    ('Dupont', 'Jean', 'Reception', 'Jour', '08:00:00', '16:00:00', 'A'),
-                    ('Martin', 'Marie', 'Radiologie', 'Nuit', '20:00:00', '04:00:00', 'A'),
-                    ('Bernard', 'Pierre', 'Urgence', 'Jour', '07:30:00', '15:30:00', 'A'),
-                    ('Dubois', 'Sophie', 'Maternité', 'Nuit', '21:00:00', '05:00:00', 'B'),
-                    ('Moreau', 'Luc', 'Administration', 'Jour', '09:00:00', '17:00:00', 'A'),
-                    ('Leroy', 'Julie', 'Chirurgie', 'Mixte', '08:00:00', '16:00:00', 'A')
-                    """
-                )
-                
-                # Initialiser les quotas de congés pour les employés exemple
-                cur.execute("SELECT id FROM personnels")
-                employes = cur.fetchall()
-                for emp_id in employes:
-                    cur.execute(
-                        "INSERT INTO quotas_conges (personnel_id) VALUES (?)",
-                        (emp_id[0],)
-                    )
-        
-        # Crée la table users et l'admin par défaut
-        ok = create_users_table()
-        
-        # Met à jour le schéma avec les nouvelles colonnes
-        update_database_schema()
-        
+        # Restaurer les données
+        cur.execute("""
+            INSERT INTO personnels
+            (id, nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit, actif, date_creation)
+            SELECT id, nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit, actif, date_creation
+            FROM temp_personnels
+        """)
+
+        # Supprimer la table temporaire
+        cur.execute("DROP TABLE temp_personnels")
+
+def _migration_index_pack(cur):
+    """Migration 3 : index secondaires des requêtes fréquentes"""
+    for ddl in INDEX_PACK:
+        cur.execute(ddl)
+
+def _creer_triggers_version(cur, tables):
+    """Incrémente version_donnees à chaque écriture sur les tables données"""
+    for table in tables:
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_version_{table}_{operation.lower()}
+                AFTER {operation} ON {table}
+                BEGIN
+                    UPDATE version_donnees SET version = version + 1 WHERE id = 1;
+                END
+            """)
+
+def _migration_version_donnees(cur):
+    """Migration 4 : compteur de version des données maintenu par triggers"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS version_donnees (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO version_donnees (id, version) VALUES (1, 0)")
+    # Une table reconstruite par une migration ultérieure perd ses triggers :
+    # les recréer dans cette même migration
+    _creer_triggers_version(cur, (
+        "personnels", "pointages", "retards", "absences", "conges",
+        "tours_role_nuit", "groupes_nuit_par_service",
+    ))
+
+def _migration_taches_planifiees(cur):
+    """Migration 5 : journal des tâches planifiées (une exécution par tâche et échéance)"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS taches_planifiees (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tache VARCHAR(50) NOT NULL,
+            echeance TIMESTAMP NOT NULL,
+            statut VARCHAR(20) NOT NULL DEFAULT 'En cours',
+            resultat TEXT,
+            debut TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fin TIMESTAMP,
+            UNIQUE(tache, echeance)
+        )
+    """)
+
+def _migration_certificats_fichiers(cur):
+    """Migration 6 : certificats déplacés vers le stockage sur disque (empreinte, taille et mime en base)"""
+    colonnes = {row[1] for row in cur.execute("PRAGMA table_info(absences)").fetchall()}
+    for colonne, type_sql in (
+        ("certificat_sha256", "VARCHAR(64)"),
+        ("certificat_taille", "INTEGER"),
+        ("certificat_mime", "VARCHAR(100)"),
+    ):
+        if colonne not in colonnes:
+            cur.execute(f"ALTER TABLE absences ADD COLUMN {colonne} {type_sql}")
+
+    # Un certificat à la fois en mémoire
+    ids = [row[0] for row in cur.execute("SELECT id FROM absences WHERE certificat_justificatif IS NOT NULL").fetchall()]
+    for absence_id in ids:
+        donnees, type_certificat = cur.execute(
+            "SELECT certificat_justificatif, type_certificat FROM absences WHERE id = ?", (absence_id,)
+        ).fetchone()
+        empreinte, taille = stocker_certificat(bytes(donnees))
+        cur.execute(
+            """
+            UPDATE absences
+            SET certificat_sha256 = ?, certificat_taille = ?, certificat_mime = ?,
+                certificat_justificatif = NULL, type_certificat = NULL
+            WHERE id = ?
+            """,
+            (empreinte, taille, MIME_CERTIFICATS.get(type_certificat, "application/octet-stream"), absence_id)
+        )
+
+def _migration_archives_mensuelles(cur):
+    """Migration 7 : registre des mois archivés en Parquet"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS archives_mensuelles (
+            mois VARCHAR(7) PRIMARY KEY,
+            nb_pointages INTEGER NOT NULL DEFAULT 0,
+            nb_retards INTEGER NOT NULL DEFAULT 0,
+            nb_absences INTEGER NOT NULL DEFAULT 0,
+            archive_le TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+# Contribution d'une ligne de pointage / d'absence au cumul mensuel (ligne = NEW
+# ou OLD, signe = '' ou '-'). Les suppressions dans un mois archivé ne sont pas
+# décomptées : ce sont les lignes déplacées vers l'archive.
+def _delta_stats_pointage(ligne, signe):
+    return f"""
+        INSERT INTO stats_mensuelles_employes
+            (mois, personnel_id, jours_presents, jours_retard, jours_depart_anticipe,
+             total_retard_minutes, total_depart_avance_minutes)
+        VALUES (
+            substr({ligne}.date_pointage, 1, 7), {ligne}.personnel_id, {signe}1,
+            {signe}IFNULL({ligne}.statut_arrivee = 'En retard', 0),
+            {signe}IFNULL({ligne}.statut_depart = 'Départ anticipé', 0),
+            {signe}MAX(IFNULL({ligne}.retard_minutes, 0), 0),
+            {signe}IFNULL({ligne}.depart_avance_minutes, 0)
+        )
+        ON CONFLICT (mois, personnel_id) DO UPDATE SET
+            jours_presents = jours_presents + excluded.jours_presents,
+            jours_retard = jours_retard + excluded.jours_retard,
+            jours_depart_anticipe = jours_depart_anticipe + excluded.jours_depart_anticipe,
+            total_retard_minutes = total_retard_minutes + excluded.total_retard_minutes,
+            total_depart_avance_minutes = total_depart_avance_minutes + excluded.total_depart_avance_minutes;
+    """
+
+def _delta_stats_absence(ligne, signe):
+    return f"""
+        INSERT INTO stats_mensuelles_employes (mois, personnel_id, absences)
+        VALUES (substr({ligne}.date_absence, 1, 7), {ligne}.personnel_id, {signe}1)
+        ON CONFLICT (mois, personnel_id) DO UPDATE SET absences = absences + excluded.absences;
+    """
+
+def _creer_triggers_stats_mensuelles(cur):
+    """Maintient stats_mensuelles_employes à chaque écriture de pointage ou d'absence"""
+    for table, colonne_date, delta, colonnes in (
+        ("pointages", "date_pointage", _delta_stats_pointage,
+         "personnel_id, date_pointage, statut_arrivee, statut_depart, retard_minutes, depart_avance_minutes"),
+        ("absences", "date_absence", _delta_stats_absence, "personnel_id, date_absence"),
+    ):
+        hors_archive = f"NOT EXISTS (SELECT 1 FROM archives_mensuelles WHERE mois = substr(OLD.{colonne_date}, 1, 7))"
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_insert
+            AFTER INSERT ON {table} WHEN NEW.personnel_id IS NOT NULL
+            BEGIN {delta("NEW", "")} END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_delete
+            AFTER DELETE ON {table} WHEN OLD.personnel_id IS NOT NULL AND {hors_archive}
+            BEGIN {delta("OLD", "-")} END
+        """)
+        # Une correction retire l'ancienne contribution et ajoute la nouvelle
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_update_old
+            AFTER UPDATE OF {colonnes} ON {table} WHEN OLD.personnel_id IS NOT NULL
+            BEGIN {delta("OLD", "-")} END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_update_new
+            AFTER UPDATE OF {colonnes} ON {table} WHEN NEW.personnel_id IS NOT NULL
+            BEGIN {delta("NEW", "")} END
+        """)
+
+def _migration_stats_mensuelles(cur):
+    """Migration 8 : cumul mensuel par employé, tenu à jour par triggers"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_mensuelles_employes (
+            mois VARCHAR(7) NOT NULL,
+            personnel_id INTEGER NOT NULL,
+            jours_presents INTEGER NOT NULL DEFAULT 0,
+            jours_retard INTEGER NOT NULL DEFAULT 0,
+            jours_depart_anticipe INTEGER NOT NULL DEFAULT 0,
+            total_retard_minutes INTEGER NOT NULL DEFAULT 0,
+            total_depart_avance_minutes INTEGER NOT NULL DEFAULT 0,
+            absences INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (mois, personnel_id)
+        ) WITHOUT ROWID
+    """)
+    _creer_triggers_stats_mensuelles(cur)
+    # Amorçage depuis la base (les mois déjà archivés : voir reconstruire_stats_mensuelles)
+    cur.execute(SQL_CUMUL_POINTAGES, ('0000-01-01', '9999-12-31'))
+    cur.execute(SQL_CUMUL_ABSENCES, ('0000-01-01', '9999-12-31'))
+
+def _migration_fts_personnel(cur):
+    """Migration 9 : index plein texte des noms, prénoms et services (sans accents, par préfixe)"""
+    try:
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS personnels_fts USING fts5(
+                nom, prenom, service,
+                content='personnels', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite compilé sans FTS5 : la recherche garde ses filtres LIKE
+        print(f"DEBUG: Index plein texte non créé - {e}")
+        return
+
+    # Synchronisation de la table de contenu externe (voir la documentation FTS5)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_personnels_insert AFTER INSERT ON personnels
+        BEGIN
+            INSERT INTO personnels_fts (rowid, nom, prenom, service) VALUES (NEW.id, NEW.nom, NEW.prenom, NEW.service);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_personnels_delete AFTER DELETE ON personnels
+        BEGIN
+            INSERT INTO personnels_fts (personnels_fts, rowid, nom, prenom, service)
+            VALUES ('delete', OLD.id, OLD.nom, OLD.prenom, OLD.service);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_personnels_update AFTER UPDATE OF nom, prenom, service ON personnels
+        BEGIN
+            INSERT INTO personnels_fts (personnels_fts, rowid, nom, prenom, service)
+            VALUES ('delete', OLD.id, OLD.nom, OLD.prenom, OLD.service);
+            INSERT INTO personnels_fts (rowid, nom, prenom, service) VALUES (NEW.id, NEW.nom, NEW.prenom, NEW.service);
+        END
+    """)
+    cur.execute("INSERT INTO personnels_fts (personnels_fts) VALUES ('rebuild')")
+
+def _migration_regles_pointage(cur):
+    """Migration 10 : règles de pointage par service/poste avec date d'effet"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS regles_pointage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            service VARCHAR(100),
+            poste VARCHAR(20),
+            date_effet DATE NOT NULL,
+            debut_plage_minutes INTEGER NOT NULL,
+            fin_plage_minutes INTEGER NOT NULL,
+            seuil_absence_minutes INTEGER,
+            avance_comptee BOOLEAN NOT NULL DEFAULT TRUE,
+            tolerance_depart_minutes INTEGER NOT NULL DEFAULT 5,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            CHECK (debut_plage_minutes <= fin_plage_minutes)
+        )
+    """)
+    # Service ou poste NULL : la règle vaut pour tous
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_regles_pointage_cle
+        ON regles_pointage(COALESCE(service, ''), COALESCE(poste, ''), date_effet)
+    """)
+    # Compteur propre aux règles : le cache du résolveur ne dépend pas des pointages
+    cur.execute("ALTER TABLE version_donnees ADD COLUMN version_regles INTEGER NOT NULL DEFAULT 0")
+    for operation in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_version_regles_pointage_{operation.lower()}
+            AFTER {operation} ON regles_pointage
+            BEGIN
+                UPDATE version_donnees SET version = version + 1, version_regles = version_regles + 1 WHERE id = 1;
+            END
+        """)
+    # Règles jusqu'ici codées en dur : jour pour tous, nuit pour le poste Nuit
+    cur.executemany(
+        """
+        INSERT OR IGNORE INTO regles_pointage
+            (service, poste, date_effet, debut_plage_minutes, fin_plage_minutes,
+             seuil_absence_minutes, avance_comptee, tolerance_depart_minutes)
+        VALUES (?, ?, '2000-01-01', ?, ?, ?, ?, ?)
+        """,
+        [
+            (None, None, -15, -5, 30, True, 5),
+            (None, 'Nuit', -30, 60, None, False, 5),
+        ]
+    )
+
+# Jours de la semaine tels qu'enregistrés dans personnels.jours_travail, indexés par strftime('%w')
+JOURS_SEMAINE_SQL = " ".join(
+    f"WHEN '{numero}' THEN '{jour}'"
+    for numero, jour in enumerate(("Dimanche", "Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi", "Samedi"))
+)
+
+def _sql_regenerer_shifts(filtre):
+    """Corps de trigger : recalcule les shifts du calendrier satisfaisant filtre (sur personnel_id, date_shift)"""
+    return f"""
+        DELETE FROM shifts_prevus
+        WHERE {filtre} AND date_shift IN (SELECT date_shift FROM calendrier_shifts);
+        INSERT OR REPLACE INTO shifts_prevus (personnel_id, date_shift, debut, fin, type_shift)
+        SELECT personnel_id, date_shift, debut, fin, type_shift FROM shifts_prevus_calcules
+        WHERE {filtre};
+    """
+
+def _migration_shifts_prevus(cur):
+    """Migration 11 : shifts prévus par employé et par jour, matérialisés sur le calendrier à venir"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS calendrier_shifts (
+            date_shift DATE PRIMARY KEY
+        ) WITHOUT ROWID
+    """)
+    # type_shift : 'Jour', 'Nuit' (nuitiers du groupe actif, mixtes leurs jours de nuit)
+    # ou 'Congé' (attendu mais en congé approuvé) ; fin le lendemain si le shift passe minuit
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS shifts_prevus (
+            personnel_id INTEGER NOT NULL REFERENCES personnels(id) ON DELETE CASCADE,
+            date_shift DATE NOT NULL,
+            debut TIMESTAMP NOT NULL,
+            fin TIMESTAMP NOT NULL,
+            type_shift VARCHAR(10) NOT NULL CHECK (type_shift IN ('Jour', 'Nuit', 'Congé')),
+            PRIMARY KEY (personnel_id, date_shift)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_shifts_prevus_date ON shifts_prevus(date_shift, type_shift)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_shifts_prevus_debut ON shifts_prevus(personnel_id, debut)")
+
+    # Même périmètre que active_roster (CTE_ACTIVE_ROSTER), pour chaque date du calendrier
+    cur.execute(f"""
+        CREATE VIEW IF NOT EXISTS shifts_prevus_calcules AS
+        SELECT p.id AS personnel_id, c.date_shift,
+               c.date_shift || ' ' || COALESCE(time(p.heure_entree_prevue), '08:00:00') AS debut,
+               CASE
+                   WHEN COALESCE(time(p.heure_sortie_prevue), '08:00:00') > COALESCE(time(p.heure_entree_prevue), '08:00:00')
+                   THEN c.date_shift
+                   ELSE date(c.date_shift, '+1 day')
+               END || ' ' || COALESCE(time(p.heure_sortie_prevue), '08:00:00') AS fin,
+               CASE
+                   WHEN EXISTS (
+                       SELECT 1 FROM conges cg
+                       WHERE cg.personnel_id = p.id AND cg.statut = 'Approuvé'
+                       AND cg.date_debut <= c.date_shift AND cg.date_fin >= c.date_shift
+                   ) THEN 'Congé'
+                   WHEN p.poste = 'Nuit' THEN 'Nuit'
+                   WHEN p.poste = 'Mixte' AND instr(
+                       ',' || COALESCE(p.jours_travail, '') || ',',
+                       ',' || CASE strftime('%w', c.date_shift) {JOURS_SEMAINE_SQL} END || ','
+                   ) > 0 THEN 'Nuit'
+                   ELSE 'Jour'
+               END AS type_shift
+        FROM calendrier_shifts c
+        CROSS JOIN personnels p
+        WHERE p.actif = 1
+        AND (
+            p.poste IN ('Jour', 'Mixte')
+            OR (p.poste = 'Nuit' AND p.groupe_nuit = COALESCE(
+                (SELECT t.groupe_actif FROM tours_role_nuit t WHERE t.service = p.service AND t.date_tour = c.date_shift),
+                (SELECT g.groupe_actif FROM groupes_nuit_par_service g WHERE g.service = p.service),
+                'A'
+            ))
+        )
+    """)
+
+    # Régénération incrémentale : seuls les shifts touchés par l'écriture sont recalculés
+    nuitiers_du_service = "personnel_id IN (SELECT id FROM personnels WHERE service = {0}.service AND poste = 'Nuit')"
+    portees = {
+        'personnels': (
+            "personnel_id = {0}.id",
+            "UPDATE OF service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit, jours_travail, actif",
+        ),
+        'conges': (
+            "personnel_id = {0}.personnel_id AND date_shift BETWEEN {0}.date_debut AND {0}.date_fin",
+            "UPDATE",
+        ),
+        'tours_role_nuit': ("date_shift = {0}.date_tour AND " + nuitiers_du_service, "UPDATE"),
+        'groupes_nuit_par_service': (nuitiers_du_service, "UPDATE"),
+    }
+    for table, (filtre, mise_a_jour) in portees.items():
+        for operation, lignes in (("INSERT", ("NEW",)), (mise_a_jour, ("OLD", "NEW")), ("DELETE", ("OLD",))):
+            if table == 'personnels' and operation == "DELETE":
+                corps = "DELETE FROM shifts_prevus WHERE personnel_id = OLD.id;"
+            else:
+                corps = "".join(_sql_regenerer_shifts(filtre.format(ligne)) for ligne in lignes)
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_shifts_{table}_{operation.split()[0].lower()}
+                AFTER {operation} ON {table}
+                BEGIN
+                    {corps}
+                END
+            """)
+
+    _etendre_calendrier_shifts(cur, date.today())
+
+def _migration_punch_events(cur):
+    """Migration 12 : journal des pointages bruts en ajout seul, repris des pointages existants"""
+    # Un événement par badgeage, correction ou annulation ; la ligne pointages
+    # du (personnel_id, date_shift) en est dérivée (voir _deriver_pointages)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS punch_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            personnel_id INTEGER NOT NULL REFERENCES personnels(id) ON DELETE CASCADE,
+            date_shift DATE NOT NULL,
+            horodatage TIMESTAMP NOT NULL,
+            sens VARCHAR(12) NOT NULL CHECK (sens IN ('arrivee', 'depart', 'annulation')),
+            heure TIME,
+            correction INTEGER NOT NULL DEFAULT 0,
+            statut VARCHAR(50),
+            motif TEXT,
+            notes TEXT,
+            est_absent INTEGER NOT NULL DEFAULT 0,
+            source VARCHAR(20) NOT NULL DEFAULT 'pointage',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_punch_events_horodatage ON punch_events(personnel_id, horodatage)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_punch_events_shift ON punch_events(date_shift, personnel_id)")
+    # Ajout seul : une correction est un nouvel événement. La suppression reste
+    # possible pour effacer un employé (ON DELETE CASCADE)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_punch_events_ajout_seul
+        BEFORE UPDATE ON punch_events
+        BEGIN
+            SELECT RAISE(ABORT, 'punch_events est un journal en ajout seul');
+        END
+    """)
+
+    # Reprise : une arrivée et un départ par pointage existant, dans l'ordre des lignes
+    if cur.execute("SELECT 1 FROM punch_events LIMIT 1").fetchone() is None:
+        cur.execute("""
+            INSERT INTO punch_events (personnel_id, date_shift, horodatage, sens, heure, motif, notes, est_absent, source)
+            SELECT personnel_id, date_shift, horodatage, sens, heure, motif, notes, est_absent, 'reprise'
+            FROM (
+                SELECT pt.id, 0 AS ordre, pt.personnel_id, pt.date_pointage AS date_shift,
+                       COALESCE(datetime(pt.date_pointage || ' ' || pt.heure_arrivee), datetime(pt.date_pointage)) AS horodatage,
+                       'arrivee' AS sens, pt.heure_arrivee AS heure, pt.motif_retard AS motif, pt.notes,
+                       pt.statut_arrivee = 'Absent' AS est_absent
+                FROM pointages pt
+                WHERE pt.heure_arrivee IS NOT NULL
+                UNION ALL
+                SELECT pt.id, 1, pt.personnel_id, pt.date_pointage,
+                       COALESCE(datetime(
+                           pt.date_pointage || ' ' || pt.heure_depart,
+                           CASE WHEN time(pt.heure_depart) < time(pt.heure_arrivee) THEN '+1 day' ELSE '+0 day' END
+                       ), datetime(pt.date_pointage)),
+                       'depart', pt.heure_depart, pt.motif_depart_avance,
+                       CASE WHEN pt.heure_arrivee IS NULL THEN pt.notes END, 0
+                FROM pointages pt
+                WHERE pt.heure_depart IS NOT NULL
+            )
+            ORDER BY id, ordre
+        """)
+
+def _migration_cumul_retards(cur):
+    """Migration 13 : cumul des retards sur le statut 'En retard' et les seules minutes positives"""
+    # Les triggers de la migration 8 comptaient un statut 'Retard' jamais écrit et
+    # ajoutaient aux minutes de retard celles, négatives, des arrivées en avance
+    for evenement in ("insert", "delete", "update_old", "update_new"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_stats_pointages_{evenement}")
+    _creer_triggers_stats_mensuelles(cur)
+
+    # Recalcul mois par mois. Sans pyarrow les partitions Parquet ne sont pas
+    # relisibles : les mois archivés restent en l'état (reconstruction depuis la maintenance)
+    mois_archives = {row[0] for row in cur.execute("SELECT mois FROM archives_mensuelles").fetchall()}
+    mois_cumul = {row[0] for row in cur.execute("SELECT DISTINCT mois FROM stats_mensuelles_employes").fetchall()}
+    if pyarrow is None:
+        mois_cumul -= mois_archives
+    else:
+        mois_cumul |= mois_archives
+    for mois in sorted(mois_cumul):
+        annee, numero = (int(partie) for partie in mois.split('-'))
+        date_debut, date_fin = _bornes_mois(annee, numero)
+        cur.execute("DELETE FROM stats_mensuelles_employes WHERE mois = ?", (mois,))
+        cur.execute(SQL_CUMUL_POINTAGES, (date_debut, date_fin))
+        cur.execute(SQL_CUMUL_ABSENCES, (date_debut, date_fin))
+        if mois in mois_archives:
+            cur.executemany(SQL_CUMUL_ARCHIVES, _cumul_archives(date_debut, date_fin))
+
+def _migration_alternance_nuit(cur):
+    """Migration 14 : alternance quotidienne A/B des groupes de nuit, activée service par service"""
+    cur.execute("PRAGMA table_info(groupes_nuit_par_service)")
+    if 'alternance_quotidienne' not in [col[1] for col in cur.fetchall()]:
+        cur.execute("ALTER TABLE groupes_nuit_par_service ADD COLUMN alternance_quotidienne INTEGER NOT NULL DEFAULT 0")
+
+# Migrations numérotées : chacune est appliquée une seule fois par fichier de
+# base, PRAGMA user_version retenant le numéro de la dernière appliquée.
+# Ne jamais modifier une migration publiée, en ajouter une nouvelle.
+MIGRATIONS = (
+    (1, "Schéma initial et administrateur par défaut", _migration_schema_initial),
+    (2, "Colonnes service/jours_travail et poste Mixte", _migration_colonnes_nuit_mixte),
+    (3, "Index des requêtes fréquentes", _migration_index_pack),
+    (4, "Compteur de version des données", _migration_version_donnees),
+    (5, "Journal des tâches planifiées", _migration_taches_planifiees),
+    (6, "Certificats dans le stockage sur disque", _migration_certificats_fichiers),
+    (7, "Registre des archives mensuelles", _migration_archives_mensuelles),
+    (8, "Cumul mensuel des statistiques par employé", _migration_stats_mensuelles),
+    (9, "Index plein texte du personnel", _migration_fts_personnel),
+    (10, "Règles de pointage par service et poste", _migration_regles_pointage),
+    (11, "Shifts prévus matérialisés par employé et par jour", _migration_shifts_prevus),
+    (12, "Journal des pointages bruts en ajout seul", _migration_punch_events),
+    (13, "Cumul mensuel des retards sur le statut 'En retard'", _migration_cumul_retards),
+    (14, "Alternance quotidienne des groupes de nuit par service", _migration_alternance_nuit),
+)
+
+def appliquer_migrations():
+    """Applique, chacune dans sa transaction, les migrations postérieures à PRAGMA user_version"""
+    conn = get_connection()
+    if conn is None:
+        return False
+
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        appliquees = 0
+        for numero, description, migration in MIGRATIONS:
+            if numero <= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Un autre processus a pu appliquer la migration entre-temps
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= numero:
+                    conn.rollback()
+                    continue
+                migration(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {numero}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            appliquees += 1
+            print(f"DEBUG: Migration {numero} appliquée - {description}")
+
+        if appliquees:
+            # Mettre à jour les statistiques du planificateur après les changements de schéma
+            conn.execute("PRAGMA optimize")
         return True
     except Exception as e:
-        st.error(f"Erreur création tables: {e}")
+        st.error(f"Erreur migration du schéma: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+@st.cache_resource(show_spinner=False)
+def _base_initialisee(db_path):
+    """Mémoïse par processus l'initialisation réussie d'un fichier de base"""
+    if not appliquer_migrations():
+        # Une exception n'est pas mise en cache : nouvel essai au prochain rerun
+        raise RuntimeError(f"Initialisation impossible de {db_path}")
+    return True
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _calendrier_shifts_etendu(db_path, jour):
+    """Mémoïse par processus et par jour la prolongation du calendrier des shifts prévus"""
+    if etendre_calendrier_shifts(jour) is None:
+        raise RuntimeError(f"Calendrier des shifts non prolongé dans {db_path}")
+    return True
+
+def initialiser_base_de_donnees():
+    """Vérifie la connexion et migre le schéma une seule fois par processus, puis prolonge les shifts prévus une fois par jour"""
+    try:
+        return _base_initialisee(DB_PATH) and _calendrier_shifts_etendu(DB_PATH, date.today())
+    except RuntimeError:
         return False
+
+def get_version_donnees():
+    """Version courante des données, incrémentée par trigger à chaque écriture (clé d'invalidation des caches)"""
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute("SELECT version FROM version_donnees WHERE id = 1").fetchone()
+        return row['version'] if row else 0
+    except Exception as e:
+        st.error(f"Erreur lecture version des données: {e}")
+        return None
     finally:
         if conn:
             conn.close()
+
 # =========================
 # Fonctions utilitaires
 # =========================
@@ -521,15 +1608,236 @@ def get_services_nuit():
         if conn:
             conn.close()
 
-def filtrer_personnel(recherche, filtre_service, groupe_nuit_actif=None, inclure_tous=False, date_pointage=None):
-    """Filtre le personnel en excluant les employés en congé et les nuitiers qui pointent de jour"""
-    if date_pointage is None:
-        date_pointage = date.today()
-    
+# CTE réutilisable : le premier paramètre ? est la date du roulement.
+# groupes_nuit_actifs donne le groupe A/B actif par service (tour du jour,
+# sinon configuration du service, sinon 'A'); active_roster donne le personnel
+# actif attendu ce jour-là (jour, mixte et nuitiers du groupe actif).
+CTE_ACTIVE_ROSTER = """
+    WITH groupes_nuit_actifs(service, groupe_actif) AS (
+        SELECT s.service, COALESCE(t.groupe_actif, g.groupe_actif, 'A')
+        FROM (SELECT DISTINCT service FROM personnels WHERE actif = 1 AND poste = 'Nuit') s
+        LEFT JOIN tours_role_nuit t ON t.service = s.service AND t.date_tour = ?
+        LEFT JOIN groupes_nuit_par_service g ON g.service = s.service
+    ),
+    active_roster AS (
+        SELECT p.*
+        FROM personnels p
+        LEFT JOIN groupes_nuit_actifs gna ON gna.service = p.service
+        WHERE p.actif = 1
+        AND (p.poste IN ('Jour', 'Mixte') OR (p.poste = 'Nuit' AND p.groupe_nuit = gna.groupe_actif))
+    )
+"""
+
+def get_groupes_nuit_actifs(date_tour=None):
+    """Récupère en une requête le groupe de nuit actif de chaque service de nuit"""
+    if date_tour is None:
+        date_tour = date.today()
+
     conn = get_connection()
     if conn is None:
         return {}
-    
+    try:
+        cur = conn.cursor()
+        cur.execute(CTE_ACTIVE_ROSTER + " SELECT service, groupe_actif FROM groupes_nuit_actifs", (date_tour,))
+        return {row['service']: row['groupe_actif'] for row in cur.fetchall()}
+    except Exception as e:
+        st.error(f"Erreur récupération groupes de nuit actifs: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+# =========================
+# Shifts prévus (calendrier matérialisé)
+# =========================
+# shifts_prevus donne, pour chaque jour du calendrier (aujourd'hui + SHIFTS_HORIZON_JOURS),
+# qui est attendu, de quelle heure à quelle heure et en quel type de shift. Les triggers
+# de la migration 11 le tiennent à jour à chaque écriture sur le personnel, les congés
+# et le roulement de nuit ; les jours passés restent figés.
+
+def _etendre_calendrier_shifts(cur, jour):
+    """Fait glisser le calendrier sur [jour, jour + horizon] et génère les shifts des jours ajoutés"""
+    dates = [str(jour + timedelta(days=decalage)) for decalage in range(SHIFTS_HORIZON_JOURS + 1)]
+    cur.execute("DELETE FROM calendrier_shifts WHERE date_shift < ?", (dates[0],))
+    cur.executemany("INSERT OR IGNORE INTO calendrier_shifts (date_shift) VALUES (?)", [(d,) for d in dates])
+    # Les jours déjà matérialisés sont tenus à jour par les triggers : seuls les manquants sont générés
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO shifts_prevus (personnel_id, date_shift, debut, fin, type_shift)
+        SELECT personnel_id, date_shift, debut, fin, type_shift FROM shifts_prevus_calcules
+        WHERE date_shift BETWEEN ? AND ?
+        """,
+        (dates[0], dates[-1])
+    )
+    return cur.execute("SELECT changes()").fetchone()[0]
+
+def etendre_calendrier_shifts(jour=None):
+    """Prolonge le calendrier des shifts prévus jusqu'à jour + SHIFTS_HORIZON_JOURS.
+
+    Retourne le nombre de shifts générés, None en cas d'erreur.
+    """
+    if jour is None:
+        jour = date.today()
+    try:
+        return executer_ecriture(lambda cur: _etendre_calendrier_shifts(cur, jour))
+    except Exception as e:
+        st.error(f"Erreur prolongation du calendrier des shifts: {e}")
+        return None
+
+def regenerer_shifts_prevus():
+    """Recalcule tous les shifts du calendrier depuis le personnel, les congés et le roulement"""
+    def regenerer(cur):
+        cur.execute("DELETE FROM shifts_prevus WHERE date_shift IN (SELECT date_shift FROM calendrier_shifts)")
+        cur.execute(
+            """
+            INSERT INTO shifts_prevus (personnel_id, date_shift, debut, fin, type_shift)
+            SELECT personnel_id, date_shift, debut, fin, type_shift FROM shifts_prevus_calcules
+            """
+        )
+        return cur.execute("SELECT changes()").fetchone()[0]
+
+    try:
+        return executer_ecriture(regenerer)
+    except Exception as e:
+        st.error(f"Erreur régénération des shifts prévus: {e}")
+        return None
+
+SQL_RESUME_SHIFTS = enregistrer_requete("resume_shifts", """
+    SELECT s.date_shift,
+           SUM(s.type_shift = 'Jour') AS jour,
+           SUM(s.type_shift = 'Nuit') AS nuit,
+           SUM(s.type_shift = 'Congé') AS conge
+    FROM shifts_prevus s
+    WHERE s.date_shift BETWEEN ? AND ?
+    GROUP BY s.date_shift
+    ORDER BY s.date_shift
+""")
+
+def get_resume_shifts(date_debut, date_fin):
+    """Effectifs attendus par jour et type de shift"""
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query(SQL_RESUME_SHIFTS, conn, params=(date_debut, date_fin))
+    except Exception as e:
+        st.error(f"Erreur récupération des shifts prévus: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+# --- Rattachement des pointages aux shifts ---
+# Un pointage appartient au shift ouvert à son horodatage : le départ à 03:30 d'un
+# shift 20:00-04:00 est celui de la veille. Le paramètre est un tableau JSON de
+# [personnel_id, borne début, borne fin] : shift le plus récent commencé avant la
+# borne début et fini après la borne fin (index idx_shifts_prevus_debut).
+SQL_RATTACHEMENT_SHIFTS = enregistrer_requete("rattachement_shifts", """
+    SELECT CAST(j.key AS INTEGER) AS rang, (
+        SELECT s.date_shift FROM shifts_prevus s
+        WHERE s.personnel_id = json_extract(j.value, '$[0]')
+        AND s.debut <= json_extract(j.value, '$[1]')
+        AND s.fin >= json_extract(j.value, '$[2]')
+        ORDER BY s.debut DESC
+        LIMIT 1
+    ) AS date_shift
+    FROM json_each(?) j
+""")
+
+SQL_HORAIRES_RATTACHEMENT = """
+    SELECT p.id, p.heure_entree_prevue, p.heure_sortie_prevue
+    FROM json_each(?) j
+    JOIN personnels p ON p.id = j.value
+"""
+
+def _horodatage_pointage(pointage):
+    """Horodatage d'un pointage : sa date et son heure (avant rattachement au shift)"""
+    return datetime.combine(date.fromisoformat(str(pointage['date_pointage'])), _as_time(pointage['heure']))
+
+def _bornes_rattachement(horodatage, sens):
+    """Bornes [début au plus tard, fin au plus tôt] du shift auquel rattacher un pointage"""
+    if sens == 'arrivee':
+        # Arrivée en avance jusqu'à la marge, pas après la fin du shift
+        debut, fin = horodatage + timedelta(minutes=MARGE_ARRIVEE_SHIFT_MINUTES), horodatage
+    else:
+        # Départ après le début du shift, en retard jusqu'à la marge
+        debut, fin = horodatage, horodatage - timedelta(minutes=MARGE_DEPART_SHIFT_MINUTES)
+    return debut.strftime('%Y-%m-%d %H:%M:%S'), fin.strftime('%Y-%m-%d %H:%M:%S')
+
+def _rattacher_pointages(cur, pointages):
+    """Date de shift de chaque pointage (personnel_id, date_pointage, heure, sens), dans l'ordre du lot.
+
+    Sans shift prévu (groupe de nuit non actif, date hors calendrier), un départ peu
+    après la sortie d'un horaire qui passe minuit revient à la veille ; sinon la date
+    du pointage est gardée.
+    """
+    horodatages = [_horodatage_pointage(p) for p in pointages]
+    bornes = json.dumps([
+        [int(p['personnel_id']), *_bornes_rattachement(horodatage, p['sens'])]
+        for p, horodatage in zip(pointages, horodatages)
+    ])
+    cur.execute(SQL_RATTACHEMENT_SHIFTS, (bornes,))
+    dates_shift = {row['rang']: row['date_shift'] for row in cur.fetchall()}
+
+    sans_shift = [rang for rang in range(len(pointages)) if dates_shift.get(rang) is None]
+    horaires = {}
+    if sans_shift:
+        ids = json.dumps(sorted({int(pointages[rang]['personnel_id']) for rang in sans_shift}))
+        cur.execute(SQL_HORAIRES_RATTACHEMENT, (ids,))
+        horaires = {row['id']: row for row in cur.fetchall()}
+
+    dates = []
+    for rang, (p, horodatage) in enumerate(zip(pointages, horodatages)):
+        if dates_shift.get(rang) is not None:
+            dates.append(date.fromisoformat(dates_shift[rang]))
+            continue
+        jour = horodatage.date()
+        horaire = horaires.get(int(p['personnel_id']))
+        if horaire is not None and p['sens'] == 'depart':
+            entree = _as_time(horaire['heure_entree_prevue'])
+            sortie = _as_time(horaire['heure_sortie_prevue'])
+            fin_veille = datetime.combine(jour, sortie) + timedelta(minutes=MARGE_DEPART_SHIFT_MINUTES)
+            if sortie < entree and horodatage.time() < entree and horodatage <= fin_veille:
+                jour -= timedelta(days=1)
+        dates.append(jour)
+    return dates
+
+def rattacher_pointages(pointages):
+    """Date de shift de chaque pointage du lot (voir _rattacher_pointages), None en cas d'erreur"""
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        return _rattacher_pointages(conn.cursor(), pointages)
+    except Exception as e:
+        print(f"DEBUG: Rattachement des pointages impossible - {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# Diacritiques retirés après décomposition NFKD (é -> e) : même règle pour la clé
+# de recherche calculée en pandas et pour la saisie
+ACCENTS = r"[\u0300-\u036f]"
+
+def normaliser_recherche(texte):
+    """Minuscules sans accents, comparable à la colonne cle_recherche"""
+    return re.sub(ACCENTS, "", unicodedata.normalize("NFKD", str(texte))).casefold()
+
+def _grouper_par_service(services, fiches):
+    """{service: [employé, ...]} dans l'ordre des fiches, sans repasser par pandas ligne à ligne"""
+    personnel_par_service = {}
+    for service, fiche in zip(services, fiches):
+        personnel_par_service.setdefault(service, []).append(fiche)
+    return personnel_par_service
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _personnel_filtrable(db_path, date_pointage, inclure_tous, version):
+    """Mémoïse par (base, jour, périmètre, version des données) le personnel pointable :
+    le DataFrame, sa clé de recherche normalisée et les fiches déjà converties en dict"""
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError(f"Connexion impossible à {db_path}")
     try:
         # Construire la requête de base
         if inclure_tous:
@@ -539,27 +1847,17 @@ def filtrer_personnel(recherche, filtre_service, groupe_nuit_actif=None, inclure
                 FROM personnels 
                 WHERE actif = 1 
             """
+            params = []
         else:
+            # Attendus du jour : seul le personnel de nuit du groupe actif a un shift
             query = """
                 SELECT id, nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, 
                        groupe_nuit, jours_travail, actif 
-                FROM personnels 
-                WHERE actif = 1 
+                FROM shifts_prevus s
+                JOIN personnels p ON p.id = s.personnel_id
+                WHERE s.date_shift = ? 
             """
-            
-            # Conditions pour exclure les groupes de nuit non actifs
-            services_nuit = get_services_nuit()
-            nuit_conditions = []
-            
-            for service in services_nuit:
-                groupe_actif_service = get_groupe_nuit_actif_service(service)
-                # Inclure seulement le personnel de nuit du groupe actif
-                nuit_conditions.append(f"(service = '{service}' AND poste = 'Nuit' AND groupe_nuit = '{groupe_actif_service}')")
-            
-            if nuit_conditions:
-                query += " AND (poste = 'Jour' OR poste = 'Mixte' OR " + " OR ".join(nuit_conditions) + ")"
-            else:
-                query += " AND (poste = 'Jour' OR poste = 'Mixte')"
+            params = [date_pointage]
         
         # Exclure les employés en congé
         query += """
@@ -589,49 +1887,54 @@ def filtrer_personnel(recherche, filtre_service, groupe_nuit_actif=None, inclure
         
         query += " ORDER BY service, nom, prenom"
         
-        df = pd.read_sql_query(query, conn, params=(date_pointage, date_pointage, date_pointage, date_pointage))
+        params.extend([date_pointage, date_pointage, date_pointage, date_pointage])
+        df = pd.read_sql_query(query, conn, params=params)
+    finally:
+        conn.close()
+
+    # "prénom nom", service et poste séparés par un caractère impossible à saisir :
+    # une recherche ne peut pas chevaucher deux champs
+    cle = (df['prenom'] + " " + df['nom']).str.cat([df['service'], df['poste']], sep="\x1f")
+    cle_recherche = cle.str.normalize("NFKD").str.replace(ACCENTS, "", regex=True).str.casefold()
+    return df, cle_recherche, df.to_dict('records')
+
+def filtrer_personnel(recherche, filtre_service, groupe_nuit_actif=None, inclure_tous=False, date_pointage=None):
+    """Filtre le personnel en excluant les employés en congé et les nuitiers qui pointent de jour"""
+    if date_pointage is None:
+        date_pointage = date.today()
+    
+    version = get_version_donnees()
+    if version is None:
+        return {}
+    try:
+        df, cle_recherche, fiches = _personnel_filtrable(DB_PATH, date_pointage, bool(inclure_tous), version)
         
-        # Filtrer par recherche et service
-        personnel_par_service = {}
-        for _, row in df.iterrows():
-            # Vérifier que la ligne contient les colonnes nécessaires
-            if 'service' not in row or 'prenom' not in row or 'nom' not in row:
-                continue
-                
-            service = row['service']
-            
-            # Appliquer le filtre de service
-            if filtre_service != "Tous les services" and service != filtre_service:
-                continue
-                
-            # Appliquer le filtre de recherche
-            nom_complet = f"{row['prenom']} {row['nom']}".lower()
-            poste = row.get('poste', '')
-            
-            if recherche and recherche.lower() not in nom_complet and recherche.lower() not in service.lower() and recherche.lower() not in poste.lower():
-                continue
-            
-            if service not in personnel_par_service:
-                personnel_par_service[service] = []
-            personnel_par_service[service].append(row.to_dict())
-            
-        return personnel_par_service
+        # Filtres de service et de recherche en masques vectorisés
+        masque = pd.Series(True, index=df.index)
+        if filtre_service != "Tous les services":
+            masque &= df['service'] == filtre_service
+        if recherche:
+            masque &= cle_recherche.str.contains(normaliser_recherche(recherche), regex=False)
+        
+        # Index positionnel (RangeIndex) : les lignes retenues désignent directement leurs fiches
+        retenus = df.index[masque]
+        return _grouper_par_service(df['service'].to_numpy()[retenus], [fiches[i] for i in retenus])
     except Exception as e:
         st.error(f"Erreur récupération personnel par service: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
+
+SQL_POINTAGE_EMPLOYE_JOUR = enregistrer_requete("pointage_employe_jour", """
+    SELECT * FROM pointages 
+    WHERE personnel_id = ? AND date_pointage = ?
+""")
+
 def get_pointage_employe_jour(personnel_id, date_pointage):
     conn = get_connection()
     if conn is None:
         return {}
     try:
         df = pd.read_sql_query(
-            """
-            SELECT * FROM pointages 
-            WHERE personnel_id = ? AND date_pointage = ?
-            """,
+            SQL_POINTAGE_EMPLOYE_JOUR,
             conn,
             params=(personnel_id, date_pointage)
         )
@@ -644,7 +1947,38 @@ def get_pointage_employe_jour(personnel_id, date_pointage):
     finally:
         if conn:
             conn.close()
-            
+
+SQL_POINTAGES_JOUR = enregistrer_requete("pointages_jour", """
+    SELECT * FROM pointages
+    WHERE date_pointage = ?
+""")
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _pointages_jour_par_employe(db_path, date_pointage, version):
+    """Mémoïse par (base, jour, version des données) les pointages du jour indexés par employé"""
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError(f"Connexion impossible à {db_path}")
+    try:
+        df = pd.read_sql_query(SQL_POINTAGES_JOUR, conn, params=(date_pointage,))
+        return {int(p['personnel_id']): p for p in df.to_dict('records')}
+    finally:
+        conn.close()
+
+def get_pointages_jour_par_employe(date_pointage=None):
+    """Tous les pointages d'une journée en une requête, {personnel_id: pointage} (lecture seule)"""
+    if date_pointage is None:
+        date_pointage = date.today()
+
+    version = get_version_donnees()
+    if version is None:
+        return {}
+    try:
+        return _pointages_jour_par_employe(DB_PATH, date_pointage, version)
+    except Exception as e:
+        st.error(f"Erreur récupération pointages du jour: {e}")
+        return {}
+
 def test_pointage_direct():
     """Test direct de l'enregistrement en base de données"""
     conn = get_connection()
@@ -708,6 +2042,21 @@ def get_personnel():
         if conn:
             conn.close()
             
+# Attendus du jour (shifts_prevus, hors congé) sans arrivée. Paramètre : date.
+# Un nuitier qui a pointé, de jour ou de nuit, a une arrivée : il n'est pas listé.
+SQL_PERSONNEL_NON_POINTE = enregistrer_requete("personnel_non_pointe", """
+    SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue
+    FROM shifts_prevus s
+    JOIN personnels p ON p.id = s.personnel_id
+    WHERE s.date_shift = ? AND s.type_shift <> 'Congé'
+    AND NOT EXISTS (
+        SELECT 1 FROM pointages pt
+        WHERE pt.personnel_id = s.personnel_id AND pt.date_pointage = s.date_shift
+        AND pt.heure_arrivee IS NOT NULL
+    )
+    ORDER BY p.service, p.nom, p.prenom
+""")
+
 def get_personnel_non_pointe():
     """Récupère le personnel qui n'a pas pointé aujourd'hui, en excluant les congés, groupes non actifs et nuitiers qui pointent de jour"""
     conn = get_connection()
@@ -715,58 +2064,12 @@ def get_personnel_non_pointe():
         return pd.DataFrame()
     
     try:
-        # Récupérer les services avec du personnel de nuit et leurs groupes actifs
-        services_nuit = get_services_nuit()
-        conditions = []
-        
-        for service in services_nuit:
-            groupe_actif = get_groupe_nuit_actif_service(service)
-            # Exclure le personnel de nuit du groupe non actif
-            conditions.append(f"(p.service = '{service}' AND p.poste = 'Nuit' AND p.groupe_nuit = '{groupe_actif}')")
-        
-        # Construction de la requête
-        query = """
-            SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue
-            FROM personnels p
-            WHERE p.actif = 1 
-            AND (
-                p.poste = 'Jour' 
-                OR p.poste = 'Mixte'
-        """
-        
-        # Ajouter les conditions pour le personnel de nuit du groupe actif
-        if conditions:
-            query += " OR " + " OR ".join(conditions)
-        
-        query += """
-            )
-            AND p.id NOT IN (
-                SELECT personnel_id FROM pointages 
-                WHERE date_pointage = ? AND heure_arrivee IS NOT NULL
-            )
-            AND p.id NOT IN (
-                SELECT personnel_id FROM conges 
-                WHERE statut = 'Approuvé' 
-                AND date_debut <= ? 
-                AND date_fin >= ?
-            )
-            -- Exclure les employés de nuit qui ont pointé de jour
-            AND NOT (
-                p.poste = 'Nuit' 
-                AND p.id IN (
-                    SELECT personnel_id FROM pointages 
-                    WHERE date_pointage = ? 
-                    AND heure_arrivee IS NOT NULL
-                    AND strftime('%H:%M', heure_arrivee) BETWEEN '06:00' AND '18:00'
-                )
-            )
-            ORDER BY p.service, p.nom, p.prenom
-        """
+        query = SQL_PERSONNEL_NON_POINTE
         
         return pd.read_sql_query(
             query,
             conn,
-            params=(date.today(), date.today(), date.today(), date.today()),
+            params=(date.today(),),
         )
     except Exception as e:
         st.error(f"Erreur récupération personnel non pointé: {e}")
@@ -897,44 +2200,244 @@ def supprimer_personnel(personnel_id):
         if conn:
             conn.close()
 
-def calculer_statut_arrivee(heure_pointage, heure_prevue):
-    """
-    Calcule le statut de pointage selon les règles spécifiques:
-    - Plage normale: 15min avant à 5min avant l'heure prévue (07:45 à 07:55 pour 08:00)
-    - En retard: après 5min avant l'heure prévue jusqu'à 29 minutes de retard
-    - Absent: 30 minutes ou plus de retard (après 08:30 pour 08:00)
+# =========================
+# Règles de pointage
+# =========================
+# Fenêtres en minutes relatives à l'heure prévue. Une règle vaut pour un service
+# et/ou un poste (NULL : tous) à partir de sa date d'effet ; la plus spécifique
+# en vigueur l'emporte (service + poste, puis service, puis poste, puis générale).
+REGLE_JOUR = {
+    'debut_plage': -15, 'fin_plage': -5, 'seuil_absence': 30,
+    'avance_comptee': True, 'tolerance_depart': 5,
+}
+REGLE_NUIT = {
+    'debut_plage': -30, 'fin_plage': 60, 'seuil_absence': None,
+    'avance_comptee': False, 'tolerance_depart': 5,
+}
+
+SQL_VERSION_REGLES = "SELECT version_regles FROM version_donnees WHERE id = 1"
+
+SQL_REGLES_POINTAGE = enregistrer_requete("regles_pointage", """
+    SELECT id, service, poste, date_effet, debut_plage_minutes, fin_plage_minutes,
+           seuil_absence_minutes, avance_comptee, tolerance_depart_minutes
+    FROM regles_pointage
+    ORDER BY service, poste, date_effet DESC
+""")
+
+def _regle_depuis_ligne(row):
+    return {
+        'debut_plage': row['debut_plage_minutes'],
+        'fin_plage': row['fin_plage_minutes'],
+        'seuil_absence': row['seuil_absence_minutes'],
+        'avance_comptee': bool(row['avance_comptee']),
+        'tolerance_depart': row['tolerance_depart_minutes'],
+    }
+
+# Règles mémoïsées par (base, version des règles). Cache du processus et non
+# st.cache_resource : le résolveur est appelé par le thread écrivain, hors exécution Streamlit.
+_regles_en_cache = {}
+_verrou_regles = threading.Lock()
+
+def _regles_pointage(db_path, version_regles, cur=None):
+    """{(service, poste): [(date_effet, règle), ...]} par date décroissante, pour une version des règles.
+
+    cur permet la lecture dans la transaction d'écriture en cours.
     """
-    if not heure_pointage or not heure_prevue:
-        return "Non pointé", 0, False
-    
-    heure_prevue = _as_time(heure_prevue)
-    heure_pointage = _as_time(heure_pointage)
-    
-    # Convertir en datetime pour les calculs
-    dt_prevue = datetime.combine(date.today(), heure_prevue)
-    dt_pointage = datetime.combine(date.today(), heure_pointage)
-    
-    # Calcul de la différence en minutes
-    difference_minutes = (dt_pointage - dt_prevue).total_seconds() / 60
-    
-    # Définition des plages horaires spécifiques
-    debut_plage = dt_prevue - timedelta(minutes=15)  # 07:45 pour 08:00
-    fin_plage = dt_prevue - timedelta(minutes=5)     # 07:55 pour 08:00
-    limite_retard = dt_prevue + timedelta(minutes=30) # 08:30 pour 08:00
-    
-    if debut_plage <= dt_pointage <= fin_plage:
-        return "Présent à l'heure", 0, False
-    elif fin_plage < dt_pointage < limite_retard:
-        retard = (dt_pointage - fin_plage).total_seconds() / 60
+    cle = (db_path, version_regles)
+    with _verrou_regles:
+        regles = _regles_en_cache.get(cle)
+    if regles is not None:
+        return regles
+
+    if cur is not None:
+        lignes = cur.execute(SQL_REGLES_POINTAGE).fetchall()
+    else:
+        conn = get_connection()
+        if conn is None:
+            raise RuntimeError(f"Connexion impossible à {db_path}")
+        try:
+            lignes = conn.execute(SQL_REGLES_POINTAGE).fetchall()
+        finally:
+            conn.close()
+
+    regles = {}
+    for row in lignes:
+        regles.setdefault((row['service'], row['poste']), []).append(
+            (str(row['date_effet']), _regle_depuis_ligne(row))
+        )
+    with _verrou_regles:
+        # Seule la dernière version sert : les précédentes sont oubliées
+        _regles_en_cache.clear()
+        _regles_en_cache[cle] = regles
+    return regles
+
+def get_version_regles(cur=None):
+    """Version des règles de pointage, incrémentée par trigger à chaque modification"""
+    if cur is not None:
+        return cur.execute(SQL_VERSION_REGLES).fetchone()[0]
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        return conn.execute(SQL_VERSION_REGLES).fetchone()[0]
+    except Exception as e:
+        st.error(f"Erreur lecture version des règles: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def regle_pointage(service, poste, jour, version_regles=None, cur=None):
+    """Règle en vigueur le jour donné pour un service et un poste.
+
+    Dans une transaction d'écriture, passer cur : la version et, au besoin, les
+    règles sont lues dans la transaction. Sans règle applicable, retombe sur
+    REGLE_NUIT pour le poste Nuit et REGLE_JOUR sinon.
+    """
+    if version_regles is None:
+        version_regles = get_version_regles(cur)
+    regles = {} if version_regles is None else _regles_pointage(DB_PATH, version_regles, cur)
+    return _resoudre_regle(regles, service, poste, jour)
+
+def _resoudre_regle(regles, service, poste, jour):
+    """Résolution dans le dictionnaire de _regles_pointage(), de la clé la plus spécifique à la plus générale"""
+    jour = str(jour)[:10]
+    for cle in ((service, poste), (service, None), (None, poste), (None, None)):
+        for date_effet, regle in regles.get(cle, ()):
+            if date_effet <= jour:
+                return regle
+    return REGLE_NUIT if poste == 'Nuit' else REGLE_JOUR
+
+def get_regles_pointage():
+    """Liste des règles de pointage pour l'administration"""
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query(SQL_REGLES_POINTAGE, conn)
+    except Exception as e:
+        st.error(f"Erreur récupération des règles de pointage: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+def ajouter_regle_pointage(service, poste, date_effet, debut_plage, fin_plage, seuil_absence,
+                           avance_comptee, tolerance_depart):
+    """Ajoute (ou remplace pour la même clé service/poste/date) une règle de pointage"""
+    def ajouter(cur):
+        cur.execute(
+            """
+            DELETE FROM regles_pointage
+            WHERE COALESCE(service, '') = COALESCE(?, '') AND COALESCE(poste, '') = COALESCE(?, '')
+            AND date_effet = ?
+            """,
+            (service, poste, date_effet)
+        )
+        cur.execute(
+            """
+            INSERT INTO regles_pointage
+                (service, poste, date_effet, debut_plage_minutes, fin_plage_minutes,
+                 seuil_absence_minutes, avance_comptee, tolerance_depart_minutes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (service, poste, date_effet, int(debut_plage), int(fin_plage),
+             None if seuil_absence is None else int(seuil_absence), bool(avance_comptee), int(tolerance_depart))
+        )
+        return True
+
+    try:
+        return executer_ecriture(ajouter)
+    except Exception as e:
+        st.error(f"Erreur ajout de la règle de pointage: {e}")
+        return False
+
+def supprimer_regle_pointage(regle_id):
+    """Supprime une règle de pointage"""
+    try:
+        return executer_ecriture(
+            lambda cur: cur.execute("DELETE FROM regles_pointage WHERE id = ?", (int(regle_id),)).rowcount > 0
+        )
+    except Exception as e:
+        st.error(f"Erreur suppression de la règle de pointage: {e}")
+        return False
+
+def calculer_statut_arrivee(heure_pointage, heure_prevue, regle=None):
+    """
+    Calcule le statut de pointage selon la règle (REGLE_JOUR par défaut):
+    - Plage normale: 15min avant à 5min avant l'heure prévue (07:45 à 07:55 pour 08:00)
+    - En retard: après 5min avant l'heure prévue jusqu'au seuil d'absence
+    - Absent: 30 minutes ou plus de retard (après 08:30 pour 08:00), jamais sans seuil
+    Une arrivée plus de 12 heures avant l'heure prévue est celle du lendemain : shift
+    qui passe minuit (00:45 pour 18:00, soit 6h45 après l'heure prévue).
+    """
+    if not heure_pointage or not heure_prevue:
+        return "Non pointé", 0, False
+    if regle is None:
+        regle = REGLE_JOUR
+    
+    heure_prevue = _as_time(heure_prevue)
+    heure_pointage = _as_time(heure_pointage)
+    
+    # Convertir en datetime pour les calculs
+    dt_prevue = datetime.combine(date.today(), heure_prevue)
+    dt_pointage = datetime.combine(date.today(), heure_pointage)
+    if dt_pointage < dt_prevue - timedelta(hours=12):
+        dt_pointage += timedelta(days=1)
+    
+    # Définition des plages horaires de la règle
+    debut_plage = dt_prevue + timedelta(minutes=regle['debut_plage'])  # 07:45 pour 08:00
+    fin_plage = dt_prevue + timedelta(minutes=regle['fin_plage'])      # 07:55 pour 08:00
+    limite_retard = None
+    if regle['seuil_absence'] is not None:
+        limite_retard = dt_prevue + timedelta(minutes=regle['seuil_absence'])  # 08:30 pour 08:00
+    
+    if debut_plage <= dt_pointage <= fin_plage:
+        return "Présent à l'heure", 0, False
+    elif dt_pointage > fin_plage and (limite_retard is None or dt_pointage < limite_retard):
+        retard = (dt_pointage - fin_plage).total_seconds() / 60
         return "En retard", int(retard), False
-    elif dt_pointage >= limite_retard:
-        return "Absent", 30, True  # Retourne 30 minutes de retard et marque comme absent
     elif dt_pointage < debut_plage:
+        if not regle['avance_comptee']:
+            return "En avance", 0, False
         avance = (debut_plage - dt_pointage).total_seconds() / 60
         return "En avance", int(-avance), False
+    elif dt_pointage >= limite_retard:
+        # Retourne le seuil comme minutes de retard et marque comme absent
+        return "Absent", regle['seuil_absence'], True
     
     return "Non pointé", 0, False
 
+def calculer_statut_depart(heure_depart, heure_sortie_prevue, regle=None, heure_entree_prevue=None):
+    """Statut et minutes de départ anticipé : anticipé au-delà de la tolérance de la règle (5 min par défaut).
+
+    Avec heure_entree_prevue, un shift qui passe minuit (sortie avant l'entrée, 20:00-04:00)
+    finit le lendemain et un départ antérieur à l'heure d'entrée est placé le lendemain.
+    """
+    if regle is None:
+        regle = REGLE_JOUR
+    dt_depart = datetime.combine(date.today(), _as_time(heure_depart))
+    dt_sortie_prevue = datetime.combine(date.today(), _as_time(heure_sortie_prevue))
+    if heure_entree_prevue is not None:
+        heure_entree = _as_time(heure_entree_prevue)
+        if dt_sortie_prevue.time() < heure_entree:
+            dt_sortie_prevue += timedelta(days=1)
+            if dt_depart.time() < heure_entree:
+                dt_depart += timedelta(days=1)
+    delta_minutes = (dt_sortie_prevue - dt_depart).total_seconds() / 60
+
+    if delta_minutes > regle['tolerance_depart']:
+        return "Départ anticipé", int(delta_minutes)
+    return "Present", 0
+
+SQL_EST_EN_CONGE = enregistrer_requete("est_en_conge", """
+    SELECT COUNT(*) FROM conges 
+    WHERE personnel_id = ? 
+    AND statut = 'Approuvé'
+    AND date_debut <= ? 
+    AND date_fin >= ?
+""")
+
 def est_en_conge(personnel_id, date_check):
     """Vérifie si l'employé est en congé à une date donnée"""
     conn = get_connection()
@@ -945,13 +2448,7 @@ def est_en_conge(personnel_id, date_check):
         with conn:
             cur = conn.cursor()
             cur.execute(
-                """
-                SELECT COUNT(*) FROM conges 
-                WHERE personnel_id = ? 
-                AND statut = 'Approuvé'
-                AND date_debut <= ? 
-                AND date_fin >= ?
-                """,
+                SQL_EST_EN_CONGE,
                 (personnel_id, date_check, date_check)
             )
             count = cur.fetchone()[0]
@@ -999,252 +2496,676 @@ def est_jour_de_nuit(personnel_id, date_check):
             conn.close()
 
 def enregistrer_pointage_arrivee(personnel_id, date_pointage, heure_arrivee, motif_retard=None, notes=None, est_absent=False):
-    # Vérifier si l'employé est en congé
-    if est_en_conge(personnel_id, date_pointage):
+    """Enregistre une arrivée : une lecture de l'horaire et du congé puis un UPSERT, dans une transaction"""
+    succes, retard_minutes, erreur = enregistrer_pointages_lot([{
+        'personnel_id': personnel_id,
+        'date_pointage': date_pointage,
+        'sens': 'arrivee',
+        'heure': heure_arrivee,
+        'motif': motif_retard,
+        'notes': notes,
+        'est_absent': est_absent,
+    }])[0]
+    if erreur == POINTAGE_EN_CONGE:
         st.error("❌ Cet employé est en congé aujourd'hui. Pointage impossible.")
-        return False, 0
-    
-    conn = get_connection()
-    if conn is None:
-        return False, 0
-    try:
-        personnel_id = int(personnel_id)
-        
-        with conn:
-            cur = conn.cursor()
-            # Vérifier si c'est un employé de nuit
-            cur.execute("SELECT poste FROM personnels WHERE id = ?", (personnel_id,))
-            poste_result = cur.fetchone()
-            poste = poste_result['poste'] if poste_result else 'Jour'
-            
-            # Heure prévue
-            cur.execute("SELECT heure_entree_prevue FROM personnels WHERE id = ?", (personnel_id,))
-            res = cur.fetchone()
-            if not res:
-                return False, 0
-            heure_prevue = _as_time(res['heure_entree_prevue'])
-
-            # Convertir l'heure d'arrivée en time object pour les calculs
-            heure_arrivee_time = _as_time(heure_arrivee)
-
-            # Pour les employés de nuit, ajuster la logique de calcul
-            if poste == 'Nuit':
-                # Pour les nuitiers, on utilise une logique différente
-                statut_arrivee, retard_minutes, est_absent_calc = calculer_statut_arrivee_nuit(heure_arrivee_time, heure_prevue)
-            else:
-                # Pour les employés de jour, logique normale
-                statut_arrivee, retard_minutes, est_absent_calc = calculer_statut_arrivee(heure_arrivee_time, heure_prevue)
+    return succes, retard_minutes
 
-            # Convertir l'heure en string pour SQLite
-            heure_arrivee_str = heure_arrivee_time.strftime('%H:%M:%S')
+def calculer_statut_arrivee_nuit(heure_pointage, heure_prevue, regle=None):
+    """Calcule le statut de pointage pour les employés de nuit (REGLE_NUIT par défaut) :
+    à l'heure de 30 minutes avant à 1 heure après, en retard au-delà, jamais absent"""
+    return calculer_statut_arrivee(heure_pointage, heure_prevue, REGLE_NUIT if regle is None else regle)
 
-            # Si le système détecte une absence, enregistrer dans la table absences
-            if est_absent or est_absent_calc:
-                cur.execute(
-                    """
-                    INSERT OR IGNORE INTO absences (personnel_id, date_absence, motif, justifie)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    (personnel_id, date_pointage, motif_retard or f"Absence automatique (retard de {retard_minutes} minutes)", False)
-                )
-                # MAINTENANT on enregistre quand même le pointage avec le statut "Absent"
-                statut_arrivee = "Absent"
-            
-            # Enregistrer le retard si applicable (seulement si < 30 minutes)
-            if retard_minutes > 0 and retard_minutes < 30:
-                cur.execute(
-                    """
-                    INSERT OR IGNORE INTO retards (personnel_id, date_retard, retard_minutes, motif)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    (personnel_id, date_pointage, retard_minutes, motif_retard),
-                )
+# --- Classement vectorisé des pointages ---
+# Mêmes règles que calculer_statut_arrivee() / calculer_statut_depart(), appliquées
+# à des tableaux entiers d'heures (secondes depuis minuit) au lieu d'un pointage à la fois
+STATUTS_ARRIVEE = ("Non pointé", "Présent à l'heure", "En retard", "Absent", "En avance")
+CODE_NON_POINTE, CODE_A_L_HEURE, CODE_EN_RETARD, CODE_ABSENT, CODE_EN_AVANCE = range(len(STATUTS_ARRIVEE))
 
-            # Vérifier si un pointage existe déjà pour cette journée
-            cur.execute(
-                "SELECT id FROM pointages WHERE personnel_id = ? AND date_pointage = ?",
-                (personnel_id, date_pointage)
-            )
-            existing = cur.fetchone()
+def secondes_depuis_minuit(heures):
+    """Heures ('HH:MM[:SS[.ffffff]]' ou datetime.time) en secondes depuis minuit (float), NaN si vide.
 
-            if existing:
-                # Mettre à jour l'arrivée
-                cur.execute(
-                    """
-                    UPDATE pointages 
-                    SET heure_arrivee = ?, statut_arrivee = ?, retard_minutes = ?, 
-                        motif_retard = ?, notes = COALESCE(?, notes)
-                    WHERE id = ?
-                    """,
-                    (heure_arrivee_str, statut_arrivee, retard_minutes, motif_retard, notes, existing['id'])
-                )
-            else:
-                # Nouveau pointage
-                cur.execute(
-                    """
-                    INSERT INTO pointages (personnel_id, date_pointage, heure_arrivee, statut_arrivee, retard_minutes, motif_retard, notes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (personnel_id, date_pointage, heure_arrivee_str, statut_arrivee, retard_minutes, motif_retard, notes),
-                )
-                
-        return True, retard_minutes
+    Une heure illisible vaut 08:00, comme dans _as_time(). Seules les valeurs distinctes
+    sont analysées : une période entière ne compte que quelques centaines d'heures différentes.
+    """
+    indices, valeurs = pd.factorize(pd.Series(heures, dtype=object))
+    serie = pd.Series(valeurs, dtype=object)
+    vide = serie == ""
+    parties = serie.astype(str).str.extract(r"^(\d{1,2}):(\d{1,2})(?::(\d{1,2})(\.\d{1,6})?)?$")
+    heure, minute, seconde = (parties[i].astype(float) for i in range(3))
+    seconde = seconde.fillna(0) + parties[3].astype(float).fillna(0)
+    lisible = heure.notna() & (heure < 24) & (minute < 60) & (seconde < 60)
+
+    secondes = (heure * 3600 + minute * 60 + seconde).where(lisible, 8 * 3600).where(~vide)
+    # Indice -1 : valeur manquante (None / NaN)
+    return np.append(secondes.to_numpy(dtype=float), np.nan)[indices]
+
+def classer_arrivees(secondes_pointage, secondes_prevues, debut_plage, fin_plage, seuil_absence, avance_comptee):
+    """Classe un lot d'arrivées en une passe NumPy.
+
+    Les paramètres de règle (minutes, comme dans REGLE_JOUR) sont des scalaires ou des
+    tableaux alignés sur les pointages ; un seuil d'absence NaN signifie jamais absent.
+    Retourne (codes dans STATUTS_ARRIVEE, retard en minutes, absent).
+    """
+    pointage = np.asarray(secondes_pointage, dtype=float)
+    prevue = np.asarray(secondes_prevues, dtype=float)
+    seuil_absence = np.broadcast_to(np.asarray(seuil_absence, dtype=float), pointage.shape)
+    avance_comptee = np.broadcast_to(np.asarray(avance_comptee, dtype=bool), pointage.shape)
+
+    pointe = ~(np.isnan(pointage) | np.isnan(prevue))
+    pointage = np.where(pointe, pointage, 0.0)
+    prevue = np.where(pointe, prevue, 0.0)
+    # Arrivée plus de 12 heures avant l'heure prévue : lendemain (shift qui passe minuit)
+    pointage = np.where(pointage < prevue - 12 * 3600, pointage + 24 * 3600, pointage)
+    debut = prevue + np.asarray(debut_plage, dtype=float) * 60
+    fin = prevue + np.asarray(fin_plage, dtype=float) * 60
+    avec_seuil = ~np.isnan(seuil_absence)
+    limite = prevue + np.where(avec_seuil, seuil_absence, 0.0) * 60
+
+    # Retard compté depuis la fin de plage, absence à partir du seuil, avance comptée depuis le début de plage
+    a_l_heure = pointe & (pointage >= debut) & (pointage <= fin)
+    absent = pointe & (pointage > fin) & avec_seuil & (pointage >= limite)
+    en_retard = pointe & (pointage > fin) & ~absent
+    en_avance = pointe & (pointage < debut)
+
+    codes = np.full(pointage.shape, CODE_NON_POINTE, dtype=np.int8)
+    codes[a_l_heure] = CODE_A_L_HEURE
+    codes[en_retard] = CODE_EN_RETARD
+    codes[absent] = CODE_ABSENT
+    codes[en_avance] = CODE_EN_AVANCE
+
+    retard = np.zeros(pointage.shape, dtype=np.int64)
+    retard[en_retard] = np.trunc((pointage - fin)[en_retard] / 60)
+    retard[absent] = seuil_absence[absent]
+    avance = en_avance & avance_comptee
+    retard[avance] = -np.trunc((debut - pointage)[avance] / 60)
+
+    return codes, retard, absent
+
+def classer_departs(secondes_depart, secondes_sortie_prevues, tolerance_depart, secondes_entree_prevues=None):
+    """Départs anticipés d'un lot : (anticipé, minutes d'avance), comme calculer_statut_depart()"""
+    depart = np.asarray(secondes_depart, dtype=float)
+    sortie = np.asarray(secondes_sortie_prevues, dtype=float)
+    if secondes_entree_prevues is not None:
+        # Shift qui passe minuit : sortie et départs avant l'heure d'entrée le lendemain
+        entree = np.asarray(secondes_entree_prevues, dtype=float)
+        nuit = sortie < entree
+        depart = np.where(nuit & (depart < entree), depart + 24 * 3600, depart)
+        sortie = np.where(nuit, sortie + 24 * 3600, sortie)
+    delta = (sortie - depart) / 60
+    anticipe = delta > np.asarray(tolerance_depart, dtype=float)
+    return anticipe, np.where(anticipe, np.trunc(np.where(anticipe, delta, 0.0)), 0).astype(np.int64)
+
+def verifier_classement_arrivees(nb_cas=20000, graine=None):
+    """Compare classer_arrivees() aux fonctions unitaires sur des heures tirées au hasard.
+
+    Retourne un DataFrame des cas divergents (vide si le classement vectorisé est équivalent).
+    """
+    rng = np.random.default_rng(graine)
+    secondes = rng.integers(0, 24 * 3600, size=(2, nb_cas))
+    # Heures prévues autour desquelles se concentrent les cas limites
+    secondes[1] = rng.choice(np.arange(0, 24 * 3600, 15 * 60), size=nb_cas)
+    secondes[0] = np.where(
+        rng.random(nb_cas) < 0.8,
+        np.clip(secondes[1] + rng.integers(-120 * 60, 180 * 60, size=nb_cas), 0, 24 * 3600 - 1),
+        secondes[0]
+    )
+    heures = [
+        [f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in ligne]
+        for ligne in secondes.tolist()
+    ]
+    # Quelques heures manquantes ou illisibles, et des heures sans secondes
+    for ligne in heures:
+        for i in rng.choice(nb_cas, size=max(nb_cas // 50, 1), replace=False).tolist():
+            ligne[i] = [None, "", "8h", ligne[i][:5]][i % 4]
+    nuit = rng.random(nb_cas) < 0.3
+
+    regles = pd.DataFrame([REGLE_NUIT if n else REGLE_JOUR for n in nuit.tolist()])
+    codes, retard, absent = classer_arrivees(
+        secondes_depuis_minuit(heures[0]), secondes_depuis_minuit(heures[1]),
+        regles['debut_plage'], regles['fin_plage'], regles['seuil_absence'].astype(float),
+        regles['avance_comptee']
+    )
+    cas = pd.DataFrame({
+        'heure_pointage': heures[0], 'heure_prevue': heures[1], 'nuit': nuit,
+        'vectorise': list(zip(np.array(STATUTS_ARRIVEE)[codes], retard.tolist(), absent.tolist())),
+        'unitaire': [
+            (calculer_statut_arrivee_nuit if n else calculer_statut_arrivee)(hp, hv)
+            for hp, hv, n in zip(heures[0], heures[1], nuit.tolist())
+        ],
+    })
+    return cas[cas['vectorise'] != cas['unitaire']]
+
+def regles_par_pointage(df, version_regles, cur=None):
+    """Paramètres de la règle en vigueur pour chaque ligne (service, poste, date_pointage) de df.
+
+    La résolution n'est faite qu'une fois par combinaison distincte.
+    """
+    cles = ['service', 'poste', 'date_pointage']
+    combinaisons = df[cles].drop_duplicates()
+    toutes = _regles_pointage(DB_PATH, version_regles, cur)
+    regles = pd.DataFrame(
+        [
+            _resoudre_regle(toutes, service, poste, jour)
+            for service, poste, jour in combinaisons.itertuples(index=False)
+        ],
+        index=combinaisons.index, columns=list(REGLE_JOUR)
+    )
+    regles['seuil_absence'] = regles['seuil_absence'].astype(float)
+    return df[cles].merge(pd.concat([combinaisons, regles], axis=1), on=cles, how='left')
+
+def _appliquer_regles(df, version_regles, cur=None):
+    """Ajoute à df les valeurs recalculées par les règles en vigueur et la colonne ecart.
+
+    Une arrivée ou un départ absent garde ses valeurs enregistrées. Heure prévue
+    manquante : 08:00, comme _calculer_arrivee() via _as_time().
+    """
+    regles = regles_par_pointage(df, version_regles, cur)
+
+    arrivees = secondes_depuis_minuit(df['heure_arrivee'])
+    prevues = secondes_depuis_minuit(df['heure_entree_prevue'])
+    prevues[np.isnan(prevues)] = 8 * 3600
+    codes, retard, _ = classer_arrivees(
+        arrivees, prevues, regles['debut_plage'], regles['fin_plage'],
+        regles['seuil_absence'], regles['avance_comptee']
+    )
+    avec_arrivee = ~np.isnan(arrivees)
+    df['statut_recalcule'] = np.where(avec_arrivee, np.array(STATUTS_ARRIVEE, dtype=object)[codes], df['statut_arrivee'])
+    df['retard_recalcule'] = np.where(avec_arrivee, retard, df['retard_minutes'].fillna(0)).astype(int)
+
+    departs = secondes_depuis_minuit(df['heure_depart'])
+    sorties = secondes_depuis_minuit(df['heure_sortie_prevue'])
+    sorties[np.isnan(sorties)] = 8 * 3600
+    avec_depart = ~np.isnan(departs)
+    anticipe, avance = classer_departs(np.where(avec_depart, departs, 0.0), sorties, regles['tolerance_depart'], prevues)
+    df['statut_depart_recalcule'] = np.where(
+        avec_depart, np.where(anticipe, "Départ anticipé", "Present"), df['statut_depart']
+    )
+    df['depart_avance_recalcule'] = np.where(avec_depart, avance, df['depart_avance_minutes'].fillna(0)).astype(int)
+
+    df['ecart'] = (
+        (df['statut_arrivee'] != df['statut_recalcule'])
+        | (df['retard_minutes'].fillna(0).astype(int) != df['retard_recalcule'])
+        | (df['statut_depart'] != df['statut_depart_recalcule'])
+        | (df['depart_avance_minutes'].fillna(0).astype(int) != df['depart_avance_recalcule'])
+    )
+    return df
+
+# Pointages d'une période avec l'horaire et le rattachement de l'employé
+SQL_REEVALUATION_POINTAGES = enregistrer_requete("reevaluation_pointages", """
+    SELECT pt.id, pt.personnel_id, p.nom, p.prenom, p.service, p.poste, pt.date_pointage,
+           pt.heure_arrivee, p.heure_entree_prevue, pt.statut_arrivee, pt.retard_minutes,
+           pt.heure_depart, p.heure_sortie_prevue, pt.statut_depart, pt.depart_avance_minutes,
+           pt.motif_retard
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+""")
+
+# Taille des lots du recalcul : une transaction d'écriture par tranche de jours
+REEVALUATION_JOURS_PAR_LOT = 7
+
+def comparer_pointages_regles(date_debut, date_fin):
+    """Recalcule en lot les pointages d'une période avec les règles en vigueur, sans rien modifier.
+
+    Ajoute statut_recalcule, retard_recalcule, statut_depart_recalcule,
+    depart_avance_recalcule et ecart (différence avec les valeurs enregistrées).
+    """
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame()
+    try:
+        df = pd.read_sql_query(SQL_REEVALUATION_POINTAGES, conn, params=(date_debut, date_fin))
+        version_regles = conn.execute(SQL_VERSION_REGLES).fetchone()[0]
     except Exception as e:
-        st.error(f"Erreur enregistrement pointage arrivée: {e}")
-        return False, 0
+        st.error(f"Erreur lecture des pointages: {e}")
+        return pd.DataFrame()
     finally:
         if conn:
             conn.close()
 
-def calculer_statut_arrivee_nuit(heure_pointage, heure_prevue):
-    """Calcule le statut de pointage pour les employés de nuit avec des règles spécifiques"""
-    if not heure_pointage or not heure_prevue:
-        return "Non pointé", 0, False
-    
-    heure_prevue = _as_time(heure_prevue)
-    heure_pointage = _as_time(heure_pointage)
-    
-    # Convertir en datetime pour les calculs
-    dt_prevue = datetime.combine(date.today(), heure_prevue)
-    dt_pointage = datetime.combine(date.today(), heure_pointage)
-    
-    # Pour les nuitiers, on considère qu'ils peuvent pointer à tout moment
-    # mais on garde une logique de retard basée sur leur heure prévue
-    
-    difference_minutes = (dt_pointage - dt_prevue).total_seconds() / 60
-    
-    # Plages plus flexibles pour les nuitiers
-    debut_plage = dt_prevue - timedelta(minutes=30)  # 30 minutes avant
-    fin_plage = dt_prevue + timedelta(minutes=60)    # 1 heure après
-    
-    if debut_plage <= dt_pointage <= fin_plage:
-        return "Présent à l'heure", 0, False
-    elif dt_pointage > fin_plage:
-        retard = (dt_pointage - fin_plage).total_seconds() / 60
-        return "En retard", int(retard), False
-    elif dt_pointage < debut_plage:
-        return "En avance", 0, False
-    
-    return "Non pointé", 0, False
+    if df.empty:
+        return df
+    return _appliquer_regles(df, version_regles)
+
+def _reevaluer_lot(cur, date_debut, date_fin):
+    """Recalcule et réécrit les pointages d'une tranche, dans la transaction d'écriture ouverte"""
+    cur.execute(SQL_REEVALUATION_POINTAGES, (date_debut, date_fin))
+    df = pd.DataFrame.from_records(cur.fetchall(), columns=[colonne[0] for colonne in cur.description])
+    if df.empty:
+        return 0
+    modifies = _appliquer_regles(df, get_version_regles(cur), cur)
+    modifies = modifies[modifies['ecart']]
+
+    cur.executemany(
+        """
+        UPDATE pointages
+        SET statut_arrivee = ?, retard_minutes = ?, statut_depart = ?, depart_avance_minutes = ?
+        WHERE id = ?
+        """,
+        [
+            (r['statut_recalcule'], r['retard_recalcule'], r['statut_depart_recalcule'], r['depart_avance_recalcule'], r['id'])
+            for r in modifies.to_dict('records')
+        ]
+    )
+    # Table retards resynchronisée comme dans modifier_historique_pointage()
+    retards = modifies[modifies['retard_minutes'].fillna(0).astype(int) != modifies['retard_recalcule']]
+    cur.executemany(
+        "DELETE FROM retards WHERE personnel_id = ? AND date_retard = ?",
+        list(zip(retards['personnel_id'].tolist(), retards['date_pointage'].tolist()))
+    )
+    # Retard sous le seuil d'absence de la règle de la ligne (sans seuil : pas de borne),
+    # c'est-à-dire arrivée classée 'En retard'
+    nouveaux = retards[(retards['retard_recalcule'] > 0) & (retards['statut_recalcule'] == 'En retard')]
+    cur.executemany(
+        "INSERT INTO retards (personnel_id, date_retard, retard_minutes, motif) VALUES (?, ?, ?, ?)",
+        [
+            (r['personnel_id'], r['date_pointage'], r['retard_recalcule'], r['motif_retard'] or "Retard recalculé")
+            for r in nouveaux.to_dict('records')
+        ]
+    )
+    return len(modifies)
+
+def reevaluer_pointages(date_debut, date_fin, progression=None):
+    """Réapplique les règles en vigueur aux pointages d'une période, par tranches de REEVALUATION_JOURS_PAR_LOT jours.
+
+    Met à jour statut_arrivee, retard_minutes, statut_depart et depart_avance_minutes
+    (et la table retards) là où ils diffèrent ; les absences enregistrées et les mois
+    archivés ne sont pas modifiés. progression(fraction) est appelé après chaque tranche.
+    Retourne le nombre de pointages modifiés, None en cas d'erreur.
+    """
+    nb_jours = (date_fin - date_debut).days + 1
+    modifies = 0
+    for decalage in range(0, max(nb_jours, 0), REEVALUATION_JOURS_PAR_LOT):
+        debut_lot = date_debut + timedelta(days=decalage)
+        fin_lot = min(debut_lot + timedelta(days=REEVALUATION_JOURS_PAR_LOT - 1), date_fin)
+        try:
+            modifies += executer_ecriture(lambda cur: _reevaluer_lot(cur, debut_lot, fin_lot))
+        except Exception as e:
+            st.error(f"Erreur recalcul des pointages du {debut_lot} au {fin_lot}: {e}")
+            return None
+        if progression is not None:
+            progression(min((decalage + REEVALUATION_JOURS_PAR_LOT) / nb_jours, 1.0))
+    return modifies
+
+# Motifs de refus d'un pointage renvoyés par enregistrer_pointages_lot()
+POINTAGE_EN_CONGE = "en_conge"
+POINTAGE_EMPLOYE_INCONNU = "employe_inconnu"
+
+# Horaire et congé de chaque pointage du lot en une lecture : le paramètre est
+# un tableau JSON de paires [personnel_id, date_pointage], rang = indice du pointage
+SQL_HORAIRES_POINTAGE = enregistrer_requete("horaires_pointage", """
+    SELECT CAST(j.key AS INTEGER) AS rang, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
+           EXISTS (
+               SELECT 1 FROM conges c
+               WHERE c.personnel_id = p.id AND c.statut = 'Approuvé'
+               AND c.date_debut <= json_extract(j.value, '$[1]')
+               AND c.date_fin >= json_extract(j.value, '$[1]')
+           ) AS en_conge
+    FROM json_each(?) j
+    JOIN personnels p ON p.id = json_extract(j.value, '$[0]')
+""")
+
+SQL_INSERT_ABSENCE_AUTO = """
+    INSERT OR IGNORE INTO absences (personnel_id, date_absence, motif, justifie)
+    VALUES (?, ?, ?, ?)
+"""
+
+# --- Journal des pointages (punch_events) ---
+# Les badgeages, corrections et annulations sont ajoutés au journal, jamais
+# modifiés ; la ligne pointages d'un (employé, shift) est dérivée de ses événements
+SQL_INSERT_EVENEMENT = """
+    INSERT INTO punch_events (personnel_id, date_shift, horodatage, sens, heure, correction, statut, motif, notes, est_absent, source)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Événements de chaque (employé, shift) donné, dans l'ordre d'ajout : le paramètre
+# est un tableau JSON de paires [personnel_id, date_shift]
+SQL_EVENEMENTS_CLES = enregistrer_requete("evenements_cles", """
+    SELECT e.id, e.personnel_id, e.date_shift, e.horodatage, e.sens, e.heure, e.correction,
+           e.statut, e.motif, e.notes, e.est_absent
+    FROM json_each(?) k
+    JOIN punch_events e
+        ON e.date_shift = json_extract(k.value, '$[1]') AND e.personnel_id = json_extract(k.value, '$[0]')
+    ORDER BY e.id
+""")
+
+SQL_UPSERT_POINTAGE_DERIVE = """
+    INSERT INTO pointages (personnel_id, date_pointage, heure_arrivee, statut_arrivee, retard_minutes, motif_retard,
+                           heure_depart, statut_depart, depart_avance_minutes, motif_depart_avance, notes)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (personnel_id, date_pointage)
+    DO UPDATE SET
+        heure_arrivee = excluded.heure_arrivee,
+        statut_arrivee = excluded.statut_arrivee,
+        retard_minutes = excluded.retard_minutes,
+        motif_retard = excluded.motif_retard,
+        heure_depart = excluded.heure_depart,
+        statut_depart = excluded.statut_depart,
+        depart_avance_minutes = excluded.depart_avance_minutes,
+        motif_depart_avance = excluded.motif_depart_avance,
+        notes = excluded.notes
+"""
+
+def _evenement(personnel_id, date_shift, horodatage, sens, heure=None, correction=False, statut=None,
+               motif=None, notes=None, est_absent=False, source='pointage'):
+    """Paramètres de SQL_INSERT_EVENEMENT"""
+    if heure is not None:
+        heure = heure.strftime('%H:%M:%S') if isinstance(heure, tm) else _as_time(heure).strftime('%H:%M:%S')
+    return (
+        int(personnel_id), str(date_shift), horodatage.strftime('%Y-%m-%d %H:%M:%S'), sens, heure,
+        int(bool(correction)), statut, motif, notes, int(bool(est_absent)), source,
+    )
+
+def _retenir_evenements(evenements):
+    """Événements qui font la ligne pointages d'un (employé, shift), triés par id.
+
+    Seuls comptent les événements postérieurs à la dernière annulation. Pour chaque
+    sens, la dernière correction horodatée l'emporte, sinon la première arrivée et
+    le dernier départ badgés (double badgeage, renvoi de la badgeuse). Le motif est
+    le dernier renseigné du sens, le statut forcé le dernier donné par l'événement
+    retenu ou une correction suivante. Retourne {sens: (événement, motif, statut forcé)} et les notes, None si
+    rien ne reste.
+    """
+    annulation = max((e['id'] for e in evenements if e['sens'] == 'annulation'), default=0)
+    evenements = [e for e in evenements if e['id'] > annulation]
+    if not evenements:
+        return None
+
+    retenus = {}
+    for sens in ('arrivee', 'depart'):
+        du_sens = [e for e in evenements if e['sens'] == sens]
+        badgeages = [e for e in du_sens if e['heure'] is not None and not e['correction']]
+        corrections = [e for e in du_sens if e['heure'] is not None and e['correction']]
+        if corrections:
+            retenu = corrections[-1]
+        elif badgeages:
+            choisir = min if sens == 'arrivee' else max
+            retenu = choisir(badgeages, key=lambda e: (e['horodatage'], e['id']))
+        else:
+            continue
+        motif = next((e['motif'] for e in reversed(du_sens) if e['motif']), retenu['motif'])
+        suivants = [retenu] + [e for e in du_sens if e['correction'] and e['id'] > retenu['id']]
+        statut = next((e['statut'] for e in reversed(suivants) if e['statut'] is not None), None)
+        retenus[sens] = (retenu, motif, statut)
+
+    notes = next((e['notes'] for e in reversed(evenements) if e['notes'] is not None), None)
+    return retenus, notes
+
+def _deriver_pointages(cur, cles):
+    """Reconstruit depuis punch_events les lignes pointages des (personnel_id, date_shift) donnés.
+
+    Exécuté dans la transaction d'écriture ouverte : UPSERT de la ligne, retard
+    resynchronisé, absence automatique ajoutée si l'arrivée la déclenche, ligne
+    supprimée si ses événements sont annulés. Retourne {clé: ligne dérivée (dict)
+    ou None}.
+    """
+    cles = sorted({(int(personnel_id), str(jour)) for personnel_id, jour in cles})
+    if not cles:
+        return {}
+    paires = json.dumps([list(cle) for cle in cles])
+    cur.execute(SQL_EVENEMENTS_CLES, (paires,))
+    evenements = {}
+    for e in cur.fetchall():
+        evenements.setdefault((e['personnel_id'], str(e['date_shift'])), []).append(e)
+    cur.execute(SQL_HORAIRES_POINTAGE, (paires,))
+    horaires = {cles[row['rang']]: row for row in cur.fetchall()}
+    version_regles = get_version_regles(cur)
+
+    derives = {}
+    lignes, retards, absences = [], [], []
+    for cle in cles:
+        horaire = horaires.get(cle)
+        resolution = _retenir_evenements(evenements.get(cle, []))
+        if horaire is None or resolution is None:
+            derives[cle] = None
+            continue
+        retenus, notes = resolution
+        regle = regle_pointage(horaire['service'], horaire['poste'], cle[1], version_regles, cur)
+        # Sens sans événement : valeurs par défaut de la table
+        ligne = {
+            'heure_arrivee': None, 'statut_arrivee': 'Present', 'retard_minutes': 0, 'motif_retard': None,
+            'heure_depart': None, 'statut_depart': 'Present', 'depart_avance_minutes': 0, 'motif_depart_avance': None,
+            'notes': notes,
+        }
+        if 'arrivee' in retenus:
+            evenement, motif, statut = retenus['arrivee']
+            heure_str, statut_calcule, retard_minutes, motif_absence = _calculer_arrivee(
+                horaire, evenement['heure'], motif, evenement['est_absent'], regle
+            )
+            ligne.update(heure_arrivee=heure_str, statut_arrivee=statut or statut_calcule,
+                         retard_minutes=retard_minutes, motif_retard=motif)
+            if motif_absence is not None:
+                absences.append((cle[0], cle[1], motif_absence, False))
+            # Enregistrer le retard si applicable : sous le seuil d'absence de la règle
+            # (sans seuil : pas de borne), c'est-à-dire arrivée classée 'En retard'
+            if retard_minutes > 0 and statut_calcule == "En retard":
+                motif_retard = "Retard modifié manuellement" if evenement['correction'] and not motif else motif
+                retards.append((cle[0], cle[1], retard_minutes, motif_retard))
+        if 'depart' in retenus:
+            evenement, motif, _ = retenus['depart']
+            heure_str, statut_depart, avance_minutes = _calculer_depart(horaire, evenement['heure'], regle)
+            ligne.update(heure_depart=heure_str, statut_depart=statut_depart,
+                         depart_avance_minutes=avance_minutes, motif_depart_avance=motif)
+        lignes.append(cle + tuple(ligne.values()))
+        derives[cle] = ligne
+
+    # Lignes annulées supprimées, retards de toutes les clés resynchronisés
+    annulees = [cle for cle in cles if derives[cle] is None and cle in horaires]
+    cur.executemany("DELETE FROM pointages WHERE personnel_id = ? AND date_pointage = ?", annulees)
+    cur.executemany("DELETE FROM retards WHERE personnel_id = ? AND date_retard = ?", [cle for cle in cles if cle in horaires])
+    cur.executemany(SQL_UPSERT_POINTAGE_DERIVE, lignes)
+    cur.executemany("INSERT INTO retards (personnel_id, date_retard, retard_minutes, motif) VALUES (?, ?, ?, ?)", retards)
+    cur.executemany(SQL_INSERT_ABSENCE_AUTO, absences)
+    return derives
+
+def _calculer_arrivee(horaire, heure_arrivee, motif_retard, est_absent, regle):
+    """Statut, retard et absence éventuelle d'une arrivée selon l'horaire de l'employé et sa règle"""
+    heure_prevue = _as_time(horaire['heure_entree_prevue'])
+    heure_arrivee_time = _as_time(heure_arrivee)
+
+    statut_arrivee, retard_minutes, est_absent_calc = calculer_statut_arrivee(heure_arrivee_time, heure_prevue, regle)
+
+    motif_absence = None
+    if est_absent or est_absent_calc:
+        motif_absence = motif_retard or f"Absence automatique (retard de {retard_minutes} minutes)"
+        # Le pointage est quand même enregistré avec le statut "Absent"
+        statut_arrivee = "Absent"
+
+    return heure_arrivee_time.strftime('%H:%M:%S'), statut_arrivee, retard_minutes, motif_absence
+
+def _calculer_depart(horaire, heure_depart, regle):
+    """Statut et minutes de départ anticipé selon l'heure de sortie prévue et la règle"""
+    heure_depart_str = heure_depart.strftime('%H:%M:%S') if isinstance(heure_depart, tm) else str(heure_depart)
+    statut_depart, depart_avance_minutes = calculer_statut_depart(
+        heure_depart, horaire['heure_sortie_prevue'], regle, _as_time(horaire['heure_entree_prevue'])
+    )
+    return heure_depart_str, statut_depart, depart_avance_minutes
+
+def _ecrire_pointages(cur, pointages, rattacher=True):
+    """Corps de enregistrer_pointages_lot(), exécuté dans la transaction d'écriture ouverte.
+
+    Les pointages acceptés sont ajoutés au journal puis leurs lignes pointages dérivées.
+    """
+    if rattacher:
+        # Chaque pointage est écrit sur la ligne de son shift (départ après minuit : la veille)
+        pointages = [
+            dict(p, date_pointage=jour, horodatage=_horodatage_pointage(p))
+            for p, jour in zip(pointages, _rattacher_pointages(cur, pointages))
+        ]
+    paires = json.dumps([[int(p['personnel_id']), str(p['date_pointage'])] for p in pointages])
+    resultats = [None] * len(pointages)
+
+    # Lecture des horaires dans la même transaction que les écritures
+    cur.execute(SQL_HORAIRES_POINTAGE, (paires,))
+    horaires = {row['rang']: row for row in cur.fetchall()}
+
+    acceptes = []
+    for rang, p in enumerate(pointages):
+        horaire = horaires.get(rang)
+        if horaire is None:
+            resultats[rang] = (False, 0, POINTAGE_EMPLOYE_INCONNU)
+        elif horaire['en_conge']:
+            resultats[rang] = (False, 0, POINTAGE_EN_CONGE)
+        else:
+            acceptes.append(rang)
+
+    cur.executemany(SQL_INSERT_EVENEMENT, [
+        _evenement(
+            pointages[rang]['personnel_id'], pointages[rang]['date_pointage'],
+            pointages[rang].get('horodatage') or _horodatage_pointage(pointages[rang]),
+            pointages[rang]['sens'], pointages[rang]['heure'], motif=pointages[rang].get('motif'),
+            notes=pointages[rang].get('notes'), est_absent=pointages[rang].get('est_absent', False),
+        )
+        for rang in acceptes
+    ])
+    derives = _deriver_pointages(cur, [(pointages[rang]['personnel_id'], pointages[rang]['date_pointage']) for rang in acceptes])
+
+    for rang in acceptes:
+        p = pointages[rang]
+        ligne = derives[(int(p['personnel_id']), str(p['date_pointage']))]
+        minutes = ligne['retard_minutes'] if p['sens'] == 'arrivee' else ligne['depart_avance_minutes']
+        resultats[rang] = (True, minutes, None)
+    return resultats
+
+def enregistrer_pointages_lot(pointages, rattacher=True):
+    """Enregistre un lot d'arrivées/départs dans une seule transaction.
+
+    Chaque pointage est un dict : personnel_id, date_pointage, sens ('arrivee'
+    ou 'depart'), heure, et optionnellement motif, notes, est_absent.
+    Avec rattacher, date_pointage et heure sont l'horodatage du pointage, écrit
+    sur la ligne du shift auquel il appartient ; sinon date_pointage est déjà
+    la date du shift (horodatage, datetime optionnel, garde alors l'instant réel).
+    Chaque pointage accepté est ajouté à punch_events, la ligne pointages en est dérivée.
+    Retourne, dans l'ordre du lot, des tuples (succes, minutes, erreur) où
+    minutes est le retard ou le départ anticipé et erreur None ou un motif
+    POINTAGE_*.
+    """
+    pointages = list(pointages)
+    if not pointages:
+        return []
+
+    try:
+        return executer_ecriture(lambda cur: _ecrire_pointages(cur, pointages, rattacher))
+    except Exception as e:
+        st.error(f"Erreur enregistrement des pointages: {e}")
+        return [(False, 0, str(e))] * len(pointages)
 
 def enregistrer_pointage_depart(personnel_id, date_pointage, heure_depart, motif_depart_avance=None, notes=None):
-    # Vérifier si l'employé est en congé
-    if est_en_conge(personnel_id, date_pointage):
+    """Enregistre un départ : une lecture de l'horaire et du congé puis un UPSERT, dans une transaction"""
+    succes, depart_avance_minutes, erreur = enregistrer_pointages_lot([{
+        'personnel_id': personnel_id,
+        'date_pointage': date_pointage,
+        'sens': 'depart',
+        'heure': heure_depart,
+        'motif': motif_depart_avance,
+        'notes': notes,
+    }])[0]
+    if erreur == POINTAGE_EN_CONGE:
         st.error("❌ Cet employé est en congé aujourd'hui. Pointage impossible.")
-        return False, 0
-    
+    return succes, depart_avance_minutes
+
+# (employé, shift) ayant des événements sur une période, hors mois archivés
+SQL_CLES_EVENEMENTS_PERIODE = enregistrer_requete("cles_evenements_periode", """
+    SELECT DISTINCT e.personnel_id, e.date_shift
+    FROM punch_events e
+    WHERE e.date_shift BETWEEN ? AND ?
+    AND strftime('%Y-%m', e.date_shift) NOT IN (SELECT mois FROM archives_mensuelles)
+""")
+
+def reconstruire_pointages(date_debut, date_fin, progression=None):
+    """Redérive depuis punch_events les pointages d'une période, par tranches de REEVALUATION_JOURS_PAR_LOT jours.
+
+    Les lignes sont recalculées avec les règles en vigueur ; les mois archivés et les
+    lignes sans événement ne sont pas modifiés. progression(fraction) est appelé après
+    chaque tranche. Retourne le nombre de lignes dérivées, None en cas d'erreur.
+    """
+    def reconstruire(cur, debut_lot, fin_lot):
+        cur.execute(SQL_CLES_EVENEMENTS_PERIODE, (debut_lot, fin_lot))
+        return len(_deriver_pointages(cur, [tuple(row) for row in cur.fetchall()]))
+
+    nb_jours = (date_fin - date_debut).days + 1
+    derivees = 0
+    for decalage in range(0, max(nb_jours, 0), REEVALUATION_JOURS_PAR_LOT):
+        debut_lot = date_debut + timedelta(days=decalage)
+        fin_lot = min(debut_lot + timedelta(days=REEVALUATION_JOURS_PAR_LOT - 1), date_fin)
+        try:
+            derivees += executer_ecriture(lambda cur: reconstruire(cur, debut_lot, fin_lot))
+        except Exception as e:
+            st.error(f"Erreur reconstruction des pointages du {debut_lot} au {fin_lot}: {e}")
+            return None
+        if progression is not None:
+            progression(min((decalage + REEVALUATION_JOURS_PAR_LOT) / nb_jours, 1.0))
+    return derivees
+
+SQL_RESUME_EVENEMENTS = enregistrer_requete("resume_evenements", """
+    SELECT e.source, e.sens, COUNT(*) AS evenements, MIN(e.date_shift) AS premier_shift, MAX(e.date_shift) AS dernier_shift
+    FROM punch_events e
+    GROUP BY e.source, e.sens
+    ORDER BY e.source, e.sens
+""")
+
+def get_resume_evenements():
+    """Nombre d'événements du journal des pointages par source et par sens"""
     conn = get_connection()
     if conn is None:
-        return False, 0
+        return pd.DataFrame()
     try:
-        personnel_id = int(personnel_id)
-        
-        with conn:
-            cur = conn.cursor()
-            # Heure de sortie prévue
-            cur.execute("SELECT heure_sortie_prevue FROM personnels WHERE id = ?", (personnel_id,))
-            res = cur.fetchone()
-            if not res:
-                return False, 0
-            heure_sortie_prevue = _as_time(res['heure_sortie_prevue'])
-
-            # Calcul départ en avance
-            depart_avance_minutes = 0
-            statut_depart = "Present"
-            
-            # Convertir l'heure en string pour SQLite
-            heure_depart_str = heure_depart.strftime('%H:%M:%S') if isinstance(heure_depart, tm) else str(heure_depart)
-            
-            # Calculer la différence en minutes
-            heure_depart_time = _as_time(heure_depart)
-            heure_sortie_prevue_time = _as_time(heure_sortie_prevue)
-            
-            dt_depart = datetime.combine(date.today(), heure_depart_time)
-            dt_sortie_prevue = datetime.combine(date.today(), heure_sortie_prevue_time)
-            
-            delta_minutes = (dt_sortie_prevue - dt_depart).total_seconds() / 60
-            
-            # Départ en avance seulement si plus de 5 minutes
-            if delta_minutes > 5:
-                depart_avance_minutes = int(delta_minutes)
-                statut_depart = "Départ anticipé"
-
-            # Vérifier si un pointage existe déjà pour cette journée
-            cur.execute(
-                "SELECT id FROM pointages WHERE personnel_id = ? AND date_pointage = ?",
-                (personnel_id, date_pointage)
-            )
-            existing = cur.fetchone()
-
-            if existing:
-                # Mettre à jour le départ
-                cur.execute(
-                    """
-                    UPDATE pointages 
-                    SET heure_depart = ?, statut_depart = ?, depart_avance_minutes = ?, 
-                        motif_depart_avance = ?, notes = COALESCE(?, notes)
-                    WHERE id = ?
-                    """,
-                    (heure_depart_str, statut_depart, depart_avance_minutes, motif_depart_avance, notes, existing['id'])
-                )
-            else:
-                # Nouveau pointage (cas rare où on pointerait le départ sans l'arrivée)
-                cur.execute(
-                    """
-                    INSERT INTO pointages (personnel_id, date_pointage, heure_depart, statut_depart, depart_avance_minutes, motif_depart_avance, notes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (personnel_id, date_pointage, heure_depart_str, statut_depart, depart_avance_minutes, motif_depart_avance, notes),
-                )
-        return True, depart_avance_minutes
+        return pd.read_sql_query(SQL_RESUME_EVENEMENTS, conn)
     except Exception as e:
-        st.error(f"Erreur enregistrement pointage départ: {e}")
-        return False, 0
+        st.error(f"Erreur lecture du journal des pointages: {e}")
+        return pd.DataFrame()
     finally:
         if conn:
             conn.close()
 
+SQL_POINTAGES_PERIODE = enregistrer_requete("pointages_periode", """
+    SELECT pt.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
+           pt.date_pointage, pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart, 
+           pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+    ORDER BY pt.date_pointage DESC, p.nom, p.prenom
+""")
+
 def get_pointages_periode(date_debut, date_fin):
     conn = get_connection()
     if conn is None:
         return pd.DataFrame()
     try:
-        return pd.read_sql_query(
-            """
-            SELECT pt.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
-                   pt.date_pointage, pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart, 
-                   pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes
-            FROM pointages pt
-            JOIN personnels p ON pt.personnel_id = p.id
-            WHERE pt.date_pointage BETWEEN ? AND ?
-            ORDER BY pt.date_pointage DESC, p.nom, p.prenom
-            """,
+        df = pd.read_sql_query(
+            SQL_POINTAGES_PERIODE,
             conn,
             params=(date_debut, date_fin),
         )
+        # Les mois archivés sont lus dans leurs partitions Parquet
+        return ajouter_archives(df, 'pointages', date_debut, date_fin, ['date_pointage', 'nom', 'prenom'], [False, True, True])
     except Exception as e:
         st.error(f"Erreur récupération pointages: {e}")
         return pd.DataFrame()
     finally:
         if conn:
             conn.close()
+SQL_RETARDS_PERIODE = enregistrer_requete("retards_periode", """
+    SELECT p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
+           r.date_retard, r.retard_minutes, r.motif, r.created_at
+    FROM retards r
+    JOIN personnels p ON r.personnel_id = p.id
+    WHERE r.date_retard BETWEEN ? AND ?
+    ORDER BY r.date_retard DESC, r.retard_minutes DESC
+""")
+
 def get_retards_periode(date_debut, date_fin):
     conn = get_connection()
     if conn is None:
         return pd.DataFrame()
     try:
-        return pd.read_sql_query(
-            """
-            SELECT p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
-                   r.date_retard, r.retard_minutes, r.motif, r.created_at
-            FROM retards r
-            JOIN personnels p ON r.personnel_id = p.id
-            WHERE r.date_retard BETWEEN ? AND ?
-            ORDER BY r.date_retard DESC, r.retard_minutes DESC
-            """,
+        df = pd.read_sql_query(
+            SQL_RETARDS_PERIODE,
             conn,
             params=(date_debut, date_fin),
         )
+        return ajouter_archives(df, 'retards', date_debut, date_fin, ['date_retard', 'retard_minutes'], [False, False])
     except Exception as e:
         st.error(f"Erreur récupération retards: {e}")
         return pd.DataFrame()
@@ -1252,6 +3173,23 @@ def get_retards_periode(date_debut, date_fin):
         if conn:
             conn.close()
 
+# Attendus du jour (shifts_prevus, hors congé) sans arrivée, avec leur absence
+# éventuellement déjà enregistrée. Paramètre : date.
+SQL_ABSENCES_DU_JOUR = enregistrer_requete("absences_du_jour", """
+    SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
+           a.motif, a.justifie, a.created_at
+    FROM shifts_prevus s
+    JOIN personnels p ON p.id = s.personnel_id
+    LEFT JOIN absences a ON a.personnel_id = s.personnel_id AND a.date_absence = s.date_shift
+    WHERE s.date_shift = ? AND s.type_shift <> 'Congé'
+    AND NOT EXISTS (
+        SELECT 1 FROM pointages pt
+        WHERE pt.personnel_id = s.personnel_id AND pt.date_pointage = s.date_shift
+        AND pt.heure_arrivee IS NOT NULL
+    )
+    ORDER BY p.nom, p.prenom
+""")
+
 def get_absences_du_jour():
     """Récupère les absences du jour en excluant les groupes de nuit non actifs et les nuitiers qui pointent de jour"""
     conn = get_connection()
@@ -1259,56 +3197,12 @@ def get_absences_du_jour():
         return pd.DataFrame()
     
     try:
-        # Construire la requête pour exclure les groupes de nuit non actifs
-        services_nuit = get_services_nuit()
-        conditions = []
-        
-        for service in services_nuit:
-            groupe_actif = get_groupe_nuit_actif_service(service)
-            conditions.append(f"(p.service = '{service}' AND p.poste = 'Nuit' AND p.groupe_nuit = '{groupe_actif}')")
-        
-        query = """
-            SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
-                   a.motif, a.justifie, a.created_at
-            FROM personnels p
-            LEFT JOIN absences a ON p.id = a.personnel_id AND a.date_absence = ?
-            WHERE p.actif = 1 
-            AND (
-                p.poste = 'Jour' 
-                OR p.poste = 'Mixte'
-        """
-        
-        if conditions:
-            query += " OR " + " OR ".join(conditions)
-        
-        query += """
-            )
-            AND p.id NOT IN (
-                SELECT personnel_id FROM pointages WHERE date_pointage = ? AND heure_arrivee IS NOT NULL
-            )
-            AND p.id NOT IN (
-                SELECT personnel_id FROM conges 
-                WHERE statut = 'Approuvé' 
-                AND date_debut <= ? 
-                AND date_fin >= ?
-            )
-            -- Exclure les employés de nuit qui ont pointé de jour
-            AND NOT (
-                p.poste = 'Nuit' 
-                AND p.id IN (
-                    SELECT personnel_id FROM pointages 
-                    WHERE date_pointage = ? 
-                    AND heure_arrivee IS NOT NULL
-                    AND strftime('%H:%M', heure_arrivee) BETWEEN '06:00' AND '18:00'
-                )
-            )
-            ORDER BY p.nom, p.prenom
-        """
+        query = SQL_ABSENCES_DU_JOUR
         
         return pd.read_sql_query(
             query,
             conn,
-            params=(date.today(), date.today(), date.today(), date.today(), date.today()),
+            params=(date.today(),),
         )
     except Exception as e:
         st.error(f"Erreur récupération absences du jour: {e}")
@@ -1317,113 +3211,706 @@ def get_absences_du_jour():
         if conn:
             conn.close()
 
+SQL_ABSENCES_PERIODE = enregistrer_requete("absences_periode", """
+    SELECT a.id, a.date_absence, p.nom, p.prenom, p.service, p.poste, 
+           p.heure_entree_prevue, a.motif, a.justifie, 
+           a.certificat_sha256 IS NOT NULL as has_certificat,
+           a.created_at
+    FROM absences a
+    JOIN personnels p ON a.personnel_id = p.id
+    WHERE a.date_absence BETWEEN ? AND ?
+    ORDER BY a.date_absence DESC, p.nom, p.prenom
+""")
+
 def get_absences_periode(date_debut, date_fin):
     """Récupère les absences avec l'ID correct"""
     conn = get_connection()
     if conn is None:
-        return pd.DataFrame()
+        return pd.DataFrame()
+    try:
+        df = pd.read_sql_query(
+            SQL_ABSENCES_PERIODE,
+            conn,
+            params=(date_debut, date_fin),
+        )
+        return ajouter_archives(df, 'absences', date_debut, date_fin, ['date_absence', 'nom', 'prenom'], [False, True, True])
+    except Exception as e:
+        st.error(f"Erreur récupération absences: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+# Temps travaillé d'un pointage en minutes (NULL sans arrivée ou sans départ) : un
+# départ antérieur à l'arrivée est celui du lendemain, pour un shift qui passe minuit
+SQL_DUREE_TRAVAIL = """
+    CAST(round((julianday(pt.heure_depart) - julianday(pt.heure_arrivee)) * 1440
+               + CASE WHEN time(pt.heure_depart) < time(pt.heure_arrivee) THEN 1440 ELSE 0 END) AS INTEGER)
+"""
+
+# Export des pointages : en-têtes d'affichage, ordre de l'historique
+SQL_EXPORT_POINTAGES = enregistrer_requete("export_pointages", f"""
+    SELECT p.nom AS "Nom", p.prenom AS "Prénom", p.service AS "Service", pt.date_pointage AS "Date",
+           pt.heure_arrivee AS "Heure Arrivée", pt.heure_depart AS "Heure Départ",
+           pt.statut_arrivee AS "Statut Arrivée", pt.statut_depart AS "Statut Départ",
+           pt.retard_minutes AS "Retard (min)", {SQL_DUREE_TRAVAIL} AS "Temps travaillé (min)",
+           pt.motif_retard AS "Motif"
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+    ORDER BY pt.date_pointage DESC, p.nom, p.prenom, pt.id
+""")
+
+SQL_EXPORT_PERSONNEL = enregistrer_requete("export_personnel", """
+    SELECT id, nom, prenom, service, poste, heure_entree_prevue, heure_sortie_prevue, groupe_nuit, actif
+    FROM personnels
+    WHERE actif = 1
+    ORDER BY nom, prenom
+""")
+
+# Exports d'une période qui couvrent aussi les mois archivés : table archivée, colonnes
+# des partitions dans l'ordre des en-têtes (None : mêmes noms), tri de l'export
+ARCHIVES_EXPORT = {
+    'pointages': (
+        'pointages',
+        ['nom', 'prenom', 'service', 'date_pointage', 'heure_arrivee', 'heure_depart', 'statut_arrivee',
+         'statut_depart', 'retard_minutes', 'duree_travail_minutes', 'motif_retard'],
+        ['Date', 'Nom', 'Prénom'], [False, True, True],
+    ),
+    'retards': ('retards', None, ['date_retard', 'retard_minutes'], [False, False]),
+    'absences': ('absences', None, ['date_absence', 'nom', 'prenom'], [False, True, True]),
+}
+
+# --- Historique paginé par clé (keyset) ---
+# Chaque page reprend après la dernière ligne affichée (pas d'OFFSET) : seule la
+# page courante est lue et gardée en mémoire. Paramètres communs : date début,
+# borne haute (date du curseur ou date fin), date du curseur (ou date fin + 1 jour
+# pour la première page), reste de la clé du curseur, taille de page + 1.
+SQL_PAGE_POINTAGES = enregistrer_requete("page_pointages", f"""
+    SELECT pt.id, pt.personnel_id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
+           pt.date_pointage, pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart,
+           pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes,
+           {SQL_DUREE_TRAVAIL} AS duree_travail_minutes
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+    AND (pt.date_pointage < ? OR (p.nom, p.prenom, pt.id) > (?, ?, ?))
+    ORDER BY pt.date_pointage DESC, p.nom, p.prenom, pt.id
+    LIMIT ?
+""")
+
+SQL_PAGE_RETARDS = enregistrer_requete("page_retards", """
+    SELECT r.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
+           r.date_retard, r.retard_minutes, r.motif, r.created_at
+    FROM retards r
+    JOIN personnels p ON r.personnel_id = p.id
+    WHERE r.date_retard BETWEEN ? AND ?
+    AND (r.date_retard < ? OR (r.retard_minutes, r.id) < (?, ?))
+    ORDER BY r.date_retard DESC, r.retard_minutes DESC, r.id DESC
+    LIMIT ?
+""")
+
+SQL_PAGE_ABSENCES = enregistrer_requete("page_absences", """
+    SELECT a.id, a.date_absence, p.nom, p.prenom, p.service, p.poste,
+           p.heure_entree_prevue, a.motif, a.justifie,
+           a.certificat_sha256 IS NOT NULL as has_certificat,
+           a.created_at
+    FROM absences a
+    JOIN personnels p ON a.personnel_id = p.id
+    WHERE a.date_absence BETWEEN ? AND ?
+    AND (a.date_absence < ? OR (p.nom, p.prenom, a.id) > (?, ?, ?))
+    ORDER BY a.date_absence DESC, p.nom, p.prenom, a.id
+    LIMIT ?
+""")
+
+# Liste (nom de la table archivée) -> (requête de page, colonnes de la clé du curseur, sens croissant)
+PAGES_HISTORIQUE = {
+    'pointages': (SQL_PAGE_POINTAGES, ('date_pointage', 'nom', 'prenom', 'id'), (False, True, True, True)),
+    'retards': (SQL_PAGE_RETARDS, ('date_retard', 'retard_minutes', 'id'), (False, False, False)),
+    'absences': (SQL_PAGE_ABSENCES, ('date_absence', 'nom', 'prenom', 'id'), (False, True, True, True)),
+}
+
+def _apres_curseur(df, cle, croissant, curseur):
+    """Masque des lignes strictement après le curseur dans l'ordre de la clé (comparaison lexicographique)"""
+    apres = pd.Series(False, index=df.index)
+    egal = pd.Series(True, index=df.index)
+    for colonne, sens, valeur in zip(cle, croissant, curseur):
+        apres |= egal & ((df[colonne] > valeur) if sens else (df[colonne] < valeur))
+        egal &= df[colonne] == valeur
+    return apres
+
+def _page_archives(liste, colonnes, date_debut, borne, curseur, nombre):
+    """Premières lignes archivées après le curseur, aux colonnes de la page.
+
+    Les mois archivés sont lus du plus récent au plus ancien, et seulement jusqu'à
+    en avoir assez pour la page : les suivants viennent après dans l'ordre de la liste.
+    """
+    _, cle, croissant = PAGES_HISTORIQUE[liste]
+    lignes, total = [], 0
+    if pyarrow is None:
+        return lignes
+    for mois in reversed(get_mois_archives(date_debut, borne)):
+        debut_mois, fin_mois = _bornes_mois(*(int(partie) for partie in mois.split('-')))
+        df = lire_archives(liste, max(debut_mois, date_debut), min(fin_mois, borne))
+        if df.empty:
+            continue
+        df = preparer_archives(liste, df)
+        if curseur is not None:
+            df = df[_apres_curseur(df, cle, croissant, curseur)]
+        lignes.append(df[colonnes])
+        total += len(df)
+        if total >= nombre:
+            break
+    return lignes
+
+def get_page_historique(liste, date_debut, date_fin, curseur=None, taille=100):
+    """Lit une page de l'historique après le curseur; retourne (DataFrame, curseur de la page suivante ou None)
+
+    Les lignes des mois archivés sont fusionnées dans l'ordre de la clé et
+    signalées par la colonne 'archive' (elles ne sont plus modifiables).
+    """
+    sql, cle, croissant = PAGES_HISTORIQUE[liste]
+    if curseur is None:
+        # Première page : la condition sur le curseur est toujours vraie
+        params = (date_debut, date_fin, date_fin + timedelta(days=1)) + (None,) * (len(cle) - 1)
+        borne = date_fin
+    else:
+        params = (date_debut, curseur[0], curseur[0]) + tuple(curseur[1:])
+        borne = date.fromisoformat(str(curseur[0])[:10])
+
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame(), None
+    try:
+        # Une ligne de plus que la page pour savoir s'il en reste
+        df = pd.read_sql_query(sql, conn, params=params + (taille + 1,))
+        archives = _page_archives(liste, list(df.columns), date_debut, borne, curseur, taille + 1)
+        df = df.assign(archive=False)
+        if archives:
+            df = pd.concat([df] + [a.assign(archive=True) for a in archives], ignore_index=True).infer_objects()
+            df = df.sort_values(list(cle), ascending=list(croissant), ignore_index=True).iloc[:taille + 1]
+        if len(df) <= taille:
+            return df, None
+        df = df.iloc[:taille]
+        # to_dict convertit les scalaires numpy en types Python, liables par sqlite3
+        dernier = df.iloc[-1:][list(cle)].to_dict('records')[0]
+        return df, tuple(dernier[c] for c in cle)
+    except Exception as e:
+        st.error(f"Erreur récupération {liste}: {e}")
+        return pd.DataFrame(), None
+    finally:
+        if conn:
+            conn.close()
+
+SQL_TOTAUX_POINTAGES = enregistrer_requete("totaux_pointages", """
+    SELECT COUNT(*) as total,
+           COALESCE(SUM(pt.retard_minutes > 0), 0) as retards,
+           COALESCE(SUM(pt.statut_arrivee = 'Absent'), 0) as absences
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+""")
+
+SQL_TOTAUX_RETARDS = enregistrer_requete("totaux_retards", """
+    SELECT p.service, COUNT(*) as total, SUM(r.retard_minutes) as retard_minutes
+    FROM retards r
+    JOIN personnels p ON r.personnel_id = p.id
+    WHERE r.date_retard BETWEEN ? AND ?
+    GROUP BY p.service
+""")
+
+SQL_TOTAUX_ABSENCES = enregistrer_requete("totaux_absences", """
+    SELECT COUNT(*) as total, COALESCE(SUM(a.justifie = 1), 0) as justifiees
+    FROM absences a
+    JOIN personnels p ON a.personnel_id = p.id
+    WHERE a.date_absence BETWEEN ? AND ?
+""")
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _totaux_historique(db_path, date_debut, date_fin, version):
+    """Mémoïse par (base, période, version des données) les compteurs de l'historique"""
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError(f"Connexion impossible à {db_path}")
+    try:
+        params = (date_debut, date_fin)
+        pointages = conn.execute(SQL_TOTAUX_POINTAGES, params).fetchone()
+        absences = conn.execute(SQL_TOTAUX_ABSENCES, params).fetchone()
+        retards_par_service = pd.read_sql_query(SQL_TOTAUX_RETARDS, conn, params=params)
+        totaux = {
+            'pointages': pointages['total'],
+            'pointages_retard': pointages['retards'],
+            'pointages_absent': pointages['absences'],
+            'absences': absences['total'],
+            'absences_justifiees': absences['justifiees'],
+        }
+    finally:
+        conn.close()
+
+    # Mêmes compteurs sur les mois archivés de la période
+    archives = lire_archives('pointages', date_debut, date_fin)
+    if not archives.empty:
+        totaux['pointages'] += len(archives)
+        totaux['pointages_retard'] += int((archives['retard_minutes'] > 0).sum())
+        totaux['pointages_absent'] += int((archives['statut_arrivee'] == 'Absent').sum())
+    archives = lire_archives('absences', date_debut, date_fin)
+    if not archives.empty:
+        totaux['absences'] += len(archives)
+        totaux['absences_justifiees'] += int((archives['justifie'] == 1).sum())
+    archives = lire_archives('retards', date_debut, date_fin)
+    if not archives.empty:
+        retards_archives = archives.groupby('service', as_index=False).agg(
+            total=('retard_minutes', 'size'), retard_minutes=('retard_minutes', 'sum')
+        )
+        retards_par_service = (
+            pd.concat([retards_par_service, retards_archives], ignore_index=True)
+            .groupby('service', as_index=False)[['total', 'retard_minutes']].sum()
+            .astype({'total': int, 'retard_minutes': int})
+        )
+    totaux['retards'] = int(retards_par_service['total'].sum())
+    totaux['retard_minutes'] = int(retards_par_service['retard_minutes'].sum())
+    totaux['retards_par_service'] = retards_par_service
+    return totaux
+
+def get_totaux_historique(date_debut, date_fin):
+    """Compteurs de l'historique sur la période (COUNT en base, sans charger les lignes, plus les mois archivés)"""
+    version = get_version_donnees()
+    if version is None:
+        return None
+    try:
+        return _totaux_historique(DB_PATH, date_debut, date_fin, version)
+    except Exception as e:
+        st.error(f"Erreur comptage historique: {e}")
+        return None
+
+# Statistiques d'un mois ('AAAA-MM') lues dans le cumul tenu à jour par triggers
+SQL_STATS_MENSUELLES = enregistrer_requete("stats_mensuelles", """
+    SELECT 
+        p.nom, p.prenom, p.service,
+        COALESCE(s.jours_presents, 0) as jours_presents,
+        COALESCE(s.jours_retard, 0) as jours_retard,
+        COALESCE(s.jours_depart_anticipe, 0) as jours_depart_anticipé,
+        COALESCE(s.total_retard_minutes, 0) as total_retard_minutes,
+        COALESCE(s.total_depart_avance_minutes, 0) as total_depart_avance_minutes,
+        COALESCE(s.absences, 0) as absences
+    FROM personnels p
+    LEFT JOIN stats_mensuelles_employes s ON s.personnel_id = p.id AND s.mois = ?
+    WHERE p.actif = 1
+    ORDER BY p.nom, p.prenom
+""")
+
+def get_stats_mensuelles(mois=None):
+    """Statistiques par employé actif pour un mois 'AAAA-MM' (mois en cours par défaut)"""
+    if mois is None:
+        mois = date.today().strftime('%Y-%m')
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query(
+            SQL_STATS_MENSUELLES,
+            conn,
+            params=(mois,),
+        )
+    except Exception as e:
+        st.error(f"Erreur stats mensuelles: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+def get_mois_stats_disponibles():
+    """Mois présents dans le cumul, du plus récent au plus ancien"""
+    conn = get_connection()
+    if conn is None:
+        return []
+    try:
+        cur = conn.execute("SELECT DISTINCT mois FROM stats_mensuelles_employes ORDER BY mois DESC")
+        return [row['mois'] for row in cur.fetchall()]
+    except Exception as e:
+        st.error(f"Erreur lecture des mois disponibles: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+# Recalcul du cumul depuis les lignes en base, entre deux dates (mois entiers)
+SQL_CUMUL_POINTAGES = enregistrer_requete("cumul_pointages", """
+    INSERT INTO stats_mensuelles_employes
+        (mois, personnel_id, jours_presents, jours_retard, jours_depart_anticipe,
+         total_retard_minutes, total_depart_avance_minutes)
+    SELECT substr(date_pointage, 1, 7), personnel_id, COUNT(*),
+           SUM(IFNULL(statut_arrivee = 'En retard', 0)),
+           SUM(IFNULL(statut_depart = 'Départ anticipé', 0)),
+           SUM(MAX(IFNULL(retard_minutes, 0), 0)),
+           SUM(IFNULL(depart_avance_minutes, 0))
+    FROM pointages
+    WHERE date_pointage BETWEEN ? AND ? AND personnel_id IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT (mois, personnel_id) DO UPDATE SET
+        jours_presents = jours_presents + excluded.jours_presents,
+        jours_retard = jours_retard + excluded.jours_retard,
+        jours_depart_anticipe = jours_depart_anticipe + excluded.jours_depart_anticipe,
+        total_retard_minutes = total_retard_minutes + excluded.total_retard_minutes,
+        total_depart_avance_minutes = total_depart_avance_minutes + excluded.total_depart_avance_minutes
+""")
+
+SQL_CUMUL_ABSENCES = enregistrer_requete("cumul_absences", """
+    INSERT INTO stats_mensuelles_employes (mois, personnel_id, absences)
+    SELECT substr(date_absence, 1, 7), personnel_id, COUNT(*)
+    FROM absences
+    WHERE date_absence BETWEEN ? AND ? AND personnel_id IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT (mois, personnel_id) DO UPDATE SET absences = absences + excluded.absences
+""")
+
+# Contribution des mois archivés, une ligne par (mois, personnel_id) issue de _cumul_archives
+SQL_CUMUL_ARCHIVES = """
+    INSERT INTO stats_mensuelles_employes
+        (mois, personnel_id, jours_presents, jours_retard, jours_depart_anticipe,
+         total_retard_minutes, total_depart_avance_minutes, absences)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (mois, personnel_id) DO UPDATE SET
+        jours_presents = jours_presents + excluded.jours_presents,
+        jours_retard = jours_retard + excluded.jours_retard,
+        jours_depart_anticipe = jours_depart_anticipe + excluded.jours_depart_anticipe,
+        total_retard_minutes = total_retard_minutes + excluded.total_retard_minutes,
+        total_depart_avance_minutes = total_depart_avance_minutes + excluded.total_depart_avance_minutes,
+        absences = absences + excluded.absences
+"""
+
+def _cumul_archives(date_debut, date_fin):
+    """Contribution des mois archivés au cumul, calculée sur les partitions Parquet"""
+    pointages = lire_archives('pointages', date_debut, date_fin)
+    absences = lire_archives('absences', date_debut, date_fin)
+    frames = []
+    if not pointages.empty:
+        frames.append(pointages.assign(
+            mois=pointages['date_pointage'].str[:7],
+            jours_presents=1,
+            jours_retard=(pointages['statut_arrivee'] == 'En retard').astype(int),
+            jours_depart_anticipe=(pointages['statut_depart'] == 'Départ anticipé').astype(int),
+            total_retard_minutes=pd.to_numeric(pointages['retard_minutes']).fillna(0).clip(lower=0).astype(int),
+            total_depart_avance_minutes=pd.to_numeric(pointages['depart_avance_minutes']).fillna(0).astype(int),
+        ))
+    if not absences.empty:
+        frames.append(absences.assign(mois=absences['date_absence'].str[:7], absences=1))
+    if not frames:
+        return []
+
+    colonnes = ['jours_presents', 'jours_retard', 'jours_depart_anticipe',
+                'total_retard_minutes', 'total_depart_avance_minutes', 'absences']
+    cumul = (
+        pd.concat(frames, ignore_index=True)
+        .reindex(columns=['mois', 'personnel_id'] + colonnes)
+        .fillna({c: 0 for c in colonnes})
+        .groupby(['mois', 'personnel_id'], as_index=False)[colonnes].sum()
+    )
+    return [
+        (r['mois'], int(r['personnel_id'])) + tuple(int(r[c]) for c in colonnes)
+        for r in cumul.to_dict('records')
+    ]
+
+def reconstruire_stats_mensuelles(mois=None):
+    """Recalcule le cumul mensuel depuis les données brutes (base et archives), pour un mois 'AAAA-MM' ou tous.
+
+    Retourne le nombre de lignes du cumul réécrites, None en cas d'erreur.
+    """
+    if mois is None:
+        date_debut, date_fin = date(1, 1, 1), date(9999, 12, 31)
+    else:
+        annee, numero = (int(partie) for partie in mois.split('-'))
+        date_debut, date_fin = _bornes_mois(annee, numero)
+
+    try:
+        # Les archives ne changent pas pendant le recalcul : lues hors transaction
+        archives = _cumul_archives(date_debut, date_fin)
+    except Exception as e:
+        st.error(f"Erreur lecture des archives: {e}")
+        return None
+
+    def reconstruire(cur):
+        cur.execute(
+            "DELETE FROM stats_mensuelles_employes WHERE mois BETWEEN ? AND ?",
+            (date_debut.strftime('%Y-%m'), date_fin.strftime('%Y-%m'))
+        )
+        cur.execute(SQL_CUMUL_POINTAGES, (date_debut, date_fin))
+        cur.execute(SQL_CUMUL_ABSENCES, (date_debut, date_fin))
+        cur.executemany(SQL_CUMUL_ARCHIVES, archives)
+        return cur.execute(
+            "SELECT COUNT(*) FROM stats_mensuelles_employes WHERE mois BETWEEN ? AND ?",
+            (date_debut.strftime('%Y-%m'), date_fin.strftime('%Y-%m'))
+        ).fetchone()[0]
+
+    try:
+        return executer_ecriture(reconstruire)
+    except Exception as e:
+        st.error(f"Erreur reconstruction des statistiques mensuelles: {e}")
+        return None
+
+# --- Statistiques sur une période quelconque ---
+# Une lecture par table sur la période (base + archives), puis des group-by
+# pandas par période et par niveau. Paramètres : date début, date fin.
+SQL_STATS_POINTAGES = enregistrer_requete("stats_pointages", """
+    SELECT pt.personnel_id, p.nom, p.prenom, p.service, p.poste, pt.date_pointage,
+           pt.statut_arrivee, pt.statut_depart, pt.retard_minutes, pt.depart_avance_minutes
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+""")
+
+SQL_STATS_ABSENCES = enregistrer_requete("stats_absences", """
+    SELECT a.personnel_id, p.nom, p.prenom, p.service, p.poste, a.date_absence
+    FROM absences a
+    JOIN personnels p ON a.personnel_id = p.id
+    WHERE a.date_absence BETWEEN ? AND ?
+""")
+
+# Granularité -> fréquence pandas ('total' : une seule période, la plage entière)
+GRANULARITES_STATS = {'jour': 'D', 'semaine': 'W-SUN', 'mois': 'M', 'total': None}
+
+# Niveau d'agrégation -> colonnes de regroupement
+NIVEAUX_STATS = {
+    'employe': ['personnel_id', 'nom', 'prenom', 'service'],
+    'service': ['service'],
+    'poste': ['poste'],
+    'global': [],
+}
+
+def _periode_stats(dates, granularite, date_debut):
+    """Début de la période (jour, lundi de la semaine, 1er du mois) de chaque date"""
+    if GRANULARITES_STATS[granularite] is None:
+        return pd.Series(date_debut, index=dates.index)
+    return pd.to_datetime(dates).dt.to_period(GRANULARITES_STATS[granularite]).dt.start_time.dt.date
+
+def _agreger_statistiques(pointages, absences, granularite, date_debut):
+    """Indicateurs par (période, niveau) pour chaque niveau de NIVEAUX_STATS, sans boucle sur les lignes"""
+    pointages = pointages.assign(
+        periode=_periode_stats(pointages['date_pointage'], granularite, date_debut),
+        presences=(pointages['statut_arrivee'] != 'Absent').astype(int),
+        retards=(pointages['statut_arrivee'] == 'En retard').astype(int),
+        departs_anticipes=(pointages['statut_depart'] == 'Départ anticipé').astype(int),
+        # Minutes des seules arrivées en retard (les avances sont négatives, les absences au seuil)
+        minutes_retard=pd.to_numeric(pointages['retard_minutes']).fillna(0).clip(lower=0)
+            .where(pointages['statut_arrivee'] == 'En retard', 0),
+        minutes_depart_anticipe=pd.to_numeric(pointages['depart_avance_minutes']).fillna(0),
+    )
+    absences = absences.assign(
+        periode=_periode_stats(absences['date_absence'], granularite, date_debut),
+        absences=1,
+    )
+    compteurs = ['presences', 'retards', 'departs_anticipes', 'minutes_retard', 'minutes_depart_anticipe']
+
+    resultats = {}
+    for niveau, cles in NIVEAUX_STATS.items():
+        groupes = ['periode'] + cles
+        df = (
+            pointages.groupby(groupes, dropna=False)[compteurs].sum()
+            .join(absences.groupby(groupes, dropna=False)[['absences']].sum(), how='outer')
+            .fillna(0)
+            .astype(int)
+            .reset_index()
+        )
+        attendus = df['presences'] + df['absences']
+        df['taux_absence'] = (100 * df['absences'] / attendus.where(attendus > 0)).round(1).fillna(0)
+        df['ponctualite'] = (100 * (df['presences'] - df['retards']) / df['presences'].where(df['presences'] > 0)).round(1).fillna(0)
+        df['retard_moyen'] = (df['minutes_retard'] / df['retards'].where(df['retards'] > 0)).round(1).fillna(0)
+        resultats[niveau] = df.sort_values(groupes, ignore_index=True)
+    return resultats
+
+def verifier_agregation_statistiques():
+    """Contrôle _agreger_statistiques() sur un jeu de pointages aux indicateurs connus.
+
+    Retourne un DataFrame des indicateurs divergents (vide si l'agrégation est conforme).
+    """
+    jour = date(2025, 9, 15)
+    pointages = pd.DataFrame(
+        [
+            (1, 'A', 'A', 'BLOC', 'Infirmier', jour, "Présent à l'heure", None, 0, 0),
+            (1, 'A', 'A', 'BLOC', 'Infirmier', jour + timedelta(days=1), 'En retard', 'Départ anticipé', 12, 30),
+            (2, 'B', 'B', 'BLOC', 'Infirmier', jour, 'En retard', None, 8, 0),
+            (2, 'B', 'B', 'BLOC', 'Infirmier', jour + timedelta(days=1), 'En avance', None, -15, 0),
+            (3, 'C', 'C', 'URGENCES', 'Médecin', jour, 'Absent', None, 30, 0),
+        ],
+        columns=['personnel_id', 'nom', 'prenom', 'service', 'poste', 'date_pointage',
+                 'statut_arrivee', 'statut_depart', 'retard_minutes', 'depart_avance_minutes']
+    )
+    absences = pd.DataFrame(
+        [(3, 'C', 'C', 'URGENCES', 'Médecin', jour)],
+        columns=['personnel_id', 'nom', 'prenom', 'service', 'poste', 'date_absence']
+    )
+    attendus = {
+        ('global', None): {'presences': 4, 'retards': 2, 'departs_anticipes': 1, 'minutes_retard': 20,
+                           'minutes_depart_anticipe': 30, 'absences': 1, 'taux_absence': 20.0,
+                           'ponctualite': 50.0, 'retard_moyen': 10.0},
+        ('service', 'BLOC'): {'presences': 4, 'retards': 2, 'minutes_retard': 20, 'absences': 0,
+                              'ponctualite': 50.0, 'retard_moyen': 10.0},
+        ('service', 'URGENCES'): {'presences': 0, 'retards': 0, 'minutes_retard': 0, 'absences': 1,
+                                  'taux_absence': 100.0},
+    }
+
+    resultats = _agreger_statistiques(pointages, absences, 'total', jour)
+    ecarts = []
+    for (niveau, cle), indicateurs in attendus.items():
+        df = resultats[niveau]
+        ligne = df.iloc[0] if cle is None else df[df['service'] == cle].iloc[0]
+        for indicateur, attendu in indicateurs.items():
+            if ligne[indicateur] != attendu:
+                ecarts.append((niveau, cle, indicateur, attendu, ligne[indicateur]))
+    return pd.DataFrame(ecarts, columns=['niveau', 'cle', 'indicateur', 'attendu', 'obtenu'])
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _statistiques_periode(db_path, date_debut, date_fin, granularite, version):
+    """Mémoïse par (base, période, granularité, version des données) les indicateurs de tous les niveaux"""
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError(f"Connexion impossible à {db_path}")
     try:
-        return pd.read_sql_query(
-            """
-            SELECT a.id, a.date_absence, p.nom, p.prenom, p.service, p.poste, 
-                   p.heure_entree_prevue, a.motif, a.justifie, 
-                   a.certificat_justificatif IS NOT NULL as has_certificat,
-                   a.created_at
-            FROM absences a
-            JOIN personnels p ON a.personnel_id = p.id
-            WHERE a.date_absence BETWEEN ? AND ?
-            ORDER BY a.date_absence DESC, p.nom, p.prenom
-            """,
-            conn,
-            params=(date_debut, date_fin),
-        )
-    except Exception as e:
-        st.error(f"Erreur récupération absences: {e}")
-        return pd.DataFrame()
+        pointages = pd.read_sql_query(SQL_STATS_POINTAGES, conn, params=(date_debut, date_fin))
+        absences = pd.read_sql_query(SQL_STATS_ABSENCES, conn, params=(date_debut, date_fin))
     finally:
-        if conn:
-            conn.close()
+        conn.close()
 
-def get_stats_mensuelles():
-    conn = get_connection()
-    if conn is None:
+    # Mois archivés : mêmes colonnes lues dans les partitions Parquet
+    archives = lire_archives('pointages', date_debut, date_fin)
+    if not archives.empty:
+        pointages = pd.concat([pointages, archives[pointages.columns]], ignore_index=True).infer_objects()
+    archives = lire_archives('absences', date_debut, date_fin)
+    if not archives.empty:
+        absences = pd.concat([absences, archives[absences.columns]], ignore_index=True).infer_objects()
+
+    return _agreger_statistiques(pointages, absences, granularite, date_debut)
+
+def get_statistiques_periode(date_debut, date_fin, granularite='mois', niveau='service'):
+    """Indicateurs (présences, retards, départs anticipés, absences, taux) par période et par niveau"""
+    version = get_version_donnees()
+    if version is None:
         return pd.DataFrame()
     try:
-        return pd.read_sql_query(
-            """
-            SELECT 
-                p.nom, p.prenom, p.service,
-                COUNT(pt.id) as jours_presents,
-                SUM(CASE WHEN pt.statut_arrivee = 'Retard' THEN 1 ELSE 0 END) as jours_retard,
-                SUM(CASE WHEN pt.statut_depart = 'Départ anticipé' THEN 1 ELSE 0 END) as jours_depart_anticipé,
-                COALESCE(SUM(pt.retard_minutes),0) as total_retard_minutes,
-                COALESCE(SUM(pt.depart_avance_minutes),0) as total_depart_avance_minutes
-            FROM personnels p
-            LEFT JOIN pointages pt ON p.id = pt.personnel_id 
-                AND pt.date_pointage >= date('now', 'start of month')
-            WHERE p.actif = 1
-            GROUP BY p.id, p.nom, p.prenom, p.service
-            ORDER BY p.nom, p.prenom
-            """,
-            conn,
-        )
+        return _statistiques_periode(DB_PATH, date_debut, date_fin, granularite, version)[niveau]
     except Exception as e:
-        st.error(f"Erreur stats mensuelles: {e}")
+        st.error(f"Erreur calcul des statistiques: {e}")
         return pd.DataFrame()
-    finally:
-        if conn:
-            conn.close()
 
-def marquer_absence_automatique():
-    conn = get_connection()
-    if conn is None:
-        return False
-    
+def comparer_statistiques(periode_a, periode_b, niveau='service'):
+    """Totaux de deux périodes (date début, date fin) côte à côte, avec l'écart de B par rapport à A"""
+    cles = NIVEAUX_STATS[niveau]
+    stats_a = get_statistiques_periode(*periode_a, granularite='total', niveau=niveau).drop(columns='periode')
+    stats_b = get_statistiques_periode(*periode_b, granularite='total', niveau=niveau).drop(columns='periode')
+    if stats_a.empty and stats_b.empty:
+        return pd.DataFrame()
+
+    if cles:
+        df = stats_a.merge(stats_b, on=cles, how='outer', suffixes=('_a', '_b')).fillna(0)
+    else:
+        df = stats_a.add_suffix('_a').join(stats_b.add_suffix('_b'), how='outer').fillna(0)
+    for indicateur in ('retards', 'absences', 'taux_absence', 'ponctualite', 'retard_moyen'):
+        df[f'ecart_{indicateur}'] = (df[f'{indicateur}_b'] - df[f'{indicateur}_a']).round(1)
+    return df
+
+def bornes_trimestre(jour, decalage=0):
+    """Premier et dernier jour du trimestre de jour, décalé de decalage trimestres"""
+    indice = (jour.year * 4 + (jour.month - 1) // 3) + decalage
+    debut = date(indice // 4, (indice % 4) * 3 + 1, 1)
+    fin = (debut + timedelta(days=95)).replace(day=1) - timedelta(days=1)
+    return debut, fin
+
+# Attendus du jour (shifts_prevus, hors congé) sans arrivée dont le début de shift
+# + seuil d'absence de leur règle est dépassé. La règle est résolue comme dans
+# _resoudre_regle() (la plus spécifique en vigueur à la date du shift, sinon seuil
+# de REGLE_NUIT ou REGLE_JOUR) ; un seuil NULL ne marque jamais absent.
+# Paramètres : date, seuil sans règle Nuit, seuil sans règle autre poste, date, motif, horodatage courant.
+SQL_ABSENCES_AUTOMATIQUES = enregistrer_requete("absences_automatiques", """
+    WITH attendus AS (
+        SELECT s.personnel_id, s.debut, p.poste,
+               (SELECT r.id FROM regles_pointage r
+                WHERE (r.service = p.service OR r.service IS NULL)
+                AND (r.poste = p.poste OR r.poste IS NULL)
+                AND r.date_effet <= s.date_shift
+                ORDER BY r.service IS NULL, r.poste IS NULL, r.date_effet DESC
+                LIMIT 1) AS regle_id
+        FROM shifts_prevus s
+        JOIN personnels p ON p.id = s.personnel_id
+        WHERE s.date_shift = ? AND s.type_shift <> 'Congé'
+        AND NOT EXISTS (
+            SELECT 1 FROM pointages pt
+            WHERE pt.personnel_id = s.personnel_id AND pt.date_pointage = s.date_shift
+            AND pt.heure_arrivee IS NOT NULL
+        )
+    ),
+    seuils AS (
+        SELECT a.personnel_id, a.debut,
+               CASE WHEN a.regle_id IS NOT NULL THEN r.seuil_absence_minutes
+                    WHEN a.poste = 'Nuit' THEN ? ELSE ? END AS seuil
+        FROM attendus a
+        LEFT JOIN regles_pointage r ON r.id = a.regle_id
+    )
+    INSERT OR IGNORE INTO absences (personnel_id, date_absence, motif, justifie)
+    SELECT personnel_id, ?, ?, 0
+    FROM seuils
+    WHERE seuil IS NOT NULL
+    AND datetime(debut, seuil || ' minutes') < ?
+""")
+
+# Non pointés du roster du jour (même périmètre que get_personnel_non_pointe()).
+# Une absence déjà enregistrée (justifiée ou non) est laissée telle quelle.
+# Paramètres : date, motif, date.
+SQL_ABSENCES_NON_POINTES = enregistrer_requete("absences_non_pointes", """
+    INSERT INTO absences (personnel_id, date_absence, motif, justifie)
+    SELECT s.personnel_id, ?, ?, 0
+    FROM shifts_prevus s
+    WHERE s.date_shift = ? AND s.type_shift <> 'Congé'
+    AND NOT EXISTS (
+        SELECT 1 FROM pointages pt
+        WHERE pt.personnel_id = s.personnel_id AND pt.date_pointage = s.date_shift
+        AND pt.heure_arrivee IS NOT NULL
+    )
+    ON CONFLICT (personnel_id, date_absence) DO NOTHING
+""")
+
+def _inserer_absences_en_masse(sql, params):
+    """Exécute un INSERT ... SELECT d'absences en une transaction, retourne le nombre de lignes écrites (None si erreur)"""
+    def inserer(cur):
+        cur.execute(sql, params)
+        # rowcount vaut -1 pour une requête préfixée par WITH : lire changes()
+        return cur.execute("SELECT changes()").fetchone()[0]
+
     try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute(
-                """
-                SELECT p.id, p.nom, p.prenom, p.heure_entree_prevue
-                FROM personnels p
-                WHERE p.actif = 1 
-                AND p.id NOT IN (
-                    SELECT personnel_id FROM pointages WHERE date_pointage = ? AND heure_arrivee IS NOT NULL
-                )
-                AND p.id NOT IN (
-                    SELECT personnel_id FROM conges 
-                    WHERE statut = 'Approuvé' 
-                    AND date_debut <= ? 
-                    AND date_fin >= ?
-                )
-                """,
-                (date.today(), date.today(), date.today())
-            )
-            employes_absents = cur.fetchall()
-            
-            maintenant = datetime.now().time()
-            
-            for emp in employes_absents:
-                emp_id, nom, prenom, heure_prevue = emp['id'], emp['nom'], emp['prenom'], emp['heure_entree_prevue']
-                heure_prevue = _as_time(heure_prevue)
-                
-                heure_limite = (datetime.combine(date.today(), heure_prevue) + timedelta(minutes=30)).time()
-                
-                if maintenant > heure_limite:
-                    cur.execute(
-                        """
-                        INSERT OR IGNORE INTO absences (personnel_id, date_absence, motif, justifie)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (emp_id, date.today(), "Absence non justifiée (automatique)", False)
-                    )
-        return True
+        return executer_ecriture(inserer)
     except Exception as e:
-        st.error(f"Erreur marquage automatique des absences: {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+        st.error(f"Erreur marquage des absences: {e}")
+        return None
+
+def marquer_absence_automatique(maintenant=None, jour=None):
+    """Marque absents, en une requête, les employés sans arrivée dont l'heure prévue + seuil est dépassée.
+
+    Le seuil est celui de la règle de pointage de chaque shift ; une règle sans
+    seuil (REGLE_NUIT par défaut) ne marque jamais absent.
+
+    jour est la date des shifts contrôlés (celle de maintenant par défaut ; la veille
+    pour une prise de poste tardive dont l'échéance passe minuit).
+    Retourne le nombre d'absences créées, None en cas d'erreur.
+    """
+    if maintenant is None:
+        maintenant = datetime.now()
+    if jour is None:
+        jour = maintenant.date()
+
+    return _inserer_absences_en_masse(
+        SQL_ABSENCES_AUTOMATIQUES,
+        (jour, REGLE_NUIT['seuil_absence'], REGLE_JOUR['seuil_absence'],
+         jour, "Absence non justifiée (automatique)", maintenant.strftime('%Y-%m-%d %H:%M:%S')),
+    )
+
+def marquer_non_pointes_absents(date_absence=None, motif="Absence non pointée"):
+    """Marque absent tout le personnel attendu non pointé du jour, en une requête; retourne le nombre marqué"""
+    if date_absence is None:
+        date_absence = date.today()
+
+    return _inserer_absences_en_masse(
+        SQL_ABSENCES_NON_POINTES,
+        (date_absence, motif, date_absence),
+    )
 
 def get_personnel_par_service(groupe_nuit_actif=None):
     conn = get_connection()
@@ -1439,18 +3926,21 @@ def get_personnel_par_service(groupe_nuit_actif=None):
         
         params = []
         if groupe_nuit_actif:
-            services_nuit = get_services_nuit()
-            conditions = []
-            
-            for service in services_nuit:
-                groupe_actif_service = get_groupe_nuit_actif_service(service)
-                if groupe_actif_service == groupe_nuit_actif:
-                    conditions.append(f"(service = '{service}' AND (poste = 'Nuit' OR poste = 'Mixte') AND groupe_nuit = '{groupe_nuit_actif}')")
-            
-            if conditions:
-                query += " AND (poste = 'Jour' OR " + " OR ".join(conditions) + ")"
-            else:
-                query += " AND (poste = 'Jour' OR poste = 'Mixte')"
+            # Services dont le groupe actif du jour est celui demandé
+            query = CTE_ACTIVE_ROSTER + query + """
+                AND (
+                    poste = 'Jour'
+                    OR (
+                        (poste = 'Nuit' OR poste = 'Mixte') AND groupe_nuit = ?
+                        AND service IN (SELECT service FROM groupes_nuit_actifs WHERE groupe_actif = ?)
+                    )
+                    OR (
+                        poste = 'Mixte'
+                        AND NOT EXISTS (SELECT 1 FROM groupes_nuit_actifs WHERE groupe_actif = ?)
+                    )
+                )
+            """
+            params = [date.today(), groupe_nuit_actif, groupe_nuit_actif, groupe_nuit_actif]
         else:
             query += " AND (poste = 'Jour' OR poste = 'Mixte' OR poste = 'Nuit')"
             
@@ -1458,14 +3948,7 @@ def get_personnel_par_service(groupe_nuit_actif=None):
         
         df = pd.read_sql_query(query, conn, params=params)
         
-        personnel_par_service = {}
-        for _, row in df.iterrows():
-            service = row['service']
-            if service not in personnel_par_service:
-                personnel_par_service[service] = []
-            personnel_par_service[service].append(row.to_dict())
-            
-        return personnel_par_service
+        return _grouper_par_service(df['service'], df.to_dict('records'))
     except Exception as e:
         st.error(f"Erreur récupération personnel par service: {e}")
         return {}
@@ -1473,6 +3956,18 @@ def get_personnel_par_service(groupe_nuit_actif=None):
         if conn:
             conn.close()
 
+# Pointages des attendus du jour : les groupes de nuit non actifs n'ont pas de shift
+SQL_POINTAGES_DU_JOUR = enregistrer_requete("pointages_du_jour", """
+    SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
+           pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart, 
+           pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes
+    FROM pointages pt
+    JOIN shifts_prevus s ON s.personnel_id = pt.personnel_id AND s.date_shift = pt.date_pointage
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage = ?
+    ORDER BY p.service, p.nom, p.prenom
+""")
+
 def get_pointages_du_jour():
     """Récupère les pointages du jour en excluant les groupes de nuit non actifs"""
     conn = get_connection()
@@ -1480,30 +3975,7 @@ def get_pointages_du_jour():
         return pd.DataFrame()
     
     try:
-        # Construire la requête pour exclure les groupes de nuit non actifs
-        services_nuit = get_services_nuit()
-        conditions = []
-        
-        for service in services_nuit:
-            groupe_actif = get_groupe_nuit_actif_service(service)
-            conditions.append(f"(p.service = '{service}' AND p.poste = 'Nuit' AND p.groupe_nuit = '{groupe_actif}')")
-        
-        query = """
-            SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
-                   pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart, 
-                   pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes
-            FROM pointages pt
-            JOIN personnels p ON pt.personnel_id = p.id
-            WHERE pt.date_pointage = ?
-            AND (
-                p.poste = 'Jour' 
-                OR p.poste = 'Mixte'
-        """
-        
-        if conditions:
-            query += " OR " + " OR ".join(conditions)
-        
-        query += ") ORDER BY p.service, p.nom, p.prenom"
+        query = SQL_POINTAGES_DU_JOUR
         
         return pd.read_sql_query(query, conn, params=(date.today(),))
     except Exception as e:
@@ -1513,33 +3985,158 @@ def get_pointages_du_jour():
         if conn:
             conn.close()
 
-def enregistrer_absence(personnel_id, date_absence, motif, justifie=False, certificat_file=None):
+# =========================
+# Instantané journalier (tableau de bord)
+# =========================
+# Une ligne par employé attendu : pointage, absence et congé du jour joints en
+# une seule passe. Paramètre : date du jour.
+SQL_SNAPSHOT_ROSTER = enregistrer_requete("snapshot_roster", """
+    SELECT p.id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
+           pt.id AS pointage_id, pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart,
+           pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes,
+           a.motif, a.justifie, a.created_at,
+           s.type_shift = 'Congé' AS en_conge
+    FROM shifts_prevus s
+    JOIN personnels p ON p.id = s.personnel_id
+    LEFT JOIN pointages pt ON pt.personnel_id = s.personnel_id AND pt.date_pointage = s.date_shift
+    LEFT JOIN absences a ON a.personnel_id = s.personnel_id AND a.date_absence = s.date_shift
+    WHERE s.date_shift = ?
+    ORDER BY p.service, p.nom, p.prenom
+""")
+
+SQL_SNAPSHOT_CONGES = enregistrer_requete("snapshot_conges", """
+    SELECT p.nom, p.prenom, p.service, c.date_debut, c.date_fin, c.type_conge,
+           (julianday(c.date_fin) - julianday(c.date_debut) + 1) as duree_jours,
+           c.statut
+    FROM conges c
+    JOIN personnels p ON c.personnel_id = p.id
+    WHERE c.statut = 'Approuvé'
+    AND c.date_debut <= ?
+    AND c.date_fin >= ?
+    ORDER BY p.service, p.nom
+""")
+
+# Indicateurs du tableau de bord en agrégats, sur les périmètres des deux requêtes
+# ci-dessus. « Total Personnel » compte actif = 1, le filtre appliqué auparavant
+# en pandas sur get_personnel(). Paramètres : date du jour (3 fois).
+SQL_SNAPSHOT_COMPTEURS = enregistrer_requete("snapshot_compteurs", """
+    SELECT (SELECT COUNT(*) FROM personnels WHERE actif = 1) AS nb_personnel_actif,
+           (SELECT COUNT(*) FROM conges c
+            JOIN personnels p ON c.personnel_id = p.id
+            WHERE c.statut = 'Approuvé' AND c.date_debut <= ? AND c.date_fin >= ?) AS nb_conges,
+           COUNT(pt.id) AS nb_pointages,
+           IFNULL(SUM(pt.heure_arrivee IS NULL AND s.type_shift <> 'Congé'), 0) AS nb_non_pointes
+    FROM shifts_prevus s
+    JOIN personnels p ON p.id = s.personnel_id
+    LEFT JOIN pointages pt ON pt.personnel_id = s.personnel_id AND pt.date_pointage = s.date_shift
+    WHERE s.date_shift = ?
+""")
+
+class SnapshotJournalier:
+    """État de présence d'une journée, lu dans une seule transaction et partagé par les widgets du tableau de bord"""
+
+    def __init__(self, jour, version, roster, conges_en_cours, compteurs):
+        self.jour = jour
+        self.version = version
+        self.roster = roster
+        self.conges_en_cours = conges_en_cours
+        # Indicateurs lus en agrégats (SQL_SNAPSHOT_COMPTEURS), pas en len() des DataFrames
+        self.compteurs = compteurs
+
+        # Mêmes périmètres que get_pointages_du_jour() et get_personnel_non_pointe()
+        a_pointe = roster['heure_arrivee'].notna()
+        en_conge = roster['en_conge'].astype(bool)
+        self.pointages = roster[roster['pointage_id'].notna()].reset_index(drop=True)
+        self.non_pointes = roster[~a_pointe & ~en_conge].reset_index(drop=True)
+
+    @property
+    def nb_personnel_actif(self):
+        return self.compteurs['nb_personnel_actif']
+
+    @property
+    def nb_pointages(self):
+        return self.compteurs['nb_pointages']
+
+    @property
+    def nb_non_pointes(self):
+        return self.compteurs['nb_non_pointes']
+
+    @property
+    def nb_absences(self):
+        """Même périmètre que get_absences_du_jour() : non pointés hors congé"""
+        return self.compteurs['nb_non_pointes']
+
+    @property
+    def nb_conges(self):
+        return self.compteurs['nb_conges']
+
+    @classmethod
+    def calculer(cls, conn, jour, version):
+        """Lit roster, pointages, absences et congés du jour dans une même transaction de lecture"""
+        conn.execute("BEGIN")
+        try:
+            roster = pd.read_sql_query(SQL_SNAPSHOT_ROSTER, conn, params=(jour,))
+            conges_en_cours = pd.read_sql_query(SQL_SNAPSHOT_CONGES, conn, params=(jour, jour))
+            compteurs = dict(conn.execute(SQL_SNAPSHOT_COMPTEURS, (jour, jour, jour)).fetchone())
+        finally:
+            conn.rollback()
+        return cls(jour, version, roster, conges_en_cours, compteurs)
+
+    @classmethod
+    def vide(cls, jour):
+        roster = pd.DataFrame(columns=['id', 'pointage_id', 'heure_arrivee', 'en_conge'])
+        compteurs = dict.fromkeys(('nb_personnel_actif', 'nb_conges', 'nb_pointages', 'nb_non_pointes'), 0)
+        return cls(jour, None, roster, pd.DataFrame(), compteurs)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _snapshot_journalier(db_path, jour, version):
+    """Mémoïse l'instantané par (base, jour, version des données) : toute écriture l'invalide"""
     conn = get_connection()
     if conn is None:
-        return False
+        raise RuntimeError(f"Connexion impossible à {db_path}")
+    try:
+        return SnapshotJournalier.calculer(conn, jour, version)
+    finally:
+        conn.close()
+
+def get_snapshot_journalier(jour=None):
+    """Instantané du jour partagé en lecture seule par les widgets (ne pas modifier ses DataFrames)"""
+    if jour is None:
+        jour = date.today()
+
+    version = get_version_donnees()
+    if version is None:
+        return SnapshotJournalier.vide(jour)
+    try:
+        return _snapshot_journalier(DB_PATH, jour, version)
+    except Exception as e:
+        st.error(f"Erreur calcul de l'instantané journalier: {e}")
+        return SnapshotJournalier.vide(jour)
+
+def enregistrer_absence(personnel_id, date_absence, motif, justifie=False, certificat_file=None):
     try:
         # Conversion de numpy.int64 en int Python standard
         personnel_id = int(personnel_id) if hasattr(personnel_id, 'item') else int(personnel_id)
         
-        with conn:
-            cur = conn.cursor()
+        if certificat_file:
+            # Le fichier va dans le stockage des certificats, la ligne ne garde que sa référence
+            empreinte, taille, mime = ingerer_certificat(certificat_file)
+
+        def ecrire(cur):
             if certificat_file:
-                # Lire directement les bytes du fichier uploadé
-                file_data = certificat_file.getvalue()
-                file_type = certificat_file.type.split('/')[-1]
-                
                 cur.execute(
                     """
-                    INSERT INTO absences (personnel_id, date_absence, motif, justifie, certificat_justificatif, type_certificat)
-                    VALUES (?, ?, ?, ?, ?, ?)
+                    INSERT INTO absences (personnel_id, date_absence, motif, justifie, certificat_sha256, certificat_taille, certificat_mime)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
                     ON CONFLICT (personnel_id, date_absence)
                     DO UPDATE SET 
                         motif = excluded.motif,
                         justifie = excluded.justifie,
-                        certificat_justificatif = excluded.certificat_justificatif,
-                        type_certificat = excluded.type_certificat
+                        certificat_sha256 = excluded.certificat_sha256,
+                        certificat_taille = excluded.certificat_taille,
+                        certificat_mime = excluded.certificat_mime
                     """,
-                    (personnel_id, date_absence, motif, justifie, file_data, file_type),
+                    (personnel_id, date_absence, motif, justifie, empreinte, taille, mime),
                 )
             else:
                 cur.execute(
@@ -1553,13 +4150,12 @@ def enregistrer_absence(personnel_id, date_absence, motif, justifie=False, certi
                     """,
                     (personnel_id, date_absence, motif, justifie),
                 )
+
+        executer_ecriture(ecrire)
         return True
     except Exception as e:
         st.error(f"Erreur enregistrement absence: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
 def get_certificat_absence(absence_id):
     conn = get_connection()
@@ -1569,12 +4165,13 @@ def get_certificat_absence(absence_id):
         with conn:
             cur = conn.cursor()
             cur.execute(
-                "SELECT certificat_justificatif, type_certificat FROM absences WHERE id = ?",
+                "SELECT certificat_sha256, certificat_mime FROM absences WHERE id = ?",
                 (absence_id,)
             )
             result = cur.fetchone()
-            if result:
-                return result['certificat_justificatif'], result['type_certificat']
+            if result and result['certificat_sha256']:
+                with open(chemin_certificat(result['certificat_sha256']), "rb") as f:
+                    return f.read(), result['certificat_mime'].split('/')[-1]
             return None, None
     except Exception as e:
         st.error(f"Erreur récupération certificat: {e}")
@@ -1953,108 +4550,52 @@ def get_tous_les_conges(filtre_statut="Tous"):
             conn.close()
             
 def modifier_pointage(personnel_id, date_pointage, nouvelle_heure_arrivee=None, nouvelle_heure_depart=None):
-    """Modifie les heures de pointage d'un employé"""
-    conn = get_connection()
-    if conn is None:
-        return False
-    
+    """Modifie les heures de pointage d'un employé : corrections ajoutées au journal, ligne dérivée"""
+    maintenant = datetime.now()
+
+    def corriger(cur):
+        cur.execute(
+            "SELECT 1 FROM pointages WHERE personnel_id = ? AND date_pointage = ?",
+            (personnel_id, date_pointage)
+        )
+        if cur.fetchone() is None:
+            return False
+        evenements = [
+            _evenement(personnel_id, date_pointage, maintenant, sens, heure, correction=True, source='correction')
+            for sens, heure in (('arrivee', nouvelle_heure_arrivee), ('depart', nouvelle_heure_depart))
+            if heure
+        ]
+        if evenements:
+            cur.executemany(SQL_INSERT_EVENEMENT, evenements)
+            _deriver_pointages(cur, [(personnel_id, date_pointage)])
+        return True
+
     try:
-        with conn:
-            cur = conn.cursor()
-            
-            # Récupérer les heures prévues
-            cur.execute(
-                "SELECT heure_entree_prevue, heure_sortie_prevue FROM personnels WHERE id = ?",
-                (personnel_id,)
-            )
-            emp_data = cur.fetchone()
-            
-            if not emp_data:
-                return False
-                
-            heure_entree_prevue = _as_time(emp_data['heure_entree_prevue'])
-            heure_sortie_prevue = _as_time(emp_data['heure_sortie_prevue'])
-            
-            # Vérifier si un pointage existe
-            cur.execute(
-                "SELECT id, heure_arrivee, heure_depart FROM pointages WHERE personnel_id = ? AND date_pointage = ?",
-                (personnel_id, date_pointage)
-            )
-            pointage = cur.fetchone()
-            
-            if not pointage:
-                st.error("Aucun pointage trouvé pour cette date")
-                return False
-            
-            # Préparer les updates
-            updates = []
-            params = []
-            
-            if nouvelle_heure_arrivee:
-                # Convertir et calculer le nouveau statut
-                nouvelle_heure_arrivee_time = _as_time(nouvelle_heure_arrivee)
-                statut_arrivee, retard_minutes, est_absent = calculer_statut_arrivee(nouvelle_heure_arrivee_time, heure_entree_prevue)
-                
-                updates.append("heure_arrivee = ?")
-                updates.append("statut_arrivee = ?")
-                updates.append("retard_minutes = ?")
-                
-                params.extend([
-                    nouvelle_heure_arrivee_time.strftime('%H:%M:%S'),
-                    statut_arrivee,
-                    retard_minutes
-                ])
-                
-                # Mettre à jour la table retards si nécessaire
-                if retard_minutes > 0 and retard_minutes < 30:
-                    cur.execute(
-                        """
-                        INSERT OR REPLACE INTO retards 
-                        (personnel_id, date_retard, retard_minutes, motif)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (personnel_id, date_pointage, retard_minutes, "Retard modifié manuellement")
-                    )
-            
-            if nouvelle_heure_depart:
-                # Convertir et calculer le départ anticipé
-                nouvelle_heure_depart_time = _as_time(nouvelle_heure_depart)
-                depart_avance_minutes = 0
-                statut_depart = "Present"
-                
-                dt_depart = datetime.combine(date.today(), nouvelle_heure_depart_time)
-                dt_sortie_prevue = datetime.combine(date.today(), heure_sortie_prevue)
-                
-                delta_minutes = (dt_sortie_prevue - dt_depart).total_seconds() / 60
-                
-                if delta_minutes > 5:
-                    depart_avance_minutes = int(delta_minutes)
-                    statut_depart = "Départ anticipé"
-                
-                updates.append("heure_depart = ?")
-                updates.append("statut_depart = ?")
-                updates.append("depart_avance_minutes = ?")
-                
-                params.extend([
-                    nouvelle_heure_depart_time.strftime('%H:%M:%S'),
-                    statut_depart,
-                    depart_avance_minutes
-                ])
-            
-            if updates:
-                query = f"UPDATE pointages SET {', '.join(updates)} WHERE id = ?"
-                params.append(pointage['id'])
-                
-                cur.execute(query, params)
-                
-            return True
-            
+        if not executer_ecriture(corriger):
+            st.error("Aucun pointage trouvé pour cette date")
+            return False
+        return True
     except Exception as e:
         st.error(f"Erreur modification pointage: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+
+SQL_CONGES_EN_COURS = enregistrer_requete("conges_en_cours", """
+    SELECT 
+        p.nom, 
+        p.prenom, 
+        p.service, 
+        c.date_debut, 
+        c.date_fin, 
+        c.type_conge,
+        (julianday(c.date_fin) - julianday(c.date_debut) + 1) as duree_jours,
+        c.statut
+    FROM conges c
+    JOIN personnels p ON c.personnel_id = p.id
+    WHERE c.statut = 'Approuvé'
+    AND c.date_debut <= date('now')
+    AND c.date_fin >= date('now')
+    ORDER BY p.service, p.nom
+""")
 
 def get_conges_en_cours():
     """Récupère les congés en cours (aujourd'hui dans la période) - VERSION CORRIGÉE"""
@@ -2064,23 +4605,7 @@ def get_conges_en_cours():
     
     try:
         return pd.read_sql_query(
-            """
-            SELECT 
-                p.nom, 
-                p.prenom, 
-                p.service, 
-                c.date_debut, 
-                c.date_fin, 
-                c.type_conge,
-                (julianday(c.date_fin) - julianday(c.date_debut) + 1) as duree_jours,
-                c.statut
-            FROM conges c
-            JOIN personnels p ON c.personnel_id = p.id
-            WHERE c.statut = 'Approuvé'
-            AND c.date_debut <= date('now')
-            AND c.date_fin >= date('now')
-            ORDER BY p.service, p.nom
-            """,
+            SQL_CONGES_EN_COURS,
             conn
         )
     except Exception as e:
@@ -2143,8 +4668,10 @@ def definir_groupe_nuit_du_jour(service, groupe_actif):
             # Mettre à jour également la table groupes_nuit_par_service
             cur.execute(
                 """
-                INSERT OR REPLACE INTO groupes_nuit_par_service (service, groupe_actif)
+                INSERT INTO groupes_nuit_par_service (service, groupe_actif)
                 VALUES (?, ?)
+                ON CONFLICT (service)
+                DO UPDATE SET groupe_actif = excluded.groupe_actif, derniere_maj = CURRENT_TIMESTAMP
                 """,
                 (service, groupe_actif)
             )
@@ -2189,144 +4716,197 @@ def get_groupe_nuit_actif_service(service):
         if conn:
             conn.close()
 
-def get_historique_tours_nuit(service=None):
-    """Récupère l'historique des tours de rôle"""
+# Bascule A/B à partir du groupe de la veille (tour de la veille, sinon
+# configuration du service), pour les seuls services en alternance quotidienne.
+# Paramètres : jour, veille.
+SQL_ROTATION_NUIT = enregistrer_requete("rotation_nuit", """
+    INSERT OR IGNORE INTO tours_role_nuit (date_tour, service, groupe_actif)
+    SELECT ?, g.service,
+           CASE COALESCE(t.groupe_actif, g.groupe_actif) WHEN 'A' THEN 'B' ELSE 'A' END
+    FROM groupes_nuit_par_service g
+    LEFT JOIN tours_role_nuit t ON t.service = g.service AND t.date_tour = ?
+    WHERE g.alternance_quotidienne = 1
+    AND EXISTS (SELECT 1 FROM personnels p WHERE p.service = g.service AND p.actif = 1 AND p.poste = 'Nuit')
+""")
+
+def appliquer_rotation_nuit(jour=None):
+    """Applique la rotation prévue des groupes de nuit pour le jour.
+
+    Les tours du jour déjà définis (par un administrateur) sont conservés et
+    deviennent la configuration de leur service ; sans tour défini, seuls les
+    services en alternance quotidienne basculent. Retourne le nombre de
+    services basculés, None en cas d'erreur.
+    """
+    if jour is None:
+        jour = date.today()
+
+    def appliquer(cur):
+        cur.execute(SQL_ROTATION_NUIT, (jour, jour - timedelta(days=1)))
+        nb_services = cur.rowcount
+
+        # Mettre à jour également la table groupes_nuit_par_service
+        cur.execute(
+            """
+            INSERT INTO groupes_nuit_par_service (service, groupe_actif)
+            SELECT service, groupe_actif FROM tours_role_nuit WHERE date_tour = ?
+            ON CONFLICT (service)
+            DO UPDATE SET groupe_actif = excluded.groupe_actif, derniere_maj = CURRENT_TIMESTAMP
+            """,
+            (jour,)
+        )
+        return nb_services
+
+    try:
+        return executer_ecriture(appliquer)
+    except Exception as e:
+        st.error(f"Erreur rotation des groupes de nuit: {e}")
+        return None
+
+def get_alternances_nuit():
+    """Services de nuit en alternance quotidienne A/B : {service: bool}"""
     conn = get_connection()
     if conn is None:
-        return pd.DataFrame()
-    
+        return {}
     try:
-        query = """
-            SELECT date_tour, service, groupe_actif, created_at
-            FROM tours_role_nuit
-        """
-        params = []
-        
-        if service:
-            query += " WHERE service = ?"
-            params.append(service)
-            
-        query += " ORDER BY date_tour DESC, service LIMIT 30"
-        
-        return pd.read_sql_query(query, conn, params=params)
+        cur = conn.execute("SELECT service, alternance_quotidienne FROM groupes_nuit_par_service")
+        return {row['service']: bool(row['alternance_quotidienne']) for row in cur.fetchall()}
     except Exception as e:
-        st.error(f"Erreur récupération historique tours: {e}")
-        return pd.DataFrame()
+        st.error(f"Erreur récupération des alternances de nuit: {e}")
+        return {}
     finally:
         if conn:
             conn.close()
-            
-def modifier_historique_pointage(pointage_id, nouvelle_heure_arrivee=None, nouvelle_heure_depart=None, nouveau_statut=None, nouveau_motif=None):
-    """Modifie manuellement un pointage - VERSION AVEC SUPPORT HEURE MANUELLE"""
+
+def definir_alternance_nuit(service, alternance):
+    """Active ou coupe la bascule A/B quotidienne du groupe de nuit d'un service"""
+    try:
+        executer_ecriture(lambda cur: cur.execute(
+            """
+            INSERT INTO groupes_nuit_par_service (service, alternance_quotidienne)
+            VALUES (?, ?)
+            ON CONFLICT (service)
+            DO UPDATE SET alternance_quotidienne = excluded.alternance_quotidienne
+            """,
+            (service, int(bool(alternance)))
+        ))
+        return True
+    except Exception as e:
+        st.error(f"Erreur réglage de l'alternance de nuit: {e}")
+        return False
+
+def get_historique_tours_nuit(service=None):
+    """Récupère l'historique des tours de rôle"""
     conn = get_connection()
     if conn is None:
-        return False, "Erreur de connexion à la base de données"
-    
-    try:
-        with conn:
-            cur = conn.cursor()
-            
-            # Récupérer les informations complètes du pointage
-            cur.execute("SELECT * FROM pointages WHERE id = ?", (pointage_id,))
-            pointage_actuel = cur.fetchone()
-            
-            if not pointage_actuel:
-                return False, "Pointage non trouvé"
-            
-            # Récupérer les informations de l'employé
-            cur.execute("SELECT heure_entree_prevue, heure_sortie_prevue FROM personnels WHERE id = ?", (pointage_actuel['personnel_id'],))
-            employe_info = cur.fetchone()
-            
-            if not employe_info:
-                return False, "Employé non trouvé"
-            
-            # Préparer les mises à jour
-            updates = []
-            params = []
-            
-            # Gestion de l'heure d'arrivée
-            if nouvelle_heure_arrivee is not None:
-                if isinstance(nouvelle_heure_arrivee, str):
-                    # Convertir la chaîne en objet time
-                    nouvelle_heure_arrivee = parse_heure_manuelle(nouvelle_heure_arrivee)
-                
-                heure_prevue = _as_time(employe_info['heure_entree_prevue'])
-                
-                # Recalculer le statut et le retard
-                statut_arrivee, retard_minutes, est_absent = calculer_statut_arrivee(nouvelle_heure_arrivee, heure_prevue)
-                
-                updates.append("heure_arrivee = ?")
-                updates.append("statut_arrivee = ?")
-                updates.append("retard_minutes = ?")
-                
-                params.extend([
-                    nouvelle_heure_arrivee.strftime('%H:%M:%S'),
-                    statut_arrivee,
-                    retard_minutes
-                ])
-                
-                # Mettre à jour la table retards
-                cur.execute("DELETE FROM retards WHERE personnel_id = ? AND date_retard = ?", (pointage_actuel['personnel_id'], pointage_actuel['date_pointage']))
-                
-                if retard_minutes > 0 and retard_minutes < 30:
-                    cur.execute("INSERT INTO retards (personnel_id, date_retard, retard_minutes, motif) VALUES (?, ?, ?, ?)",
-                               (pointage_actuel['personnel_id'], pointage_actuel['date_pointage'], retard_minutes, nouveau_motif or "Retard modifié manuellement"))
-            
-            # Gestion de l'heure de départ
-            if nouvelle_heure_depart is not None:
-                if isinstance(nouvelle_heure_depart, str):
-                    # Convertir la chaîne en objet time
-                    nouvelle_heure_depart = parse_heure_manuelle(nouvelle_heure_depart)
-                
-                heure_sortie_prevue = _as_time(employe_info['heure_sortie_prevue'])
-                
-                # Calculer le départ anticipé
-                depart_avance_minutes = 0
-                statut_depart = "Present"
-                
-                dt_depart = datetime.combine(date.today(), nouvelle_heure_depart)
-                dt_sortie_prevue = datetime.combine(date.today(), heure_sortie_prevue)
-                
-                delta_minutes = (dt_sortie_prevue - dt_depart).total_seconds() / 60
-                
-                if delta_minutes > 5:
-                    depart_avance_minutes = int(delta_minutes)
-                    statut_depart = "Départ anticipé"
-                
-                updates.append("heure_depart = ?")
-                updates.append("statut_depart = ?")
-                updates.append("depart_avance_minutes = ?")
-                
-                params.extend([
-                    nouvelle_heure_depart.strftime('%H:%M:%S'),
-                    statut_depart,
-                    depart_avance_minutes
-                ])
-            
-            # Gestion du statut manuel
-            if nouveau_statut:
-                updates.append("statut_arrivee = ?")
-                params.append(nouveau_statut)
-            
-            # Gestion du motif
-            if nouveau_motif is not None:
-                updates.append("motif_retard = ?")
-                params.append(nouveau_motif)
-            
-            # Appliquer les mises à jour
-            if updates:
-                query = f"UPDATE pointages SET {', '.join(updates)} WHERE id = ?"
-                params.append(pointage_id)
-                cur.execute(query, params)
-                
-            return True, "Pointage modifié avec succès"
+        return pd.DataFrame()
+    
+    try:
+        query = """
+            SELECT date_tour, service, groupe_actif, created_at
+            FROM tours_role_nuit
+        """
+        params = []
+        
+        if service:
+            query += " WHERE service = ?"
+            params.append(service)
             
+        query += " ORDER BY date_tour DESC, service LIMIT 30"
+        
+        return pd.read_sql_query(query, conn, params=params)
     except Exception as e:
-        return False, f"Erreur lors de la modification: {str(e)}"
+        st.error(f"Erreur récupération historique tours: {e}")
+        return pd.DataFrame()
     finally:
         if conn:
             conn.close()
             
+def modifier_historique_pointage(pointage_id, nouvelle_heure_arrivee=None, nouvelle_heure_depart=None, nouveau_statut=None, nouveau_motif=None):
+    """Modifie manuellement un pointage : corrections ajoutées au journal, ligne et retard dérivés"""
+    maintenant = datetime.now()
+
+    def corriger(cur):
+        # Récupérer le pointage et son employé
+        cur.execute(
+            """
+            SELECT pt.personnel_id, pt.date_pointage, pt.heure_arrivee, pt.statut_arrivee, pt.motif_retard,
+                   p.id AS employe_id
+            FROM pointages pt
+            LEFT JOIN personnels p ON p.id = pt.personnel_id
+            WHERE pt.id = ?
+            """,
+            (pointage_id,)
+        )
+        pointage_actuel = cur.fetchone()
+        
+        if not pointage_actuel:
+            return False, "Pointage non trouvé"
+        if pointage_actuel['employe_id'] is None:
+            return False, "Employé non trouvé"
+        personnel_id, date_pointage = pointage_actuel['personnel_id'], pointage_actuel['date_pointage']
+        
+        # Sans heure ni arrivée enregistrée, un statut ou un motif n'a pas d'arrivée à
+        # corriger (le journal l'ignorerait) : refusé s'il change, sinon sans effet
+        arrivee_a_corriger = nouvelle_heure_arrivee is not None or nouveau_statut or nouveau_motif is not None
+        if arrivee_a_corriger and nouvelle_heure_arrivee is None and pointage_actuel['heure_arrivee'] is None:
+            if (
+                (nouveau_statut and nouveau_statut != pointage_actuel['statut_arrivee'])
+                or (nouveau_motif or None) != (pointage_actuel['motif_retard'] or None)
+            ):
+                return False, "Aucune arrivée enregistrée : saisir l'heure d'arrivée avec le statut ou le motif"
+            arrivee_a_corriger = False
+
+        # Arrivée : heure, statut manuel et motif dans une même correction
+        evenements = []
+        if arrivee_a_corriger:
+            evenements.append(_evenement(
+                personnel_id, date_pointage, maintenant, 'arrivee', nouvelle_heure_arrivee, correction=True,
+                statut=nouveau_statut or None, motif=nouveau_motif, source='correction'
+            ))
+        if nouvelle_heure_depart is not None:
+            evenements.append(_evenement(
+                personnel_id, date_pointage, maintenant, 'depart', nouvelle_heure_depart, correction=True,
+                source='correction'
+            ))
+        
+        if evenements:
+            cur.executemany(SQL_INSERT_EVENEMENT, evenements)
+            _deriver_pointages(cur, [(personnel_id, date_pointage)])
+            
+        return True, "Pointage modifié avec succès"
+
+    try:
+        # Convertir les chaînes en objets time
+        if isinstance(nouvelle_heure_arrivee, str):
+            nouvelle_heure_arrivee = parse_heure_manuelle(nouvelle_heure_arrivee)
+        if isinstance(nouvelle_heure_depart, str):
+            nouvelle_heure_depart = parse_heure_manuelle(nouvelle_heure_depart)
+
+        return executer_ecriture(corriger)
+    except Exception as e:
+        return False, f"Erreur lors de la modification: {str(e)}"
+
+def supprimer_pointage(pointage_id):
+    """Annule un pointage : annulation ajoutée au journal, ligne et retard supprimés"""
+    maintenant = datetime.now()
+
+    def annuler(cur):
+        cur.execute("SELECT personnel_id, date_pointage FROM pointages WHERE id = ?", (pointage_id,))
+        pointage = cur.fetchone()
+        if pointage is None:
+            return False
+        cur.execute(SQL_INSERT_EVENEMENT, _evenement(
+            pointage['personnel_id'], pointage['date_pointage'], maintenant, 'annulation', source='correction'
+        ))
+        _deriver_pointages(cur, [(pointage['personnel_id'], pointage['date_pointage'])])
+        return True
+
+    try:
+        return executer_ecriture(annuler)
+    except Exception as e:
+        st.error(f"Erreur suppression du pointage: {e}")
+        return False
+            
 def get_pointage_id_from_selection(selection_text):
     """Extrait l'ID du pointage à partir du texte de sélection"""
     try:
@@ -2336,8 +4916,30 @@ def get_pointage_id_from_selection(selection_text):
     except (ValueError, IndexError):
         return None
 
+def requete_fts_personnel(nom=None, prenom=None):
+    """Expression MATCH de personnels_fts : chaque mot saisi cherché comme début de mot dans sa colonne"""
+    clauses = []
+    for colonne, texte in (('nom', nom), ('prenom', prenom)):
+        mots = re.findall(r"\w+", texte or "")
+        if mots:
+            clauses.append(f"{colonne} : (" + " ".join(f'"{mot}"*' for mot in mots) + ")")
+    return " AND ".join(clauses) or None
+
+def rechercher_ids_personnel(conn, nom=None, prenom=None):
+    """Identifiants du personnel correspondant aux noms saisis via l'index plein texte.
+
+    Retourne None si aucun nom n'est saisi ou si l'index n'existe pas.
+    """
+    expression = requete_fts_personnel(nom, prenom)
+    if expression is None:
+        return None
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'personnels_fts'").fetchone() is None:
+        return None
+    cur = conn.execute("SELECT rowid FROM personnels_fts WHERE personnels_fts MATCH ?", (expression,))
+    return [row[0] for row in cur.fetchall()]
+
 def rechercher_pointages_avances(nom=None, prenom=None, service=None, date_debut=None, date_fin=None, statut=None):
-    """Recherche avancée dans les pointages - VERSION CORRIGÉE"""
+    """Recherche avancée dans les pointages : employés résolus par l'index plein texte, puis pointages par (personnel_id, date)"""
     conn = get_connection()
     if conn is None:
         return pd.DataFrame()
@@ -2364,18 +4966,32 @@ def rechercher_pointages_avances(nom=None, prenom=None, service=None, date_debut
                 pt.motif_depart_avance,
                 pt.notes,
                 pt.created_at
-            FROM pointages pt
-            JOIN personnels p ON pt.personnel_id = p.id
-            WHERE 1=1
         """
         params = []
         
-        if nom:
-            query += " AND p.nom LIKE ?"
-            params.append(f"%{nom}%")
-        if prenom:
-            query += " AND p.prenom LIKE ?"
-            params.append(f"%{prenom}%")
+        ids_personnel = rechercher_ids_personnel(conn, nom, prenom)
+        if ids_personnel is not None:
+            # Employés trouvés d'abord (CROSS JOIN fixe l'ordre des boucles), puis
+            # parcours de l'index unique (personnel_id, date_pointage) pour chacun
+            query += """
+            FROM json_each(?) AS ids
+            CROSS JOIN pointages pt ON pt.personnel_id = ids.value
+            JOIN personnels p ON pt.personnel_id = p.id
+            WHERE 1=1
+            """
+            params.append(json.dumps(ids_personnel))
+        else:
+            query += """
+            FROM pointages pt
+            JOIN personnels p ON pt.personnel_id = p.id
+            WHERE 1=1
+            """
+            if nom:
+                query += " AND p.nom LIKE ?"
+                params.append(f"%{nom}%")
+            if prenom:
+                query += " AND p.prenom LIKE ?"
+                params.append(f"%{prenom}%")
         if service:
             query += " AND p.service = ?"
             params.append(service)
@@ -2391,7 +5007,27 @@ def rechercher_pointages_avances(nom=None, prenom=None, service=None, date_debut
         
         query += " ORDER BY pt.date_pointage DESC, p.nom, p.prenom"
         
-        return pd.read_sql_query(query, conn, params=params)
+        df = pd.read_sql_query(query, conn, params=params)
+        
+        # Mêmes filtres sur les mois archivés
+        archives = lire_archives('pointages', date_debut, date_fin)
+        if archives.empty:
+            return df
+        if ids_personnel is not None:
+            archives = archives[archives['personnel_id'].isin(ids_personnel)]
+        else:
+            # LIKE de SQLite : insensible à la casse
+            if nom:
+                archives = archives[archives['nom'].str.contains(nom, case=False, regex=False)]
+            if prenom:
+                archives = archives[archives['prenom'].str.contains(prenom, case=False, regex=False)]
+        if service:
+            archives = archives[archives['service'] == service]
+        if statut:
+            archives = archives[archives['statut_arrivee'] == statut]
+        archives = archives.rename(columns={'id': 'pointage_id'})
+        df = pd.concat([df, archives[df.columns]], ignore_index=True).infer_objects()
+        return df.sort_values(['date_pointage', 'nom', 'prenom'], ascending=[False, True, True], ignore_index=True)
     except Exception as e:
         st.error(f"Erreur recherche avancée: {e}")
         return pd.DataFrame()
@@ -2424,12 +5060,12 @@ def get_groupes_par_service():
         if conn:
             conn.close()
 
-def get_personnel_nuit_par_service():
-    """Récupère le personnel de nuit groupé par service et groupe"""
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _personnel_nuit_par_service(db_path, version):
+    """Mémoïse par (base, version des données) le personnel de nuit groupé par service et groupe"""
     conn = get_connection()
     if conn is None:
-        return {}
-    
+        raise RuntimeError(f"Connexion impossible à {db_path}")
     try:
         df = pd.read_sql_query(
             """
@@ -2442,23 +5078,25 @@ def get_personnel_nuit_par_service():
             """,
             conn
         )
-        
-        personnel_par_service = {}
-        for _, row in df.iterrows():
-            service = row['service']
-            if service not in personnel_par_service:
-                personnel_par_service[service] = {'A': [], 'B': []}
-            
-            groupe = row['groupe_actif'] if row['groupe_actif'] in ['A', 'B'] else 'A'
-            personnel_par_service[service][groupe].append(row.to_dict())
-            
-        return personnel_par_service
+    finally:
+        conn.close()
+
+    groupe = df['groupe_actif'].where(df['groupe_actif'].isin(['A', 'B']), 'A')
+    personnel_par_service = {}
+    for service, cle_groupe, fiche in zip(df['service'], groupe, df.to_dict('records')):
+        personnel_par_service.setdefault(service, {'A': [], 'B': []})[cle_groupe].append(fiche)
+    return personnel_par_service
+
+def get_personnel_nuit_par_service():
+    """Récupère le personnel de nuit groupé par service et groupe"""
+    version = get_version_donnees()
+    if version is None:
+        return {}
+    try:
+        return _personnel_nuit_par_service(DB_PATH, version)
     except Exception as e:
         st.error(f"Erreur récupération personnel nuit: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
             
 def parse_heure_manuelle(heure_texte):
     """Convertit une chaîne de caractères en objet time avec plusieurs formats supportés"""
@@ -2507,6 +5145,7 @@ def supprimer_definitivement_personnel(personnel_id):
             tables = [
                 'retards', 
                 'absences', 
+                'punch_events', 
                 'pointages', 
                 'conges', 
                 'quotas_conges',
@@ -2547,43 +5186,35 @@ def supprimer_definitivement_personnel(personnel_id):
             
 def justifier_absence(absence_id, certificat_file, motif_justification=None):
     """Enregistre un justificatif pour une absence"""
-    conn = get_connection()
-    if conn is None:
-        return False
-    
     try:
-        with conn:
-            cur = conn.cursor()
-            
-            # Lire directement les bytes du fichier uploadé
-            file_data = certificat_file.getvalue()
-            file_type = certificat_file.type.split('/')[-1]
-            
-            # Vérifier le type de fichier
-            if file_type not in ['jpeg', 'jpg', 'png', 'pdf']:
-                st.error("❌ Format de fichier non supporté. Utilisez JPEG, PNG ou PDF.")
-                return False
-            
-            # Mettre à jour l'absence avec le justificatif
-            cur.execute(
-                """
-                UPDATE absences 
-                SET justifie = TRUE, 
-                    certificat_justificatif = ?,
-                    type_certificat = ?,
-                    motif = COALESCE(?, motif)
-                WHERE id = ?
-                """,
-                (file_data, file_type, motif_justification, absence_id)
-            )
-            
-            return True
+        mime = certificat_file.type
+        file_type = mime.split('/')[-1]
+        
+        # Vérifier le type de fichier
+        if file_type not in ['jpeg', 'jpg', 'png', 'pdf']:
+            st.error("❌ Format de fichier non supporté. Utilisez JPEG, PNG ou PDF.")
+            return False
+        
+        # Le fichier va dans le stockage (dédupliqué par empreinte), la ligne ne garde que sa référence
+        empreinte, taille, mime = ingerer_certificat(certificat_file)
+        
+        # Mettre à jour l'absence avec le justificatif
+        executer_ecriture(lambda cur: cur.execute(
+            """
+            UPDATE absences 
+            SET justifie = TRUE, 
+                certificat_sha256 = ?,
+                certificat_taille = ?,
+                certificat_mime = ?,
+                motif = COALESCE(?, motif)
+            WHERE id = ?
+            """,
+            (empreinte, taille, mime, motif_justification, absence_id)
+        ))
+        return True
     except Exception as e:
         st.error(f"Erreur lors de l'enregistrement du justificatif: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
             
 def debug_conges():
     """Fonction de débogage pour vérifier les congés dans la base"""
@@ -2630,33 +5261,59 @@ def afficher_justificatif_absence(absence_id):
         with conn:
             cur = conn.cursor()
             cur.execute(
-                "SELECT certificat_justificatif, type_certificat FROM absences WHERE id = ?",
+                "SELECT certificat_sha256, certificat_taille, certificat_mime FROM absences WHERE id = ?",
                 (absence_id,)
             )
             result = cur.fetchone()
             
-            if result and result['certificat_justificatif']:
-                file_data = result['certificat_justificatif']
-                file_type = result['type_certificat']
+            if result and result['certificat_sha256']:
+                # Le fichier n'est lu qu'à l'affichage, depuis le stockage des certificats
+                chemin = chemin_certificat(result['certificat_sha256'])
+                if not os.path.exists(chemin):
+                    st.warning("⚠️ Fichier du justificatif introuvable dans le stockage")
+                    return False
+                file_type = result['certificat_mime'].split('/')[-1]
                 
                 # Créer un bouton de téléchargement
                 if file_type in ['jpeg', 'jpg', 'png']:
-                    # Pour les images, utiliser st.image avec les bytes directement
-                    st.image(file_data, caption="Certificat médical", use_column_width=True)
-                    st.download_button(
-                        label="📥 Télécharger l'image",
-                        data=file_data,
-                        file_name=f"certificat_absence_{absence_id}.{file_type}",
-                        mime=f"image/{file_type}"
-                    )
+                    # Aperçu d'abord, image recompressée à la demande, original au téléchargement seulement
+                    apercu = chemin_derive_certificat(result['certificat_sha256'], "apercu")
+                    if not os.path.exists(apercu):
+                        try:
+                            # Certificats envoyés avant la génération des dérivés
+                            generer_derives_certificat(result['certificat_sha256'])
+                        except Exception as e:
+                            print(f"DEBUG: Dérivés du certificat {absence_id} non générés - {e}")
+
+                    if os.path.exists(apercu):
+                        with open(apercu, "rb") as f:
+                            st.image(f.read(), caption="Aperçu du certificat médical")
+                        # Sans dérivé d'affichage (génération interrompue), l'original s'affiche en grand
+                        affichage = chemin_derive_certificat(result['certificat_sha256'], "affichage")
+                        if not os.path.exists(affichage):
+                            affichage = chemin
+                        with st.expander("🔍 Afficher en grand"):
+                            with open(affichage, "rb") as f:
+                                st.image(f.read(), caption="Certificat médical", use_column_width=True)
+                    else:
+                        with open(chemin, "rb") as f:
+                            st.image(f.read(), caption="Certificat médical", use_column_width=True)
+                    with open(chemin, "rb") as f:
+                        st.download_button(
+                            label=f"📥 Télécharger l'original ({result['certificat_taille'] // 1024} Ko)",
+                            data=f,
+                            file_name=f"certificat_absence_{absence_id}.{file_type}",
+                            mime=f"image/{file_type}"
+                        )
                 elif file_type == 'pdf':
                     # Pour les PDF
-                    st.download_button(
-                        label="📥 Télécharger le PDF",
-                        data=file_data,
-                        file_name=f"certificat_absence_{absence_id}.pdf",
-                        mime="application/pdf"
-                    )
+                    with open(chemin, "rb") as f:
+                        st.download_button(
+                            label=f"📥 Télécharger le PDF ({result['certificat_taille'] // 1024} Ko)",
+                            data=f,
+                            file_name=f"certificat_absence_{absence_id}.pdf",
+                            mime="application/pdf"
+                        )
                     st.info("📄 Document PDF - Cliquez sur télécharger pour visualiser")
                 
                 return True
@@ -2714,25 +5371,701 @@ def modifier_quota_conges_employe(personnel_id, nouveaux_jours_alloues):
                 )
                 return True
     except Exception as e:
-        st.error(f"Erreur modification quota congés: {e}")
-        return False
+        st.error(f"Erreur modification quota congés: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+# =========================
+# Archives mensuelles (Parquet)
+# =========================
+# Lignes d'un mois avec l'identité de l'employé au moment de l'archivage.
+# Paramètres : premier et dernier jour du mois.
+SQL_ARCHIVE_POINTAGES = enregistrer_requete("archive_pointages", """
+    SELECT pt.id, pt.personnel_id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue, p.heure_sortie_prevue,
+           pt.date_pointage, pt.heure_arrivee, pt.heure_depart, pt.statut_arrivee, pt.statut_depart,
+           pt.retard_minutes, pt.depart_avance_minutes, pt.motif_retard, pt.motif_depart_avance, pt.notes, pt.created_at
+    FROM pointages pt
+    JOIN personnels p ON pt.personnel_id = p.id
+    WHERE pt.date_pointage BETWEEN ? AND ?
+""")
+
+SQL_ARCHIVE_RETARDS = enregistrer_requete("archive_retards", """
+    SELECT r.id, r.personnel_id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
+           r.date_retard, r.retard_minutes, r.motif, r.created_at
+    FROM retards r
+    JOIN personnels p ON r.personnel_id = p.id
+    WHERE r.date_retard BETWEEN ? AND ?
+""")
+
+# Les absences avec certificat restent en base : le stockage des certificats
+# purge les fichiers qu'aucune ligne ne référence
+SQL_ARCHIVE_ABSENCES = enregistrer_requete("archive_absences", """
+    SELECT a.id, a.personnel_id, p.nom, p.prenom, p.service, p.poste, p.heure_entree_prevue,
+           a.date_absence, a.motif, a.justifie, a.created_at
+    FROM absences a
+    JOIN personnels p ON a.personnel_id = p.id
+    WHERE a.date_absence BETWEEN ? AND ?
+    AND a.certificat_sha256 IS NULL
+""")
+
+# Table -> (requête d'archivage, colonne de date, colonnes catégorielles)
+TABLES_ARCHIVEES = {
+    'pointages': (SQL_ARCHIVE_POINTAGES, 'date_pointage', ('service', 'poste', 'statut_arrivee', 'statut_depart')),
+    'retards': (SQL_ARCHIVE_RETARDS, 'date_retard', ('service', 'poste')),
+    'absences': (SQL_ARCHIVE_ABSENCES, 'date_absence', ('service', 'poste')),
+}
+
+def get_dossier_archives():
+    """Dossier des archives Parquet, à côté du fichier de base"""
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), ARCHIVES_DIR)
+
+def chemin_partition_archive(table, annee, mois):
+    """Fichier d'une partition year=/month= (lisible comme jeu de données Parquet partitionné)"""
+    return os.path.join(get_dossier_archives(), table, f"year={annee}", f"month={mois}", f"{table}.parquet")
+
+def _bornes_mois(annee, mois):
+    debut = date(annee, mois, 1)
+    return debut, (debut + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+def _lire_partition_archive(table, annee, mois):
+    chemin = chemin_partition_archive(table, annee, mois)
+    if not os.path.exists(chemin):
+        return pd.DataFrame()
+    return pd.read_parquet(chemin, engine="pyarrow")
+
+def _ecrire_partition_archive(table, annee, mois, df):
+    _, _, categorielles = TABLES_ARCHIVEES[table]
+    df = df.copy()
+    for colonne in categorielles:
+        df[colonne] = df[colonne].astype("category")
+    chemin = chemin_partition_archive(table, annee, mois)
+    os.makedirs(os.path.dirname(chemin), exist_ok=True)
+    temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df.to_parquet(temporaire, engine="pyarrow", index=False)
+    os.replace(temporaire, chemin)
+
+def archiver_mois(annee, mois):
+    """Écrit un mois clos dans les archives Parquet puis retire ses lignes de la base.
+
+    Un mois déjà archivé est complété (lignes arrivées depuis), jamais écrasé.
+    Retourne {table: lignes archivées}, None en cas d'erreur.
+    """
+    if pyarrow is None:
+        st.error("Archivage indisponible : pyarrow n'est pas installé")
+        return None
+
+    debut, fin = _bornes_mois(annee, mois)
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        nouvelles = {
+            table: pd.read_sql_query(sql, conn, params=(debut, fin))
+            for table, (sql, _, _) in TABLES_ARCHIVEES.items()
+        }
+    except Exception as e:
+        st.error(f"Erreur lecture du mois à archiver: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    try:
+        totaux = {}
+        for table, df in nouvelles.items():
+            if df.empty:
+                totaux[table] = len(_lire_partition_archive(table, annee, mois))
+                continue
+            existantes = _lire_partition_archive(table, annee, mois)
+            if not existantes.empty:
+                df = pd.concat([existantes, df], ignore_index=True).drop_duplicates('id', keep='last')
+            _ecrire_partition_archive(table, annee, mois, df)
+            # Relire avant de supprimer quoi que ce soit de la base
+            totaux[table] = len(_lire_partition_archive(table, annee, mois))
+            if totaux[table] != len(df):
+                raise RuntimeError(f"partition {table} {annee}-{mois:02d} incomplète")
+    except Exception as e:
+        st.error(f"Erreur écriture de l'archive {annee}-{mois:02d}: {e}")
+        return None
+
+    def retirer(cur):
+        # Mois enregistré avant les suppressions : le cumul mensuel conserve ses lignes
+        cur.execute(
+            """
+            INSERT INTO archives_mensuelles (mois, nb_pointages, nb_retards, nb_absences)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(mois) DO UPDATE SET
+                nb_pointages = excluded.nb_pointages,
+                nb_retards = excluded.nb_retards,
+                nb_absences = excluded.nb_absences,
+                archive_le = CURRENT_TIMESTAMP
+            """,
+            (f"{annee}-{mois:02d}", totaux['pointages'], totaux['retards'], totaux['absences'])
+        )
+        # Seules les lignes écrites dans l'archive sont supprimées
+        for table, df in nouvelles.items():
+            if not df.empty:
+                cur.execute(
+                    f"DELETE FROM {table} WHERE id IN (SELECT value FROM json_each(?))",
+                    (json.dumps(df['id'].tolist()),)
+                )
+
+    try:
+        executer_ecriture(retirer)
+        return {table: len(df) for table, df in nouvelles.items()}
+    except Exception as e:
+        st.error(f"Erreur retrait des lignes archivées: {e}")
+        return None
+
+SQL_MOIS_A_ARCHIVER = enregistrer_requete("mois_a_archiver", """
+    SELECT strftime('%Y-%m', date_pointage) AS mois FROM pointages WHERE date_pointage < ?
+    UNION
+    SELECT strftime('%Y-%m', date_retard) FROM retards WHERE date_retard < ?
+    UNION
+    SELECT strftime('%Y-%m', date_absence) FROM absences WHERE date_absence < ? AND certificat_sha256 IS NULL
+    ORDER BY mois
+""")
+
+def archiver_mois_clos(jour=None, mois_conserves=ARCHIVE_MOIS_CONSERVES):
+    """Archive les mois antérieurs aux mois_conserves derniers mois; retourne un résumé, None si erreur"""
+    if jour is None:
+        jour = date.today()
+
+    # Premier jour du plus ancien mois conservé en base
+    limite = jour.replace(day=1)
+    for _ in range(mois_conserves):
+        limite = (limite - timedelta(days=1)).replace(day=1)
+
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        mois_a_archiver = [row['mois'] for row in conn.execute(SQL_MOIS_A_ARCHIVER, (limite, limite, limite)).fetchall()]
+    except Exception as e:
+        st.error(f"Erreur recherche des mois à archiver: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    archives = []
+    for mois in mois_a_archiver:
+        annee, numero = (int(partie) for partie in mois.split('-'))
+        if archiver_mois(annee, numero) is None:
+            return None
+        archives.append(mois)
+    return f"{len(archives)} mois archivé(s)" + (f" ({', '.join(archives)})" if archives else "")
+
+def get_mois_archives(date_debut=None, date_fin=None):
+    """Mois archivés ('AAAA-MM') recoupant la période, tous si elle n'est pas bornée"""
+    conn = get_connection()
+    if conn is None:
+        return []
+    try:
+        debut = date_debut.strftime('%Y-%m') if date_debut else '0000-00'
+        fin = date_fin.strftime('%Y-%m') if date_fin else '9999-99'
+        cur = conn.execute("SELECT mois FROM archives_mensuelles WHERE mois BETWEEN ? AND ? ORDER BY mois", (debut, fin))
+        return [row['mois'] for row in cur.fetchall()]
+    except Exception as e:
+        st.error(f"Erreur lecture du registre des archives: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def lire_archives(table, date_debut=None, date_fin=None):
+    """Lignes archivées d'une table sur la période, en ne lisant que les partitions des mois concernés"""
+    if pyarrow is None:
+        return pd.DataFrame()
+    _, colonne_date, _ = TABLES_ARCHIVEES[table]
+    frames = []
+    for mois in get_mois_archives(date_debut, date_fin):
+        annee, numero = (int(partie) for partie in mois.split('-'))
+        df = _lire_partition_archive(table, annee, numero)
+        if not df.empty:
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame()
+
+    # Colonnes catégorielles des partitions ramenées au type des lectures en base, et
+    # types numériques rétablis (une partition aux colonnes vides les laisse en object)
+    df = pd.concat(frames, ignore_index=True)
+    for colonne in df.select_dtypes("category").columns:
+        df[colonne] = df[colonne].astype(object)
+    df = df.infer_objects()
+    if date_debut:
+        df = df[df[colonne_date] >= str(date_debut)]
+    if date_fin:
+        df = df[df[colonne_date] <= str(date_fin)]
+    return df
+
+def preparer_archives(table, df):
+    """Colonnes calculées en SQL sur les tables vivantes, ajoutées aux lignes archivées"""
+    if table == 'pointages':
+        # Même calcul que SQL_DUREE_TRAVAIL, arrondis compris : julianday() d'une heure seule
+        # compte en millisecondes depuis 2000-01-01 00:00 (jour julien 2451544.5), round()
+        # arrondit la demi-minute en s'éloignant de zéro. Départ antérieur : le lendemain.
+        arrivee = secondes_depuis_minuit(df['heure_arrivee'])
+        depart = secondes_depuis_minuit(df['heure_depart'])
+        origine = 2451544.5 * 86400000
+        minutes = ((origine + np.round(depart * 1000)) / 86400000.0
+                   - (origine + np.round(arrivee * 1000)) / 86400000.0) * 1440
+        minutes = minutes + np.where(depart < arrivee, 1440, 0)
+        minutes = np.trunc(minutes + np.where(minutes < 0, -0.5, 0.5))
+        return df.assign(duree_travail_minutes=pd.array(minutes, dtype="Int64"))
+    if table == 'absences':
+        # Les absences avec certificat ne sont pas archivées
+        return df.assign(has_certificat=0)
+    return df
+
+def ajouter_archives(df, table, date_debut, date_fin, tri, croissant):
+    """Lignes en base de la période suivies de ses lignes archivées, aux colonnes de df, triées"""
+    archives = lire_archives(table, date_debut, date_fin)
+    if archives.empty:
+        return df
+    archives = preparer_archives(table, archives)
+    df = pd.concat([df, archives[df.columns]], ignore_index=True).infer_objects()
+    return df.sort_values(tri, ascending=croissant, ignore_index=True)
+
+def get_historique_archives():
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query("SELECT * FROM archives_mensuelles ORDER BY mois DESC", conn)
+    except Exception as e:
+        st.error(f"Erreur lecture du registre des archives: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+# =========================
+# Planificateur de tâches
+# =========================
+def get_prises_de_poste(jour):
+    """(heure d'entrée prévue, seuil d'absence de la règle en vigueur le jour donné) distincts du personnel actif.
+
+    Une échéance d'absences par prise de poste ; les règles sans seuil (jamais absent) sont omises.
+    """
+    conn = get_connection()
+    if conn is None:
+        return []
+    try:
+        cur = conn.execute("SELECT DISTINCT service, poste, heure_entree_prevue FROM personnels WHERE actif = 1")
+        lignes = cur.fetchall()
+        version_regles = get_version_regles(cur)
+        prises = set()
+        for row in lignes:
+            seuil = regle_pointage(row['service'], row['poste'], jour, version_regles, cur)['seuil_absence']
+            if seuil is not None:
+                prises.add((_as_time(row['heure_entree_prevue']), seuil))
+        return sorted(prises)
+    except Exception as e:
+        st.error(f"Erreur récupération heures d'entrée: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def reserver_tache(tache, echeance):
+    """Réserve l'exécution d'une tâche pour une échéance; False si elle a déjà été prise (autre session ou processus)"""
+    def reserver(cur):
+        cur.execute(
+            "INSERT OR IGNORE INTO taches_planifiees (tache, echeance) VALUES (?, ?)",
+            (tache, echeance.strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        return cur.rowcount == 1
+
+    try:
+        return executer_ecriture(reserver)
+    except Exception as e:
+        print(f"DEBUG: Réservation de la tâche {tache} impossible - {e}")
+        return False
+
+def terminer_tache(tache, echeance, statut, resultat=None):
+    try:
+        executer_ecriture(lambda cur: cur.execute(
+            """
+            UPDATE taches_planifiees
+            SET statut = ?, resultat = ?, fin = CURRENT_TIMESTAMP
+            WHERE tache = ? AND echeance = ?
+            """,
+            (statut, resultat, tache, echeance.strftime('%Y-%m-%d %H:%M:%S'))
+        ))
+        return True
+    except Exception as e:
+        print(f"DEBUG: Fin de la tâche {tache} non enregistrée - {e}")
+        return False
+
+def get_historique_taches_planifiees(limite=50):
+    conn = get_connection()
+    if conn is None:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query(
+            """
+            SELECT tache, echeance, statut, resultat, debut, fin
+            FROM taches_planifiees
+            ORDER BY echeance DESC, tache
+            LIMIT ?
+            """,
+            conn,
+            params=(limite,),
+        )
+    except Exception as e:
+        st.error(f"Erreur récupération des tâches planifiées: {e}")
+        return pd.DataFrame()
+    finally:
+        if conn:
+            conn.close()
+
+def cloturer_journee(jour=None, conservation_jours=90):
+    """Tâches de fin de journée : purges (journal des tâches, certificats orphelins, exports), statistiques du planificateur, checkpoint WAL"""
+    if jour is None:
+        jour = date.today()
+
+    def purger(cur):
+        cur.execute(
+            "DELETE FROM taches_planifiees WHERE echeance < ?",
+            ((jour - timedelta(days=conservation_jours)).isoformat(),)
+        )
+        return cur.rowcount
+
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        nb_purgees = executer_ecriture(purger)
+        # Maintenance hors transaction, sur une connexion de lecture
+        conn.execute("PRAGMA optimize")
+        # Replier le WAL dans la base pendant la période creuse
+        occupe, pages_wal, pages_copiees = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        nb_certificats = purger_certificats_orphelins()
+        nb_exports = purger_exports()
+        return (
+            f"{nb_purgees} tâche(s) purgée(s), {nb_certificats} certificat(s) orphelin(s) supprimé(s), "
+            f"{nb_exports} export(s) supprimé(s), "
+            f"checkpoint {'partiel' if occupe else 'complet'} ({pages_copiees}/{pages_wal} pages)"
+        )
+    except Exception as e:
+        st.error(f"Erreur clôture de la journée: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def _marquer_absences_jours(jours_shift):
+    """Absences automatiques des shifts de chacun des jours; None si l'un des marquages échoue"""
+    resultats = [marquer_absence_automatique(datetime.now(), jour_shift) for jour_shift in jours_shift]
+    return None if None in resultats else sum(resultats)
+
+class PlanificateurTaches:
+    """Thread de fond exécutant les tâches du jour à leur échéance, hors du chemin des requêtes.
+
+    Chaque (tâche, échéance) est réservée dans taches_planifiees avant
+    exécution : une échéance n'est traitée qu'une fois, même avec plusieurs
+    processus. Les échéances passées du jour sont rattrapées au démarrage.
+    """
+
+    def __init__(self, intervalle=PLANIFICATEUR_INTERVALLE):
+        self.intervalle = intervalle
+        self.derniere_verification = None
+        self._arret = threading.Event()
+        self._thread = threading.Thread(target=self._boucle, name="planificateur-pointage", daemon=True)
+
+    def demarrer(self):
+        self._thread.start()
+
+    def arreter(self, delai=5):
+        self._arret.set()
+        self._thread.join(delai)
+
+    @property
+    def actif(self):
+        return self._thread.is_alive()
+
+    def echeances(self, jour):
+        """Liste (tâche, échéance, fonction) des tâches prévues pour le jour"""
+        taches = []
+        if HEURE_CALENDRIER_SHIFTS is not None:
+            taches.append(("calendrier_shifts", datetime.combine(jour, HEURE_CALENDRIER_SHIFTS),
+                           lambda: etendre_calendrier_shifts(jour)))
+        # Échéance = prise de poste + seuil de sa règle ; celle d'un shift de la veille
+        # peut passer minuit et tomber le jour même
+        jours_par_echeance = {}
+        for jour_shift in (jour - timedelta(days=1), jour):
+            for heure, seuil in get_prises_de_poste(jour_shift):
+                echeance = datetime.combine(jour_shift, heure) + timedelta(minutes=seuil)
+                if echeance.date() == jour:
+                    jours_par_echeance.setdefault(echeance, set()).add(jour_shift)
+        for echeance, jours_shift in sorted(jours_par_echeance.items()):
+            taches.append(("absences_automatiques", echeance,
+                           lambda jours_shift=sorted(jours_shift): _marquer_absences_jours(jours_shift)))
+        if HEURE_ROTATION_NUIT is not None:
+            taches.append(("rotation_nuit", datetime.combine(jour, HEURE_ROTATION_NUIT),
+                           lambda: appliquer_rotation_nuit(jour)))
+        if HEURE_CLOTURE_JOUR is not None:
+            taches.append(("cloture_jour", datetime.combine(jour, HEURE_CLOTURE_JOUR),
+                           lambda: cloturer_journee(jour)))
+            if ARCHIVAGE_ACTIF and pyarrow is not None:
+                taches.append(("archivage_mensuel", datetime.combine(jour, HEURE_CLOTURE_JOUR),
+                               lambda: archiver_mois_clos(jour)))
+        return taches
+
+    def executer_echeances(self, maintenant=None):
+        """Exécute les tâches échues et non encore réservées; retourne le nombre exécuté"""
+        if maintenant is None:
+            maintenant = datetime.now()
+
+        executees = 0
+        for tache, echeance, fonction in self.echeances(maintenant.date()):
+            if echeance > maintenant or not reserver_tache(tache, echeance):
+                continue
+            try:
+                resultat = fonction()
+                statut = "Erreur" if resultat is None else "Terminée"
+                terminer_tache(tache, echeance, statut, None if resultat is None else str(resultat))
+            except Exception as e:
+                terminer_tache(tache, echeance, "Erreur", str(e))
+            executees += 1
+            print(f"DEBUG: Tâche planifiée {tache} ({echeance:%H:%M}) exécutée")
+
+        self.derniere_verification = maintenant
+        return executees
+
+    def _boucle(self):
+        while not self._arret.is_set():
+            try:
+                self.executer_echeances()
+            except Exception as e:
+                print(f"DEBUG: Erreur planificateur - {e}")
+            self._arret.wait(self.intervalle)
+
+@st.cache_resource(show_spinner=False)
+def get_planificateur(db_path):
+    """Un seul planificateur par processus, quels que soient les sessions et reruns"""
+    planificateur = PlanificateurTaches()
+    planificateur.demarrer()
+    return planificateur
+
+# =========================
+# Service de pointage (badgeuses)
+# =========================
+# Personnel attendu parmi une liste d'identifiants. Paramètres : tableau JSON d'ids, date.
+SQL_ROSTER_VALIDATION = enregistrer_requete("roster_validation", """
+    SELECT s.personnel_id AS id
+    FROM json_each(?) ids
+    JOIN shifts_prevus s ON s.personnel_id = ids.value AND s.date_shift = ?
+""")
+
+def get_ids_roster(jour, personnel_ids):
+    """Sous-ensemble des identifiants donnés attendus ce jour-là (None en cas d'erreur)"""
+    conn = get_connection()
+    if conn is None:
+        return None
+    try:
+        cur = conn.execute(SQL_ROSTER_VALIDATION, (json.dumps(sorted(set(personnel_ids))), jour))
+        return {row['id'] for row in cur.fetchall()}
+    except Exception as e:
+        print(f"DEBUG: Validation du roster impossible - {e}")
+        return None
     finally:
         if conn:
             conn.close()
 
+def _lire_pointage_json(brut, maintenant):
+    """Valide et normalise un pointage reçu en JSON; retourne (pointage, erreur)"""
+    if not isinstance(brut, dict):
+        return None, "objet JSON attendu"
+    try:
+        personnel_id = int(brut['personnel_id'])
+    except (KeyError, TypeError, ValueError):
+        return None, "personnel_id invalide"
+    sens = brut.get('sens')
+    if sens not in ('arrivee', 'depart'):
+        return None, "sens doit valoir 'arrivee' ou 'depart'"
+    try:
+        jour = date.fromisoformat(brut['date']) if brut.get('date') else maintenant.date()
+        heure = tm.fromisoformat(brut['heure']) if brut.get('heure') else maintenant.time().replace(microsecond=0)
+    except (TypeError, ValueError):
+        return None, "date ou heure invalide"
+    for champ in ('motif', 'notes'):
+        if brut.get(champ) is not None and not isinstance(brut[champ], str):
+            return None, f"{champ} doit être une chaîne"
+
+    return {
+        'personnel_id': personnel_id,
+        'date_pointage': jour,
+        'sens': sens,
+        'heure': heure,
+        'motif': brut.get('motif'),
+        'notes': brut.get('notes'),
+    }, None
+
+def ingerer_pointages(lot, maintenant=None):
+    """Valide un lot de pointages JSON contre le roster puis l'enregistre en une transaction.
+
+    Retourne un résultat par pointage, dans l'ordre du lot : {"statut": "ok",
+    "minutes": ...} ou {"statut": "refuse", "erreur": ...}.
+    """
+    if maintenant is None:
+        maintenant = datetime.now()
+
+    resultats = [None] * len(lot)
+    valides = []
+    for rang, brut in enumerate(lot):
+        pointage, erreur = _lire_pointage_json(brut, maintenant)
+        if erreur:
+            resultats[rang] = {"statut": "refuse", "erreur": erreur}
+        else:
+            valides.append((rang, pointage))
+
+    # Date du shift de chaque pointage, puis une requête de roster par date de shift
+    dates_shift = rattacher_pointages([p for _, p in valides]) if valides else []
+    if dates_shift is None:
+        for rang, _ in valides:
+            resultats[rang] = {"statut": "refuse", "erreur": "roster indisponible"}
+        valides = []
+    else:
+        valides = [
+            (rang, dict(p, date_pointage=jour, horodatage=_horodatage_pointage(p)))
+            for (rang, p), jour in zip(valides, dates_shift)
+        ]
+
+    attendus = {}
+    for jour in {p['date_pointage'] for _, p in valides}:
+        attendus[jour] = get_ids_roster(jour, [p['personnel_id'] for _, p in valides if p['date_pointage'] == jour])
+
+    a_enregistrer = []
+    for rang, p in valides:
+        ids_attendus = attendus[p['date_pointage']]
+        if ids_attendus is None:
+            resultats[rang] = {"statut": "refuse", "erreur": "roster indisponible"}
+        elif p['personnel_id'] not in ids_attendus:
+            resultats[rang] = {"statut": "refuse", "erreur": "hors roster du jour"}
+        else:
+            a_enregistrer.append((rang, p))
+
+    if a_enregistrer:
+        enregistres = enregistrer_pointages_lot([p for _, p in a_enregistrer], rattacher=False)
+        for (rang, p), (succes, minutes, erreur) in zip(a_enregistrer, enregistres):
+            resultats[rang] = {"statut": "ok", "minutes": minutes} if succes else {"statut": "refuse", "erreur": erreur}
+
+    for brut, resultat in zip(lot, resultats):
+        if isinstance(brut, dict) and 'personnel_id' in brut:
+            resultat['personnel_id'] = brut['personnel_id']
+    return resultats
+
+class _GestionnairePointage(BaseHTTPRequestHandler):
+    """POST /pointages (objet ou liste JSON) et GET /sante"""
+
+    protocol_version = "HTTP/1.1"  # connexions persistantes pour les badgeuses
+    server_version = "PointageClinique/1.0"
+
+    def _repondre(self, code, donnees):
+        corps = json.dumps(donnees, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def do_GET(self):
+        if self.path == "/sante":
+            self._repondre(200, {"statut": "ok"})
+        else:
+            self._repondre(404, {"erreur": "ressource inconnue"})
+
+    def do_POST(self):
+        try:
+            longueur = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            longueur = -1
+        if longueur < 0:
+            # Corps illisible : la connexion ne peut pas être réutilisée
+            self.close_connection = True
+            self._repondre(400, {"erreur": "Content-Length invalide"})
+            return
+        corps = self.rfile.read(longueur)
+
+        if self.path != "/pointages":
+            self._repondre(404, {"erreur": "ressource inconnue"})
+            return
+        jeton = self.headers.get("X-Jeton", "").encode('utf-8')
+        if not SERVICE_POINTAGE_JETON or not hmac.compare_digest(jeton, SERVICE_POINTAGE_JETON.encode('utf-8')):
+            self._repondre(401, {"erreur": "jeton invalide"})
+            return
+        try:
+            donnees = json.loads(corps)
+        except (ValueError, UnicodeDecodeError):
+            self._repondre(400, {"erreur": "JSON invalide"})
+            return
+
+        lot = donnees if isinstance(donnees, list) else [donnees]
+        if len(lot) > SERVICE_POINTAGE_LOT_MAX:
+            self._repondre(413, {"erreur": f"lot limité à {SERVICE_POINTAGE_LOT_MAX} pointages"})
+            return
+        self._repondre(200, {"resultats": ingerer_pointages(lot)})
+
+    def log_message(self, format, *args):
+        # Pas de journal par requête : plusieurs centaines de pointages par minute
+        pass
+
+@st.cache_resource(show_spinner=False)
+def get_service_pointage(hote, port):
+    """Démarre une seule fois par processus le service HTTP de pointage dans un thread de fond.
+
+    Sans jeton (POINTAGE_JETON), le service n'est pas démarré : il accepterait des
+    pointages non authentifiés. Retourne None dans ce cas.
+    """
+    if not SERVICE_POINTAGE_JETON:
+        print("DEBUG: Service de pointage non démarré - définir POINTAGE_JETON pour authentifier les badgeuses")
+        return None
+    serveur = ThreadingHTTPServer((hote, port), _GestionnairePointage)
+    serveur.daemon_threads = True
+    threading.Thread(target=serveur.serve_forever, name="service-pointage", daemon=True).start()
+    print(f"DEBUG: Service de pointage à l'écoute sur http://{hote}:{port}")
+    return serveur
+
+def demarrer_service_pointage():
+    """Service de pointage du processus, None si le port est indisponible (nouvel essai au prochain rerun)"""
+    try:
+        return get_service_pointage(SERVICE_POINTAGE_HOTE, SERVICE_POINTAGE_PORT)
+    except OSError as e:
+        print(f"DEBUG: Service de pointage non démarré - {e}")
+        return None
+
+def envoyer_pointages(pointages, url=None, delai=5):
+    """Client de test en boucle locale : poste un pointage (dict) ou un lot (liste) et retourne la réponse décodée"""
+    if url is None:
+        url = f"http://{SERVICE_POINTAGE_HOTE}:{SERVICE_POINTAGE_PORT}/pointages"
+
+    entetes = {"Content-Type": "application/json"}
+    if SERVICE_POINTAGE_JETON:
+        entetes["X-Jeton"] = SERVICE_POINTAGE_JETON
+    requete = urllib.request.Request(url, data=json.dumps(pointages).encode('utf-8'), headers=entetes, method="POST")
+    with urllib.request.urlopen(requete, timeout=delai) as reponse:
+        return json.loads(reponse.read())
+
 # =========================
 # Interface Streamlit
 # =========================
 
 def main():
-    # Initialisation
-    if not test_connection_background():
-        st.error("❌ Impossible de se connecter à la base de données. Vérifiez la configuration.")
-        return
-    
-    if not create_tables():
-        st.error("❌ Erreur lors de l'initialisation des tables.")
+    # Initialisation (mémoïsée par processus : aucun travail de schéma aux reruns)
+    if not initialiser_base_de_donnees():
+        st.error("❌ Impossible d'initialiser la base de données. Vérifiez la configuration.")
         return
+
+    # Absences automatiques, rotation de nuit et clôture tournent en tâche de fond
+    if PLANIFICATEUR_ACTIF:
+        get_planificateur(DB_PATH)
+    # Les badgeuses pointent directement, sans navigateur ni rerun
+    if SERVICE_POINTAGE_ACTIF:
+        demarrer_service_pointage()
     
     # Authentification
     if "authenticated" not in st.session_state:
@@ -2815,30 +6148,30 @@ def show_dashboard():
     
     # Marquage automatique des absences
     if st.button("🔄 Vérifier les absences automatiques"):
-        if marquer_absence_automatique():
-            st.success("✅ Absences automatiques vérifiées")
+        nb_absences = marquer_absence_automatique()
+        if nb_absences is not None:
+            st.success(f"✅ Absences automatiques vérifiées ({nb_absences} nouvelle(s) absence(s))")
         else:
             st.error("❌ Erreur lors de la vérification des absences")
     
     col1, col2, col3, col4, col5 = st.columns(5)
     
-    # Statistiques rapides
-    personnel_df = get_personnel()
-    pointages_du_jour = get_pointages_du_jour()
-    absences_du_jour = get_absences_du_jour()
-    conges_en_cours = get_conges_en_cours()
-    non_pointes = get_personnel_non_pointe()
-    
+    # Statistiques rapides : un seul instantané, recalculé après chaque écriture
+    snapshot = get_snapshot_journalier()
+    pointages_du_jour = snapshot.pointages
+    conges_en_cours = snapshot.conges_en_cours
+    non_pointes = snapshot.non_pointes
+
     with col1:
-        st.metric("Total Personnel", len(personnel_df[personnel_df['actif'] == 1]))
+        st.metric("Total Personnel", snapshot.nb_personnel_actif)
     with col2:
-        st.metric("Pointages Aujourd'hui", len(pointages_du_jour))
+        st.metric("Pointages Aujourd'hui", snapshot.nb_pointages)
     with col3:
-        st.metric("Absences Aujourd'hui", len(absences_du_jour))
+        st.metric("Absences Aujourd'hui", snapshot.nb_absences)
     with col4:
-        st.metric("Non Pointés", len(non_pointes))
+        st.metric("Non Pointés", snapshot.nb_non_pointes)
     with col5:
-        st.metric("En Congé", len(conges_en_cours))
+        st.metric("En Congé", snapshot.nb_conges)
     
     # Employés en congé aujourd'hui - AFFICHAGE DÉTAILLÉ
     st.subheader("🏖️ Employés en congé aujourd'hui")
@@ -2877,11 +6210,11 @@ def show_dashboard():
         
         # Bouton pour pointer en masse
         if st.button("📝 Pointer tous comme absents", type="secondary"):
-            for _, emp in non_pointes.iterrows():
-                enregistrer_absence(emp['id'], date.today(), "Absence non pointée", False)
-            st.success("✅ Tous les non-pointés marqués comme absents")
-            time.sleep(1)
-            st.rerun()
+            nb_absences = marquer_non_pointes_absents(date.today())
+            if nb_absences is not None:
+                st.success(f"✅ {nb_absences} non-pointé(s) marqué(s) comme absent(s)")
+                time.sleep(1)
+                st.rerun()
     else:
         st.success("✅ Tout le personnel a pointé aujourd'hui")
     
@@ -2918,9 +6251,12 @@ def show_pointage_du_jour():
     if afficher_tous:
         st.info("👁️ Affichage de TOUS les employés (y compris les groupes de nuit non actifs)")
     
+    # Pointages du jour de toute la page en une requête, réutilisés tant qu'aucune écriture n'a lieu
+    pointages_du_jour = get_pointages_jour_par_employe(date.today())
+
     # Utiliser un conteneur pour éviter les problèmes de rendu
     pointage_container = st.container()
-    
+
     with pointage_container:
         for service, employes in personnel_filtre.items():
             if not employes:  # Vérifier si la liste d'employés n'est pas vide
@@ -2937,8 +6273,8 @@ def show_pointage_du_jour():
                 
                 # Créer un expander pour chaque employé
                 with st.expander(f"{emp['prenom']} {emp['nom']} - {emp['poste']}"):
-                    pointage = get_pointage_employe_jour(emp_id, date.today())
-                    
+                    pointage = pointages_du_jour.get(emp_id, {})
+
                     col1, col2 = st.columns(2)
                     
                     with col1:
@@ -3007,6 +6343,14 @@ def show_pointage_du_jour():
                     if emp['poste'] == 'Nuit':
                         st.info(f"🌙 Groupe de nuit: {emp.get('groupe_nuit', 'A')}")
                         
+SQL_ABSENCES_NON_JUSTIFIEES = enregistrer_requete("absences_non_justifiees", """
+    SELECT a.id, p.nom, p.prenom, p.service, a.date_absence, a.motif, a.created_at
+    FROM absences a
+    JOIN personnels p ON a.personnel_id = p.id
+    WHERE a.justifie = FALSE
+    ORDER BY a.date_absence DESC
+""")
+
 def show_gestion_absences():
     st.title("📋 Gestion des Absences")
     
@@ -3020,13 +6364,7 @@ def show_gestion_absences():
         if conn:
             try:
                 absences_non_justifiees = pd.read_sql_query(
-                    """
-                    SELECT a.id, p.nom, p.prenom, p.service, a.date_absence, a.motif, a.created_at
-                    FROM absences a
-                    JOIN personnels p ON a.personnel_id = p.id
-                    WHERE a.justifie = FALSE
-                    ORDER BY a.date_absence DESC
-                    """,
+                    SQL_ABSENCES_NON_JUSTIFIEES,
                     conn
                 )
                 
@@ -3150,14 +6488,8 @@ def show_gestion_personnel():
                     use_container_width=True
                 )
                 
-                # Option d'export
-                csv_data = personnel_actif.to_csv(index=False)
-                st.download_button(
-                    "📥 Exporter en CSV",
-                    csv_data,
-                    "personnel.csv",
-                    "text/csv"
-                )
+                # Option d'export (fichier préparé à la demande)
+                bouton_export("Exporter", "export_personnel", "personnel", SQL_EXPORT_PERSONNEL)
             else:
                 st.info("Aucun employé actif")
         else:
@@ -3472,196 +6804,180 @@ def show_gestion_personnel():
         else:
             st.info("Aucun employé actif à supprimer")
             
+TAILLES_PAGE_HISTORIQUE = [50, 100, 250, 500]
+
 def show_historique_pointages():
     st.title("📊 Historique des Pointages")
     
-    # Initialisation des états
+    # Initialisation des états : seuls la période et les curseurs de page sont conservés
     if 'hist_data_loaded' not in st.session_state:
         st.session_state.hist_data_loaded = False
         st.session_state.hist_date_debut = date.today() - timedelta(days=7)
         st.session_state.hist_date_fin = date.today()
-        st.session_state.pointages_df = pd.DataFrame()
-        st.session_state.retards_df = pd.DataFrame()
-        st.session_state.absences_df = pd.DataFrame()
+        st.session_state.hist_curseurs = {}
     
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns([2, 2, 1])
     with col1:
         date_debut = st.date_input("Date de début", value=st.session_state.hist_date_debut)
     with col2:
         date_fin = st.date_input("Date de fin", value=st.session_state.hist_date_fin)
+    with col3:
+        taille_page = st.selectbox("Lignes par page", TAILLES_PAGE_HISTORIQUE, index=1, key="hist_taille_page")
+    
+    # Changer la taille de page invalide les curseurs
+    if st.session_state.get('hist_taille_courante') != taille_page:
+        st.session_state.hist_taille_courante = taille_page
+        st.session_state.hist_curseurs = {}
     
     # Bouton de chargement
     if st.button("🔍 Charger l'historique"):
-        with st.spinner("Chargement des données..."):
-            st.session_state.pointages_df = get_pointages_periode(date_debut, date_fin)
-            st.session_state.retards_df = get_retards_periode(date_debut, date_fin)
-            st.session_state.absences_df = get_absences_periode(date_debut, date_fin)
-            st.session_state.hist_data_loaded = True
-            st.session_state.hist_date_debut = date_debut
-            st.session_state.hist_date_fin = date_fin
+        st.session_state.hist_data_loaded = True
+        st.session_state.hist_date_debut = date_debut
+        st.session_state.hist_date_fin = date_fin
+        st.session_state.hist_curseurs = {}
     
     # Affichage des données si chargées
     if st.session_state.hist_data_loaded:
+        mois_archives = get_mois_archives(st.session_state.hist_date_debut, st.session_state.hist_date_fin)
+        if mois_archives:
+            st.info(f"🗄️ Mois archivés dans la période ({', '.join(mois_archives)}) : relus depuis les archives, en lecture seule")
         display_historique_data()
     else:
         st.info("👆 Cliquez sur 'Charger l'historique' pour afficher les données")
 
+def get_page_historique_courante(liste):
+    """Page courante d'une liste de l'historique, d'après la pile de curseurs de la session"""
+    curseurs = st.session_state.hist_curseurs.setdefault(liste, [None])
+    return get_page_historique(
+        liste,
+        st.session_state.hist_date_debut,
+        st.session_state.hist_date_fin,
+        curseurs[-1],
+        st.session_state.hist_taille_courante,
+    )
+
+def afficher_navigation_page(liste, curseur_suivant, total):
+    """Boutons Précédent / Suivant d'une liste paginée par clé"""
+    curseurs = st.session_state.hist_curseurs.setdefault(liste, [None])
+    page = len(curseurs)
+    nb_pages = max(1, -(-total // st.session_state.hist_taille_courante))
+    
+    # Rappels exécutés avant le prochain rendu : la page relue est déjà la bonne
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        st.button("◀️ Précédent", key=f"prec_{liste}", disabled=page == 1, on_click=curseurs.pop)
+    with col2:
+        st.caption(f"Page {page} / {nb_pages} — {total} ligne(s)")
+    with col3:
+        st.button("Suivant ▶️", key=f"suiv_{liste}", disabled=curseur_suivant is None,
+                  on_click=curseurs.append, args=(curseur_suivant,))
+
+def bouton_export(libelle, cle, nom, sql, params=(), nom_fichier=None):
+    """Boutons d'export générés à la demande; le fichier préparé reste proposé tant que les paramètres sont les mêmes"""
+    nom_fichier = nom_fichier or nom
+    etat = f"export_{cle}"
+    formats = formats_export_disponibles()
+    colonnes = st.columns(len(formats))
+    for colonne, format_export in zip(colonnes, formats):
+        with colonne:
+            if st.button(f"📦 {libelle} ({format_export.upper()})", key=f"prep_{cle}_{format_export}"):
+                with st.spinner("Préparation de l'export..."):
+                    chemin = generer_export(nom, sql, params, format_export)
+                st.session_state[etat] = (chemin, format_export, [str(p) for p in params])
+
+    prepare = st.session_state.get(etat)
+    if prepare and prepare[0] and prepare[2] == [str(p) for p in params] and os.path.exists(prepare[0]):
+        chemin, format_export, _ = prepare
+        with open(chemin, "rb") as f:
+            st.download_button(
+                f"📥 Télécharger {nom_fichier}.{format_export}",
+                f,
+                f"{nom_fichier}.{format_export}",
+                FORMATS_EXPORT[format_export][0],
+                key=cle,
+            )
+
 def display_historique_data():
     """Affiche les données historiques une fois chargées"""
+    totaux = get_totaux_historique(st.session_state.hist_date_debut, st.session_state.hist_date_fin)
+    if totaux is None:
+        return
+    # La page courante des pointages sert aussi à l'onglet de modification
+    page_pointages, suivant_pointages = get_page_historique_courante('pointages')
+    
     tab1, tab2, tab3, tab4, tab5 = st.tabs(["Pointages", "Modifier Pointage", "Recherche Avancée", "Retards", "Absences"])
     
     with tab1:
-        display_pointages_tab()
+        display_pointages_tab(page_pointages, suivant_pointages, totaux)
     
     with tab2:
-        display_modification_tab()
+        display_modification_tab(page_pointages)
     
     with tab3:
         display_recherche_tab()
     
     with tab4:
-        display_retards_tab()
+        display_retards_tab(totaux)
     
     with tab5:
-        display_absences_tab()
+        display_absences_tab(totaux)
 
-def display_pointages_tab():
-    """Affiche l'onglet des pointages"""
+def display_pointages_tab(page_df, curseur_suivant, totaux):
+    """Affiche l'onglet des pointages (page courante)"""
     st.subheader("📋 Liste des pointages")
     
-    if not st.session_state.pointages_df.empty:
+    if totaux['pointages'] > 0:
         # Afficher avec plus de détails
-        display_df = st.session_state.pointages_df[[
+        display_df = page_df[[
             'nom', 'prenom', 'service', 'date_pointage', 
             'heure_arrivee', 'heure_depart', 'statut_arrivee', 
-            'statut_depart', 'retard_minutes', 'motif_retard'
+            'statut_depart', 'retard_minutes', 'duree_travail_minutes', 'motif_retard'
         ]].copy()
         
         # Renommer les colonnes pour un affichage plus clair
         display_df.columns = ['Nom', 'Prénom', 'Service', 'Date', 'Heure Arrivée', 
                              'Heure Départ', 'Statut Arrivée', 'Statut Départ', 
-                             'Retard (min)', 'Motif']
+                             'Retard (min)', 'Temps travaillé (min)', 'Motif']
         
         st.dataframe(display_df, use_container_width=True, height=400)
+        afficher_navigation_page('pointages', curseur_suivant, totaux['pointages'])
         
         # Option d'export (en dehors de tout formulaire)
-        csv_data = display_df.to_csv(index=False, encoding='utf-8-sig')
-        st.download_button(
-            "📥 Exporter en CSV",
-            csv_data,
-            f"pointages_{st.session_state.hist_date_debut}_{st.session_state.hist_date_fin}.csv",
-            "text/csv",
-            key="export_pointages"
+        bouton_export(
+            "Exporter",
+            "export_pointages",
+            "pointages",
+            SQL_EXPORT_POINTAGES,
+            (st.session_state.hist_date_debut, st.session_state.hist_date_fin),
+            f"pointages_{st.session_state.hist_date_debut}_{st.session_state.hist_date_fin}",
         )
         
-        # Statistiques rapides
+        # Statistiques rapides (sur toute la période)
         st.subheader("📈 Statistiques")
         col1, col2, col3 = st.columns(3)
         with col1:
-            total_pointages = len(st.session_state.pointages_df)
-            st.metric("Total pointages", total_pointages)
+            st.metric("Total pointages", totaux['pointages'])
         with col2:
-            retards_count = len(st.session_state.pointages_df[st.session_state.pointages_df['retard_minutes'] > 0])
-            st.metric("Retards", retards_count)
+            st.metric("Retards", totaux['pointages_retard'])
         with col3:
-            absences_count = len(st.session_state.pointages_df[st.session_state.pointages_df['statut_arrivee'] == 'Absent'])
-            st.metric("Absences", absences_count)
+            st.metric("Absences", totaux['pointages_absent'])
             
     else:
         st.info("Aucun pointage dans la période sélectionnée")
 
-def display_retards_tab():
-    """Affiche l'onglet des retards"""
-    st.subheader("⏰ Retards")
-    
-    if not st.session_state.retards_df.empty:
-        st.dataframe(st.session_state.retards_df, use_container_width=True, height=400)
-        
-        # Statistiques des retards
-        st.subheader("📈 Statistiques des retards")
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            total_retards = len(st.session_state.retards_df)
-            st.metric("Total retards", total_retards)
-        with col2:
-            total_minutes = st.session_state.retards_df['retard_minutes'].sum()
-            st.metric("Total minutes", f"{total_minutes} min")
-        with col3:
-            moyenne_retard = st.session_state.retards_df['retard_minutes'].mean()
-            st.metric("Moyenne retard", f"{moyenne_retard:.1f} min")
-        
-        # Bouton d'export (en dehors de tout formulaire)
-        csv_data = st.session_state.retards_df.to_csv(index=False, encoding='utf-8-sig')
-        st.download_button(
-            "📥 Exporter les retards",
-            csv_data,
-            "retards.csv",
-            "text/csv",
-            key="export_retards"
-        )
-            
-    else:
-        st.info("Aucun retard dans la période sélectionnée")
-
-def display_absences_tab():
-    """Affiche l'onglet des absences"""
-    st.subheader("📋 Absences")
-    
-    if not st.session_state.absences_df.empty:
-        # Afficher les absences avec possibilité de voir les justificatifs
-        for index, absence in st.session_state.absences_df.iterrows():
-            if 'id' in absence and pd.notna(absence['id']):
-                absence_id = int(absence['id'])
-                with st.expander(f"{absence['prenom']} {absence['nom']} - {absence['date_absence']}"):
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.write(f"**Service:** {absence['service']}")
-                        st.write(f"**Date:** {absence['date_absence']}")
-                        st.write(f"**Poste:** {absence['poste']}")
-                        st.write(f"**Heure prévue:** {absence['heure_entree_prevue']}")
-                    with col2:
-                        st.write(f"**Motif:** {absence['motif']}")
-                        st.write(f"**Justifiée:** {'✅ Oui' if absence['justifie'] else '❌ Non'}")
-                        st.write(f"**Certificat:** {'📎 Disponible' if absence['has_certificat'] else '❌ Aucun'}")
-                        
-                        # Bouton pour voir le justificatif
-                        if absence['has_certificat']:
-                            if st.button("👁️ Voir le justificatif", key=f"cert_{absence_id}"):
-                                afficher_justificatif_absence(absence_id)
-        
-        # Option d'export (en dehors de tout formulaire)
-        st.download_button(
-            "📥 Exporter les absences en CSV",
-            st.session_state.absences_df.to_csv(index=False, encoding='utf-8-sig'),
-            "absences.csv",
-            "text/csv",
-            key="export_absences"
-        )
-        
-        # Statistiques des absences
-        st.subheader("📊 Statistiques des absences")
-        col1, col2 = st.columns(2)
-        with col1:
-            total_absences = len(st.session_state.absences_df)
-            st.metric("Total absences", total_absences)
-        with col2:
-            absences_justifiees = len(st.session_state.absences_df[st.session_state.absences_df['justifie'] == True])
-            st.metric("Absences justifiées", absences_justifiees)
-            
-    else:
-        st.info("Aucune absence dans la période sélectionnée")
-
-def display_modification_tab():
-    """Affiche l'onglet de modification des pointages - VERSION CORRIGÉE"""
+def display_modification_tab(page_df):
+    """Affiche l'onglet de modification des pointages de la page courante"""
     st.subheader("✏️ Modification des pointages")
     
-    if st.session_state.pointages_df.empty:
+    # Les pointages archivés ne sont plus en base
+    page_df = page_df[~page_df['archive']] if 'archive' in page_df else page_df
+    if page_df.empty:
         st.info("Aucun pointage à modifier")
         return
     
     # Sélection du pointage
     pointages_list = []
-    for _, row in st.session_state.pointages_df.iterrows():
+    for _, row in page_df.iterrows():
         pointage_id = row.get('id', 'N/A')
         heure_arrivee = row.get('heure_arrivee', 'N/A')
         statut = row.get('statut_arrivee', 'N/A')
@@ -3672,7 +6988,7 @@ def display_modification_tab():
     if selected_pointage:
         try:
             pointage_id = int(selected_pointage.split('ID: ')[1])
-            selected_data = st.session_state.pointages_df[st.session_state.pointages_df['id'] == pointage_id].iloc[0]
+            selected_data = page_df[page_df['id'] == pointage_id].iloc[0]
             
             # Afficher les informations de l'employé
             st.write(f"**Employé:** {selected_data['prenom']} {selected_data['nom']}")
@@ -3792,10 +7108,7 @@ def display_modification_tab():
                     
                     if success:
                         st.success("✅ " + message)
-                        # Recharger les données
-                        st.session_state.pointages_df = get_pointages_periode(
-                            st.session_state.hist_date_debut, st.session_state.hist_date_fin
-                        )
+                        # La page est relue au prochain affichage
                         st.rerun()
                     else:
                         st.error("❌ " + message)
@@ -3815,25 +7128,10 @@ def display_modification_tab():
                 with col_confirm1:
                     if st.button("✅ Confirmer la suppression", key=f"confirm_del_{pointage_id}", 
                                disabled=confirm_text.upper() != "SUPPRIMER"):
-                        conn = get_connection()
-                        if conn:
-                            try:
-                                with conn:
-                                    cur = conn.cursor()
-                                    cur.execute("DELETE FROM pointages WHERE id = ?", (pointage_id,))
-                                    cur.execute("DELETE FROM retards WHERE personnel_id = ? AND date_retard = ?", 
-                                               (selected_data['personnel_id'], selected_data['date_pointage']))
-                                st.success("✅ Pointage supprimé avec succès")
-                                # Recharger les données
-                                st.session_state.pointages_df = get_pointages_periode(
-                                    st.session_state.hist_date_debut, st.session_state.hist_date_fin
-                                )
-                                st.session_state.show_delete_confirm = None
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"❌ Erreur lors de la suppression: {e}")
-                            finally:
-                                conn.close()
+                        if supprimer_pointage(pointage_id):
+                            st.success("✅ Pointage supprimé avec succès")
+                            st.session_state.show_delete_confirm = None
+                            st.rerun()
                 
                 with col_confirm2:
                     if st.button("❌ Annuler", key=f"cancel_del_{pointage_id}"):
@@ -3855,8 +7153,8 @@ def display_recherche_tab():
     with st.form("recherche_avancee_form"):
         col1, col2 = st.columns(2)
         with col1:
-            nom_recherche = st.text_input("Nom", key="rech_nom")
-            prenom_recherche = st.text_input("Prénom", key="rech_prenom")
+            nom_recherche = st.text_input("Nom", key="rech_nom", help="Début du nom, accents facultatifs (ex. « hel » trouve Hélène)")
+            prenom_recherche = st.text_input("Prénom", key="rech_prenom", help="Début du prénom, accents facultatifs")
             service_recherche = st.selectbox("Service", ["Tous"] + get_services_disponibles(), key="rech_service")
         with col2:
             date_debut_recherche = st.date_input("Date début", value=st.session_state.hist_date_debut, key="rech_debut")
@@ -3891,28 +7189,36 @@ def display_recherche_tab():
     elif st.session_state.get('recherche_effectuee', False):
         st.info("Aucun résultat trouvé")
 
-def display_retards_tab():
-    """Affiche l'onglet des retards"""
+def display_retards_tab(totaux):
+    """Affiche l'onglet des retards (page courante, statistiques sur la période)"""
     st.subheader("⏰ Retards")
     
-    if not st.session_state.retards_df.empty:
-        st.dataframe(st.session_state.retards_df, use_container_width=True, height=400)
+    if totaux['retards'] > 0:
+        page_df, curseur_suivant = get_page_historique_courante('retards')
+        st.dataframe(page_df.drop(columns=['id', 'archive']), use_container_width=True, height=400)
+        afficher_navigation_page('retards', curseur_suivant, totaux['retards'])
+        
+        bouton_export(
+            "Exporter les retards",
+            "export_retards",
+            "retards",
+            SQL_RETARDS_PERIODE,
+            (st.session_state.hist_date_debut, st.session_state.hist_date_fin),
+        )
         
         # Statistiques des retards
         st.subheader("📈 Statistiques des retards")
         col1, col2, col3 = st.columns(3)
         with col1:
-            total_retards = len(st.session_state.retards_df)
-            st.metric("Total retards", total_retards)
+            st.metric("Total retards", totaux['retards'])
         with col2:
-            total_minutes = st.session_state.retards_df['retard_minutes'].sum()
-            st.metric("Total minutes", f"{total_minutes} min")
+            st.metric("Total minutes", f"{totaux['retard_minutes']} min")
         with col3:
-            moyenne_retard = st.session_state.retards_df['retard_minutes'].mean()
+            moyenne_retard = totaux['retard_minutes'] / totaux['retards']
             st.metric("Moyenne retard", f"{moyenne_retard:.1f} min")
             
         # Graphique des retards par service
-        retards_par_service = st.session_state.retards_df.groupby('service')['retard_minutes'].sum().reset_index()
+        retards_par_service = totaux['retards_par_service']
         if not retards_par_service.empty:
             fig = px.bar(
                 retards_par_service,
@@ -3926,13 +7232,14 @@ def display_retards_tab():
     else:
         st.info("Aucun retard dans la période sélectionnée")
 
-def display_absences_tab():
-    """Affiche l'onglet des absences"""
+def display_absences_tab(totaux):
+    """Affiche l'onglet des absences (page courante, statistiques sur la période)"""
     st.subheader("📋 Absences")
     
-    if not st.session_state.absences_df.empty:
+    if totaux['absences'] > 0:
+        page_df, curseur_suivant = get_page_historique_courante('absences')
         # Afficher les absences avec possibilité de voir les justificatifs
-        for index, absence in st.session_state.absences_df.iterrows():
+        for index, absence in page_df.iterrows():
             if 'id' in absence and pd.notna(absence['id']):
                 absence_id = int(absence['id'])
                 with st.expander(f"{absence['prenom']} {absence['nom']} - {absence['date_absence']}"):
@@ -3951,32 +7258,49 @@ def display_absences_tab():
                         if absence['has_certificat']:
                             if st.button("👁️ Voir le justificatif", key=f"cert_{absence_id}"):
                                 afficher_justificatif_absence(absence_id)
+        afficher_navigation_page('absences', curseur_suivant, totaux['absences'])
         
         # Option d'export
-        st.download_button(
-            "📥 Exporter les absences en CSV",
-            st.session_state.absences_df.to_csv(index=False, encoding='utf-8-sig'),
-            "absences.csv",
-            "text/csv",
-            key="export_absences"
+        bouton_export(
+            "Exporter les absences",
+            "export_absences",
+            "absences",
+            SQL_ABSENCES_PERIODE,
+            (st.session_state.hist_date_debut, st.session_state.hist_date_fin),
         )
         
         # Statistiques des absences
         st.subheader("📊 Statistiques des absences")
         col1, col2 = st.columns(2)
         with col1:
-            total_absences = len(st.session_state.absences_df)
-            st.metric("Total absences", total_absences)
+            st.metric("Total absences", totaux['absences'])
         with col2:
-            absences_justifiees = len(st.session_state.absences_df[st.session_state.absences_df['justifie'] == True])
-            st.metric("Absences justifiées", absences_justifiees)
+            st.metric("Absences justifiées", totaux['absences_justifiees'])
             
     else:
         st.info("Aucune absence dans la période sélectionnée")
+
 def show_statistiques():
     st.title("📈 Statistiques")
     
-    stats_df = get_stats_mensuelles()
+    tab1, tab2, tab3 = st.tabs(["Mois", "Analyse par période", "Comparaison de périodes"])
+    
+    with tab1:
+        display_statistiques_mois()
+    
+    with tab2:
+        display_statistiques_periode()
+    
+    with tab3:
+        display_comparaison_periodes()
+
+def display_statistiques_mois():
+    """Statistiques d'un mois, lues dans le cumul mensuel"""
+    mois_courant = date.today().strftime('%Y-%m')
+    mois_disponibles = [mois_courant] + [m for m in get_mois_stats_disponibles() if m != mois_courant]
+    mois = st.selectbox("Mois", mois_disponibles, key="stats_mois")
+    
+    stats_df = get_stats_mensuelles(mois)
     
     if not stats_df.empty:
         col1, col2, col3 = st.columns(3)
@@ -4006,7 +7330,98 @@ def show_statistiques():
         st.subheader("📋 Statistiques détaillées par employé")
         st.dataframe(stats_df, use_container_width=True)
     else:
-        st.info("Aucune statistique disponible pour le mois en cours")
+        st.info("Aucune statistique disponible pour ce mois")
+
+LIBELLES_NIVEAUX_STATS = {'service': "Service", 'poste': "Poste", 'employe': "Employé", 'global': "Clinique"}
+
+def display_statistiques_periode():
+    """Tendances par jour, semaine ou mois sur une période quelconque"""
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        date_debut = st.date_input("Date de début", value=date.today() - timedelta(days=90), key="stats_debut")
+    with col2:
+        date_fin = st.date_input("Date de fin", value=date.today(), key="stats_fin")
+    with col3:
+        granularite = st.selectbox("Granularité", ["jour", "semaine", "mois"], index=1, key="stats_granularite")
+    with col4:
+        niveau = st.selectbox("Niveau", list(LIBELLES_NIVEAUX_STATS), format_func=LIBELLES_NIVEAUX_STATS.get, key="stats_niveau")
+    
+    if date_debut > date_fin:
+        st.warning("⚠️ La date de début doit précéder la date de fin")
+        return
+    
+    stats_df = get_statistiques_periode(date_debut, date_fin, granularite, niveau)
+    if stats_df.empty:
+        st.info("Aucune donnée sur la période")
+        return
+    
+    totaux = get_statistiques_periode(date_debut, date_fin, 'total', 'global')
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Ponctualité", f"{totaux['ponctualite'].iloc[0]} %")
+    with col2:
+        st.metric("Taux d'absence", f"{totaux['taux_absence'].iloc[0]} %")
+    with col3:
+        st.metric("Retard moyen", f"{totaux['retard_moyen'].iloc[0]} min")
+    with col4:
+        st.metric("Départs anticipés", int(totaux['departs_anticipes'].iloc[0]))
+    
+    indicateur = st.selectbox(
+        "Indicateur",
+        ["retards", "taux_absence", "ponctualite", "minutes_retard", "departs_anticipes", "absences"],
+        key="stats_indicateur"
+    )
+    # Courbe par groupe, sauf au niveau employé (trop de séries)
+    couleur = {'service': 'service', 'poste': 'poste'}.get(niveau)
+    fig = px.line(
+        stats_df if niveau != 'employe' else get_statistiques_periode(date_debut, date_fin, granularite, 'global'),
+        x='periode',
+        y=indicateur,
+        color=couleur,
+        markers=True,
+        title=f"{indicateur} par {granularite}"
+    )
+    st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader("📋 Détail")
+    st.dataframe(stats_df, use_container_width=True)
+
+def display_comparaison_periodes():
+    """Deux périodes côte à côte (par défaut : trimestre précédent / trimestre en cours)"""
+    trimestre_prec = bornes_trimestre(date.today(), -1)
+    trimestre_cour = bornes_trimestre(date.today())
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**Période A**")
+        debut_a = st.date_input("Début A", value=trimestre_prec[0], key="comp_debut_a")
+        fin_a = st.date_input("Fin A", value=trimestre_prec[1], key="comp_fin_a")
+    with col2:
+        st.markdown("**Période B**")
+        debut_b = st.date_input("Début B", value=trimestre_cour[0], key="comp_debut_b")
+        fin_b = st.date_input("Fin B", value=min(trimestre_cour[1], date.today()), key="comp_fin_b")
+    niveau = st.selectbox("Niveau", list(LIBELLES_NIVEAUX_STATS), format_func=LIBELLES_NIVEAUX_STATS.get, key="comp_niveau")
+    
+    comparaison = comparer_statistiques((debut_a, fin_a), (debut_b, fin_b), niveau)
+    if comparaison.empty:
+        st.info("Aucune donnée sur ces périodes")
+        return
+    
+    colonnes = NIVEAUX_STATS[niveau] + [
+        f'{indicateur}_{suffixe}'
+        for indicateur in ('ponctualite', 'taux_absence', 'retards', 'retard_moyen')
+        for suffixe in ('a', 'b')
+    ] + ['ecart_ponctualite', 'ecart_taux_absence', 'ecart_retards', 'ecart_retard_moyen']
+    st.dataframe(comparaison[colonnes], use_container_width=True)
+    
+    if niveau in ('service', 'poste'):
+        fig = px.bar(
+            comparaison,
+            x=niveau,
+            y='ecart_ponctualite',
+            title="Écart de ponctualité (points, B - A)"
+        )
+        st.plotly_chart(fig, use_container_width=True)
 
 def show_gestion_conges():
     st.title("📅 Gestion des Congés")
@@ -4218,8 +7633,10 @@ def show_tours_role_nuit():
         if not services_nuit:
             st.info("Aucun service avec du personnel de nuit")
         else:
+            groupes_actifs = get_groupes_nuit_actifs()
+            alternances = get_alternances_nuit()
             for service in services_nuit:
-                groupe_actuel = get_groupe_nuit_actif_service(service)
+                groupe_actuel = groupes_actifs.get(service, 'A')
                 
                 col1, col2 = st.columns([2, 1])
                 with col1:
@@ -4232,9 +7649,15 @@ def show_tours_role_nuit():
                         key=f"groupe_{service}",
                         horizontal=True
                     )
+                alternance = st.checkbox(
+                    "🔁 Alterner A/B chaque jour",
+                    value=alternances.get(service, False),
+                    key=f"alternance_{service}",
+                    help="Bascule automatique du groupe par le planificateur si aucun tour n'est défini pour le jour"
+                )
                 
                 if st.button(f"💾 Enregistrer pour {service}", key=f"btn_{service}"):
-                    if definir_groupe_nuit_du_jour(service, nouveau_groupe):
+                    if definir_groupe_nuit_du_jour(service, nouveau_groupe) and definir_alternance_nuit(service, alternance):
                         st.success(f"✅ Groupe {nouveau_groupe} défini comme actif pour {service}")
                     else:
                         st.error("❌ Erreur lors de l'enregistrement")
@@ -4308,6 +7731,127 @@ def show_tours_role_nuit():
         else:
             st.info("Aucun historique de tours de rôle disponible")
 
+def display_regles_pointage():
+    """Règles de pointage par service/poste et recalcul de l'historique"""
+    st.subheader("📏 Règles de pointage")
+    st.caption(
+        "Fenêtres en minutes par rapport à l'heure prévue. La règle la plus spécifique en vigueur "
+        "s'applique : service et poste, puis service, puis poste, puis règle générale."
+    )
+    regles_df = get_regles_pointage()
+    if not regles_df.empty:
+        affichage = regles_df.copy()
+        affichage['service'] = affichage['service'].fillna("Tous les services")
+        affichage['poste'] = affichage['poste'].fillna("Tous les postes")
+        st.dataframe(affichage, use_container_width=True)
+
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            regle_id = st.selectbox(
+                "Règle à supprimer",
+                regles_df['id'].tolist(),
+                format_func=lambda i: " / ".join(
+                    str(v) for v in affichage.loc[affichage['id'] == i, ['service', 'poste', 'date_effet']].iloc[0]
+                ),
+                key="regle_a_supprimer"
+            )
+        with col2:
+            st.write("")
+            if st.button("🗑️ Supprimer la règle"):
+                if supprimer_regle_pointage(regle_id):
+                    st.success("✅ Règle supprimée")
+    else:
+        st.info("Aucune règle : les règles par défaut (jour / nuit) s'appliquent")
+
+    with st.form("ajout_regle_pointage"):
+        st.write("**➕ Nouvelle règle**")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            service = st.selectbox("Service", ["Tous les services"] + get_services_disponibles())
+        with col2:
+            poste = st.selectbox("Poste", ["Tous les postes", "Jour", "Nuit", "Mixte"])
+        with col3:
+            date_effet = st.date_input("En vigueur à partir du", value=date.today())
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            debut_plage = st.number_input("Début de la plage à l'heure (min)", value=REGLE_JOUR['debut_plage'], step=1)
+            fin_plage = st.number_input("Fin de la plage à l'heure (min)", value=REGLE_JOUR['fin_plage'], step=1)
+        with col2:
+            absence_auto = st.checkbox("Absence automatique", value=True)
+            seuil_absence = st.number_input("Absent à partir de (min de retard)", value=REGLE_JOUR['seuil_absence'], step=1)
+        with col3:
+            avance_comptee = st.checkbox("Compter les minutes d'avance", value=REGLE_JOUR['avance_comptee'])
+            tolerance_depart = st.number_input(
+                "Tolérance de départ anticipé (min)", value=REGLE_JOUR['tolerance_depart'], min_value=0, step=1
+            )
+        if st.form_submit_button("💾 Enregistrer la règle"):
+            if debut_plage > fin_plage:
+                st.error("❌ Le début de la plage doit précéder sa fin")
+            elif ajouter_regle_pointage(
+                None if service == "Tous les services" else service,
+                None if poste == "Tous les postes" else poste,
+                date_effet, debut_plage, fin_plage,
+                seuil_absence if absence_auto else None, avance_comptee, tolerance_depart
+            ):
+                st.success("✅ Règle enregistrée : appliquée aux prochains pointages")
+                if date_effet <= date.today():
+                    st.info(f"Recalculer les pointages depuis le {date_effet.strftime('%d/%m/%Y')} pour les mettre en cohérence")
+
+    st.subheader("🔁 Recalcul des pointages")
+    st.caption("Réapplique les règles en vigueur aux pointages d'une période (hors mois archivés)")
+    col1, col2 = st.columns(2)
+    with col1:
+        reevaluation_debut = st.date_input("Du", value=date.today().replace(day=1), key="reevaluation_debut")
+    with col2:
+        reevaluation_fin = st.date_input("Au", value=date.today(), key="reevaluation_fin")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        apercu = st.button("👁️ Aperçu des écarts")
+    with col2:
+        appliquer = st.button("🔁 Recalculer la période")
+    with col3:
+        verifier = st.button("🧪 Vérifier les calculs vectorisés")
+
+    if apercu:
+        debut_calcul = time.perf_counter()
+        reevaluation = comparer_pointages_regles(reevaluation_debut, reevaluation_fin)
+        duree_ms = (time.perf_counter() - debut_calcul) * 1000
+        if reevaluation.empty:
+            st.info("Aucun pointage sur la période")
+        else:
+            ecarts = reevaluation[reevaluation['ecart']]
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Pointages", len(reevaluation))
+            with col2:
+                st.metric("Écarts avec les règles", len(ecarts))
+            with col3:
+                st.metric("Durée (ms)", round(duree_ms, 1))
+            if not ecarts.empty:
+                st.dataframe(
+                    ecarts.drop(columns=['id', 'personnel_id', 'motif_retard', 'ecart']),
+                    use_container_width=True
+                )
+    if appliquer:
+        barre = st.progress(0.0)
+        nb_modifies = reevaluer_pointages(reevaluation_debut, reevaluation_fin, barre.progress)
+        if nb_modifies is not None:
+            st.success(f"✅ {nb_modifies} pointage(s) recalculé(s)")
+    if verifier:
+        divergences = verifier_classement_arrivees()
+        if divergences.empty:
+            st.success("✅ Classement vectorisé identique aux règles unitaires")
+        else:
+            st.error(f"❌ {len(divergences)} cas divergent(s)")
+            st.dataframe(divergences.astype(str), use_container_width=True)
+        ecarts = verifier_agregation_statistiques()
+        if ecarts.empty:
+            st.success("✅ Indicateurs statistiques conformes au jeu de contrôle")
+        else:
+            st.error(f"❌ {len(ecarts)} indicateur(s) divergent(s) sur le jeu de contrôle")
+            st.dataframe(ecarts.astype(str), use_container_width=True)
+
 def show_gestion_utilisateurs():
     st.title("👥 Gestion des Utilisateurs")
     
@@ -4315,7 +7859,7 @@ def show_gestion_utilisateurs():
         st.warning("⛔ Accès réservé aux administrateurs")
         return
     
-    tab1, tab2 = st.tabs(["Liste des Utilisateurs", "Ajouter un Utilisateur"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Liste des Utilisateurs", "Ajouter un Utilisateur", "Règles de pointage", "Maintenance"])
     
     with tab1:
         st.subheader("📋 Liste des utilisateurs")
@@ -4344,6 +7888,111 @@ def show_gestion_utilisateurs():
                         st.error("❌ Erreur lors de l'ajout de l'utilisateur")
                 else:
                     st.warning("⚠️ Veuillez remplir tous les champs obligatoires")
+    
+    with tab3:
+        display_regles_pointage()
+    
+    with tab4:
+        st.subheader("🩺 Audit des plans de requête")
+        if st.button("🔍 Lancer l'audit EXPLAIN QUERY PLAN"):
+            audit_df = auditer_plans_requetes()
+            if not audit_df.empty:
+                scans = audit_df[audit_df['parcours_complet']]
+                if scans.empty:
+                    st.success("✅ Aucun parcours complet de table détecté")
+                else:
+                    st.warning(f"⚠️ {len(scans)} parcours complet(s) détecté(s)")
+                st.dataframe(audit_df, use_container_width=True)
+
+        st.subheader("⏱️ Tâches planifiées")
+        if PLANIFICATEUR_ACTIF:
+            planificateur = get_planificateur(DB_PATH)
+            if planificateur.actif:
+                st.success(f"✅ Planificateur actif (dernière vérification: {planificateur.derniere_verification or 'en attente'})")
+            else:
+                st.error("❌ Planificateur arrêté")
+        else:
+            st.info("Planificateur désactivé (PLANIFICATEUR_ACTIF)")
+
+        historique_taches = get_historique_taches_planifiees()
+        if not historique_taches.empty:
+            st.dataframe(historique_taches, use_container_width=True)
+        else:
+            st.info("Aucune tâche planifiée exécutée")
+
+        st.subheader("🗄️ Archives mensuelles")
+        if pyarrow is None:
+            st.info("Archivage indisponible : installer pyarrow pour archiver les mois clos en Parquet")
+        else:
+            st.caption(f"Les mois antérieurs aux {ARCHIVE_MOIS_CONSERVES} derniers mois sont archivés à la clôture de la journée")
+            if st.button("🗄️ Archiver les mois clos maintenant"):
+                with st.spinner("Archivage..."):
+                    resultat = archiver_mois_clos()
+                if resultat is not None:
+                    st.success(f"✅ {resultat}")
+        historique_archives = get_historique_archives()
+        if not historique_archives.empty:
+            st.dataframe(historique_archives, use_container_width=True)
+
+        st.subheader("📈 Statistiques mensuelles")
+        st.caption("Cumul par employé et par mois, tenu à jour à chaque pointage, correction et absence")
+        if st.button("🔄 Reconstruire le cumul depuis les données brutes"):
+            with st.spinner("Reconstruction..."):
+                nb_lignes = reconstruire_stats_mensuelles()
+            if nb_lignes is not None:
+                st.success(f"✅ {nb_lignes} ligne(s) de cumul reconstruites")
+
+        st.subheader("📅 Shifts prévus")
+        st.caption(f"Calendrier matérialisé sur {SHIFTS_HORIZON_JOURS} jours, tenu à jour à chaque modification du personnel, des congés et du roulement")
+        resume_shifts = get_resume_shifts(date.today(), date.today() + timedelta(days=SHIFTS_HORIZON_JOURS))
+        if not resume_shifts.empty:
+            st.dataframe(resume_shifts, use_container_width=True)
+        if st.button("🔄 Régénérer les shifts prévus"):
+            with st.spinner("Régénération..."):
+                nb_shifts = regenerer_shifts_prevus()
+            if nb_shifts is not None:
+                st.success(f"✅ {nb_shifts} shift(s) régénérés")
+
+        st.subheader("🧾 Journal des pointages")
+        st.caption("Badgeages, corrections et annulations en ajout seul ; les pointages en sont dérivés")
+        resume_evenements = get_resume_evenements()
+        if not resume_evenements.empty:
+            st.dataframe(resume_evenements, use_container_width=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            reconstruction_debut = st.date_input("Du", value=date.today().replace(day=1), key="reconstruction_debut")
+        with col2:
+            reconstruction_fin = st.date_input("Au", value=date.today(), key="reconstruction_fin")
+        if st.button("🔄 Reconstruire les pointages depuis le journal"):
+            barre = st.progress(0.0)
+            nb_derivees = reconstruire_pointages(reconstruction_debut, reconstruction_fin, barre.progress)
+            if nb_derivees is not None:
+                st.success(f"✅ {nb_derivees} pointage(s) reconstruit(s)")
+
+        st.subheader("🧾 File d'écriture")
+        if FILE_ECRITURES_ACTIVE:
+            metriques = get_file_ecritures(DB_PATH).metriques()
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("En attente", f"{metriques['profondeur']} / {metriques['capacite']}")
+            with col2:
+                st.metric("Taille moyenne des groupes", metriques['taille_moyenne_groupe'])
+            with col3:
+                st.metric("Attente moyenne (ms)", metriques['attente_moyenne_ms'])
+            with col4:
+                st.metric("Rejetées (file pleine)", metriques['rejetees'])
+            st.json(metriques)
+        else:
+            st.info("File d'écriture désactivée (FILE_ECRITURES_ACTIVE)")
+
+        st.subheader("📡 Service de pointage des badgeuses")
+        if SERVICE_POINTAGE_ACTIF and demarrer_service_pointage() is not None:
+            st.success(f"✅ À l'écoute sur http://{SERVICE_POINTAGE_HOTE}:{SERVICE_POINTAGE_PORT}/pointages")
+            st.caption('Exemple : {"personnel_id": 12, "sens": "arrivee", "heure": "07:52:10"} ou une liste de pointages')
+        elif SERVICE_POINTAGE_ACTIF and not SERVICE_POINTAGE_JETON:
+            st.warning("⚠️ Service de pointage non démarré : définir la variable d'environnement POINTAGE_JETON")
+        else:
+            st.warning("⚠️ Service de pointage non démarré")
 
 # =========================
 # Point d'entrée principal
@@ -4364,15 +8013,5 @@ if __name__ == "__main__":
     if "show_stats" not in st.session_state:
         st.session_state.show_stats = False
     
-    # Vérification de la connexion à la base de données
-    if not test_connection_background():
-        st.error("❌ Impossible de se connecter à la base de données. Vérifiez la configuration.")
-        st.stop()
-    
-    # Initialisation des tables
-    if not create_tables():
-        st.error("❌ Erreur lors de l'initialisation des tables de la base de données.")
-        st.stop()
-    
-    # Lancement de l'application
+    # Lancement de l'application (initialise la base une fois par processus)
     main()
\ No newline at end of file